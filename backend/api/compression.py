@@ -0,0 +1,88 @@
+import json
+import os
+import zlib
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware
+
+# Responses smaller than this go out uncompressed
+GZIP_MIN_BYTES = int(os.environ.get("GZIP_MIN_BYTES", 1024))
+# zlib's level 9 costs several times level 5 on large JSON for a few percent
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 5))
+# Cap on a decompressed request body, so a small gzip body can't expand without bound
+GZIP_MAX_REQUEST_BYTES = int(os.environ.get("GZIP_MAX_REQUEST_BYTES", 1 << 30))
+
+class GZipRequestMiddleware:
+    """Decompress request bodies sent with ``Content-Encoding: gzip``.
+
+    The body is inflated as it arrives and handed to the app as one message
+    without the encoding header, so endpoints see plain JSON or uploads. Other
+    encodings get 415; corrupt or oversized bodies get 400 and 413.
+    """
+
+    def __init__(self, app, max_bytes: int = GZIP_MAX_REQUEST_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = Headers(scope=scope).get("content-encoding", "identity").strip().lower()
+        if encoding == "identity":
+            await self.app(scope, receive, send)
+            return
+        if encoding not in ("gzip", "x-gzip"):
+            await self._reject(send, 415, f"Unsupported Content-Encoding '{encoding}'; send gzip or identity")
+            return
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks, size = [], 0
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                data = decompressor.decompress(message.get("body", b""), self.max_bytes - size + 1)
+                size += len(data)
+                if size > self.max_bytes or decompressor.unconsumed_tail:
+                    await self._reject(send, 413, f"Decompressed body exceeds {self.max_bytes} bytes")
+                    return
+                chunks.append(data)
+                if not message.get("more_body", False):
+                    break
+            chunks.append(decompressor.flush())
+        except zlib.error as e:
+            await self._reject(send, 400, f"Body is not valid gzip: {e}")
+            return
+        if not decompressor.eof:
+            await self._reject(send, 400, "Body is not valid gzip: truncated stream")
+            return
+
+        body = b"".join(chunks)
+        headers = [(name, value) for name, value in scope["headers"] if name not in (b"content-encoding", b"content-length")]
+        scope = {**scope, "headers": headers + [(b"content-length", str(len(body)).encode())]}
+        replayed = False
+
+        async def receive_body():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        await self.app(scope, receive_body, send)
+
+    @staticmethod
+    async def _reject(send, status: int, detail: str):
+        body = json.dumps({"detail": detail}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+def add_compression(app) -> None:
+    """gzip responses for clients that accept it, and accept gzip request bodies."""
+    app.add_middleware(GZipRequestMiddleware)
+    app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_BYTES, compresslevel=GZIP_LEVEL)
@@ -0,0 +1,24 @@
+import io
+import pandas as pd
+import pyarrow as pa
+
+STREAM_CHUNK_ROWS = 10_000
+
+def iter_ndjson(df: pd.DataFrame, chunk_rows: int = STREAM_CHUNK_ROWS):
+    """Yield ``df`` as newline-delimited JSON, ``chunk_rows`` rows at a time."""
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].to_json(orient="records", lines=True)
+        yield chunk if chunk.endswith("\n") else chunk + "\n"
+
+def iter_arrow(df: pd.DataFrame, chunk_rows: int = STREAM_CHUNK_ROWS):
+    """Yield ``df`` as an Arrow IPC stream, one record batch of ``chunk_rows`` rows at a time."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    buf = io.BytesIO()
+    with pa.ipc.new_stream(buf, table.schema) as writer:
+        for batch in table.to_batches(max_chunksize=chunk_rows):
+            writer.write_batch(batch)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    # Schema-only streams (empty pages) and the end-of-stream marker
+    yield buf.getvalue()
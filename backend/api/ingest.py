@@ -0,0 +1,27 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+PARQUET_MAGIC = b"PAR1"
+ARROW_FILE_MAGIC = b"ARROW1"
+
+def read_table(body: bytes) -> pd.DataFrame:
+    """Decode an Arrow IPC (file or stream) or Parquet body into a DataFrame.
+
+    The format is sniffed from the leading magic bytes, so clients don't need to
+    send a matching content type. Raises ``ValueError`` if the body is neither.
+    """
+    buf = pa.py_buffer(body)
+    try:
+        if body[:4] == PARQUET_MAGIC:
+            table = pq.read_table(pa.BufferReader(buf))
+        elif body[:6] == ARROW_FILE_MAGIC:
+            table = pa.ipc.open_file(buf).read_all()
+        else:
+            table = pa.ipc.open_stream(buf).read_all()
+    except pa.ArrowInvalid as e:
+        raise ValueError(f"Body is not Arrow IPC or Parquet: {e}") from e
+    # Columns are converted one at a time and released as they go, so the
+    # table and the DataFrame are never fully held in memory together. String
+    # columns become categoricals, which is also how confounders get encoded.
+    return table.to_pandas(split_blocks=True, self_destruct=True, strings_to_categorical=True)
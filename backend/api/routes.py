@@ -1,36 +1,413 @@
-from fastapi import APIRouter
-from api.schemas import PSMRequest, PSMResponse, DMLRequest, DMLResponse
-from core.psm import psm
-from core.dml import dml
+from typing import List, Literal, Optional
+import pandas as pd
+from fastapi import APIRouter, File, Form, HTTPException, Path, Query, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from api.schemas import PSMParams, PSMRequest, PSMResponse, DMLParams, DMLRequest, DMLStreamRequest, DMLResponse, DatasetInfo, JobStatus, BatchRequest, BatchItem, ScoreRequest, ScoreResponse, DATASET_ID_PATTERN
+from api.ingest import read_table
+from api.export import iter_arrow, iter_ndjson
+from core.datasets import store, content_id
+from core.results import results
+from core.metrics import observe_stages, run_instrumented, serialize
+from core.preprocessing import compact_frame, encode_confounders
+from core.jobs import jobs, QueueFullError, SUCCEEDED, FAILED, CANCELLED
 router = APIRouter()
 
-@router.post("/psm", response_model = PSMResponse)
-async def psm_endpoint(request: PSMRequest):
-  result = psm(
-      data=request.data,
-      treatment_col=request.treatment_col,
-      outcome_col=request.outcome_col,
-      confounders=request.confounders, 
-      n_neighbors=request.n_neighbors,
-      random_state=request.random_state,
-      scale_features=request.scale_features,
-      use_caliper=request.use_caliper,
-      caliper=request.caliper,
-      show_prop_hist=request.show_prop_hist,
-      show_matched_pair_hist=request.show_matched_pair_hist
+# The estimator modules load scikit-learn, most of the app's import time, so
+# endpoints import them on first use instead (or main.py's warm-up does).
+
+def psm_kwargs(data, params: PSMParams, design=None) -> dict:
+  if params.estimator == "aipw":
+      check_learner("outcome", params.outcome_learner)
+  return dict(
+      data=data,
+      treatment_col=params.treatment_col,
+      outcome_col=params.outcome_col,
+      confounders=params.confounders,
+      n_neighbors=params.n_neighbors,
+      random_state=params.random_state,
+      scale_features=params.scale_features,
+      use_caliper=params.use_caliper,
+      caliper=params.caliper,
+      show_prop_hist=params.show_prop_hist,
+      show_matched_pair_hist=params.show_matched_pair_hist,
+      design=design,
+      include_full_data=params.include_full_data,
+      include_matched_pairs=params.include_matched_pairs,
+      plot_mode=params.plot_mode,
+      n_bootstrap=params.n_bootstrap,
+      confidence_level=params.confidence_level,
+      n_jobs=params.n_jobs,
+      matching_method=params.matching_method,
+      estimator=params.estimator,
+      trim=params.trim,
+      stabilize=params.stabilize,
+      outcome_learner=params.outcome_learner,
+      n_splits=params.n_splits,
+      balance=params.balance
   )
 
-  return result
+def check_learner(role: str, name: str) -> None:
+    from core.learners import resolve_learner
+    try:
+        resolve_learner(role, name, n_rows=0)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def check_learners(params: DMLParams) -> None:
+    from core.learners import OUTCOME, TREATMENT
+    for role, name in ((TREATMENT, params.treatment_learner), (OUTCOME, params.outcome_learner)):
+        check_learner(role, name)
+
+def dml_kwargs(data, params: DMLParams, design=None) -> dict:
+    check_learners(params)
+    return dict(
+        data=data,
+        treatment_col=params.treatment_col,
+        outcome_col=params.outcome_col,
+        confounders=params.confounders,
+        n_splits=params.n_splits,
+        random_state=params.random_state,
+        scale_features=params.scale_features,
+        design=design,
+        n_jobs=params.n_jobs,
+        include_residuals=params.include_residuals,
+        plot_mode=params.plot_mode,
+        n_repeats=params.n_repeats,
+        confidence_level=params.confidence_level,
+        treatment_learner=params.treatment_learner,
+        outcome_learner=params.outcome_learner,
+        cate=params.cate
+    )
+
+def dml_stream_kwargs(params: DMLStreamRequest) -> dict:
+    return dict(
+        source_path=params.source_path,
+        treatment_col=params.treatment_col,
+        outcome_col=params.outcome_col,
+        confounders=params.confounders,
+        n_splits=params.n_splits,
+        random_state=params.random_state,
+        scale_features=params.scale_features,
+        chunk_rows=params.chunk_rows,
+        max_iter=params.max_iter,
+        categories=params.categories,
+        confidence_level=params.confidence_level
+    )
+
+def check_source(path: str):
+    from core.dml_stream import resolve_source
+    try:
+        resolve_source(path)
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+def run_stored(analysis: str, fn, kwargs: dict, params) -> Response:
+    """Run an analysis, keeping its row-level tables in the result store.
+
+    The result is serialized here, once and timed, instead of validated again
+    as the response model. Its stage timings go to ``/metrics`` and the
+    ``Server-Timing`` header.
+    """
+    tables = {}
+    result, timings = run_instrumented(fn, {**kwargs, "tables": tables}, params.include_timings, params.profile)
+    result.result_id = results.put(tables)
+    body = serialize(result, timings)
+    observe_stages(analysis, timings.stages)
+    return Response(content=body, media_type="application/json", headers={"Server-Timing": timings.server_timing()})
+
+def resolve_data(request):
+    """Inline records, or the stored DataFrame and cached design matrix for ``dataset_id``."""
+    if request.dataset_id is None:
+        return request.data, None
+    try:
+        df = store.get(request.dataset_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset_id '{request.dataset_id}'")
+    return df, store.design(request.dataset_id, request.confounders, request.scale_features)
+
+def resolve_incremental(request) -> pd.DataFrame:
+    """The stored DataFrame an ``incremental`` request continues on."""
+    if request.dataset_id is None:
+        raise HTTPException(status_code=400, detail="incremental runs need a dataset_id")
+    try:
+        return store.get(request.dataset_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset_id '{request.dataset_id}'")
+
+def batch_runs(request: BatchRequest) -> list:
+    """The batch as ``run_batch`` runs, all on one DataFrame with one design
+    matrix per distinct confounder set."""
+    specs = [("psm", params, psm_kwargs) for params in request.psm] + [("dml", params, dml_kwargs) for params in request.dml]
+    if request.dataset_id is not None:
+        try:
+            df = store.get(request.dataset_id)
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"Unknown dataset_id '{request.dataset_id}'")
+    designs = {}
+    runs = []
+    try:
+        if request.dataset_id is None:
+            # Columns some spec analyses as treatment or outcome keep their dtypes
+            analysed = {col for _, params, _ in specs for col in (params.treatment_col, params.outcome_col)}
+            confounders = {col for _, params, _ in specs for col in params.confounders}
+            df = compact_frame(request.data, sorted(confounders - analysed))
+        for analysis, params, to_kwargs in specs:
+            key = (tuple(params.confounders), params.scale_features)
+            if key not in designs:
+                designs[key] = (
+                    encode_confounders(df, params.confounders, params.scale_features) if request.dataset_id is None
+                    else store.design(request.dataset_id, params.confounders, params.scale_features)
+                )
+            runs.append((analysis, to_kwargs(df, params, designs[key]), params.include_timings, params.profile))
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"Unknown column {e}")
+    return runs
+
+async def read_upload(file: UploadFile, params: str, params_model):
+    try:
+        parsed = params_model.model_validate_json(params)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+    try:
+        df = await run_in_threadpool(read_table, await file.read())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return df, parsed
+
+# The analysis endpoints are plain `def` so FastAPI runs them in its threadpool
+# instead of blocking the event loop for the length of the fit.
+@router.post("/psm", response_model = PSMResponse)
+def psm_endpoint(request: PSMRequest):
+  from core.psm import psm
+  from core.incremental import psm_incremental
+  if request.incremental:
+      kwargs = {**psm_kwargs(resolve_incremental(request), request), "dataset_id": request.dataset_id}
+      return run_stored("psm", psm_incremental, kwargs, request)
+  data, design = resolve_data(request)
+  return run_stored("psm", psm, psm_kwargs(data, request, design), request)
+
+@router.post("/psm/upload", response_model=PSMResponse)
+async def psm_upload_endpoint(file: UploadFile = File(...), params: str = Form(...)):
+    """PSM on an Arrow IPC or Parquet file; ``params`` is a JSON-encoded ``PSMParams``."""
+    from core.psm import psm
+    df, parsed = await read_upload(file, params, PSMParams)
+    return await run_in_threadpool(run_stored, "psm", psm, psm_kwargs(df, parsed), parsed)
 
 @router.post("/dml", response_model=DMLResponse)
-async def dml_endpoint(request: DMLRequest):
-    result = dml(
-        data=request.data,
-        treatment_col=request.treatment_col,
-        outcome_col=request.outcome_col,
-        confounders=request.confounders,
-        n_splits=request.n_splits,
-        random_state=request.random_state
+def dml_endpoint(request: DMLRequest):
+    from core.dml import dml
+    from core.incremental import dml_incremental
+    if request.incremental:
+        kwargs = {**dml_kwargs(resolve_incremental(request), request), "dataset_id": request.dataset_id}
+        return run_stored("dml", dml_incremental, kwargs, request)
+    data, design = resolve_data(request)
+    return run_stored("dml", dml, dml_kwargs(data, request, design), request)
+
+@router.post("/dml/upload", response_model=DMLResponse)
+async def dml_upload_endpoint(file: UploadFile = File(...), params: str = Form(...)):
+    """DML on an Arrow IPC or Parquet file; ``params`` is a JSON-encoded ``DMLParams``."""
+    from core.dml import dml
+    df, parsed = await read_upload(file, params, DMLParams)
+    return await run_in_threadpool(run_stored, "dml", dml, dml_kwargs(df, parsed), parsed)
+
+@router.post("/dml/stream", response_model=DMLResponse)
+def dml_stream_endpoint(request: DMLStreamRequest):
+    """DML over a file under ``DML_SOURCE_ROOT`` that is too large to load at once."""
+    from core.dml_stream import dml_streaming
+    check_source(request.source_path)
+    try:
+        return run_stored("dml_stream", dml_streaming, dml_stream_kwargs(request), request)
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/dml/{model_id}/score", response_model=ScoreResponse)
+def dml_score_endpoint(model_id: str, request: ScoreRequest):
+    """Conditional effects of new confounder rows under a DML run's effect model
+    (``cate.model_id`` of a ``cate`` run), in the rows' order."""
+    from core.cate import effect_models
+    try:
+        model = effect_models.get(model_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown model_id '{model_id}'")
+    rows = pd.DataFrame(request.columns if request.columns is not None else request.data)
+    try:
+        effects = model.predict(rows)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"Missing confounder column {e}")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    # Serialized once here instead of validated again as the response model
+    body = ScoreResponse.model_construct(model_id=model_id, cate=effects.tolist()).model_dump_json()
+    return Response(content=body, media_type="application/json")
+
+@router.post("/batch")
+def batch_endpoint(request: BatchRequest):
+    """Run every PSM and DML specification in the batch on its one dataset.
+
+    Streams an NDJSON ``BatchItem`` line per specification as it finishes.
+    Specs sharing a confounder set share one encoding and one propensity fit.
+    """
+    from core.batch import run_batch
+    runs = batch_runs(request)
+    n_psm = len(request.psm)
+
+    def items():
+        for position, result, tables, stages, error in run_batch(runs, request.n_jobs):
+            analysis = runs[position][0]
+            if error is None:
+                observe_stages(analysis, stages)
+                result.result_id = results.put(tables)
+            index = position if analysis == "psm" else position - n_psm
+            yield BatchItem(analysis=analysis, index=index, result=result, error=error).model_dump_json() + "\n"
+
+    return StreamingResponse(items(), media_type="application/x-ndjson")
+
+@router.post("/datasets", response_model=DatasetInfo)
+async def dataset_upload_endpoint(file: UploadFile = File(...)):
+    """Register an Arrow IPC or Parquet file; its ID can replace ``data`` in PSM/DML requests."""
+    body = await file.read()
+    dataset_id = content_id(body)
+    if dataset_id not in store:
+        try:
+            store.put(dataset_id, await run_in_threadpool(read_table, body))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    df = store.get(dataset_id)
+    return DatasetInfo(dataset_id=dataset_id, n_rows=len(df), columns=[str(c) for c in df.columns])
+
+@router.post("/datasets/{dataset_id}/append", response_model=DatasetInfo)
+async def dataset_append_endpoint(dataset_id: str = Path(pattern=DATASET_ID_PATTERN), file: UploadFile = File(...)):
+    """Register ``dataset_id``'s rows followed by an Arrow IPC or Parquet file's
+    rows as a new dataset; incremental runs on it continue from the original's."""
+    body = await file.read()
+    new_id = content_id(dataset_id.encode() + body)
+    if new_id not in store:
+        try:
+            rows = await run_in_threadpool(read_table, body)
+            await run_in_threadpool(store.append, dataset_id, new_id, rows)
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"Unknown dataset_id '{dataset_id}'")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    df = store.get(new_id)
+    return DatasetInfo(dataset_id=new_id, n_rows=len(df), columns=[str(c) for c in df.columns], parent_id=dataset_id)
+
+@router.delete("/datasets/{dataset_id}")
+async def dataset_delete_endpoint(dataset_id: str = Path(pattern=DATASET_ID_PATTERN)):
+    try:
+        store.delete(dataset_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset_id '{dataset_id}'")
+    return {"message": "Dataset deleted."}
+
+@router.get("/results/{result_id}/{table}")
+def result_table_endpoint(
+    result_id: str,
+    table: str,
+    offset: int = Query(default=0, ge=0),
+    limit: Optional[int] = Query(default=None, ge=1),
+    columns: Optional[List[str]] = Query(default=None),
+    format: Literal["json", "ndjson", "arrow"] = "json"
+):
+    """Rows ``offset:offset+limit`` of a result table (``full_data``, ``matched_pairs``,
+    ``balance``, ``residuals`` or ``cate``), optionally restricted to ``columns``.
+
+    ``json`` returns one page object; ``ndjson`` and ``arrow`` stream the rows.
+    The unpaginated row count is sent in the ``X-Total-Rows`` header.
+    """
+    try:
+        df = results.get(result_id, table)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown result '{result_id}/{table}'")
+    if columns:
+        missing = [c for c in columns if c not in df.columns]
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Unknown columns: {missing}")
+        df = df[columns]
+    total = len(df)
+    page = df.iloc[offset:offset + limit if limit is not None else None]
+    headers = {"X-Total-Rows": str(total)}
+    if format == "arrow":
+        return StreamingResponse(iter_arrow(page), media_type="application/vnd.apache.arrow.stream", headers=headers)
+    if format == "ndjson":
+        return StreamingResponse(iter_ndjson(page), media_type="application/x-ndjson", headers=headers)
+    body = f'{{"total_rows": {total}, "offset": {offset}, "rows": {page.to_json(orient="records")}}}'
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def job_status(job) -> JobStatus:
+    return JobStatus(
+        job_id=job.job_id,
+        kind=job.kind,
+        status=job.status,
+        progress=job.progress,
+        error=job.error,
+        queue_position=jobs.queue_position(job),
+        submitted_at=job.submitted_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at
     )
 
-    return result
\ No newline at end of file
+def get_job(job_id: str):
+    try:
+        return jobs.get(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown job_id '{job_id}'")
+
+def submit_job(kind: str, kwargs: dict, params) -> JobStatus:
+    # Job workers are separate processes, which don't share incremental states
+    if getattr(params, "incremental", False):
+        raise HTTPException(status_code=400, detail="incremental runs can't be submitted as jobs")
+    try:
+        return job_status(jobs.submit(kind, kwargs, params.include_timings, params.profile))
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=f"Job queue is full: {e}", headers={"Retry-After": "5"})
+
+def job_data(request) -> dict:
+    """What a job needs to find its data: inline records, or the ID of a
+    registered dataset, shared for the workers to load themselves."""
+    if request.dataset_id is None:
+        return {"data": request.data}
+    try:
+        store.share(request.dataset_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset_id '{request.dataset_id}'")
+    return {"data": None, "dataset_id": request.dataset_id}
+
+@router.post("/jobs/psm", response_model=JobStatus, status_code=202)
+def psm_job_endpoint(request: PSMRequest):
+    return submit_job("psm", {**psm_kwargs(None, request), **job_data(request)}, request)
+
+@router.post("/jobs/dml", response_model=JobStatus, status_code=202)
+def dml_job_endpoint(request: DMLRequest):
+    return submit_job("dml", {**dml_kwargs(None, request), **job_data(request)}, request)
+
+@router.post("/jobs/dml/stream", response_model=JobStatus, status_code=202)
+def dml_stream_job_endpoint(request: DMLStreamRequest):
+    check_source(request.source_path)
+    return submit_job("dml_stream", dml_stream_kwargs(request), request)
+
+@router.get("/jobs/{job_id}", response_model=JobStatus)
+async def job_status_endpoint(job_id: str):
+    return job_status(get_job(job_id))
+
+@router.get("/jobs/{job_id}/result")
+async def job_result_endpoint(job_id: str):
+    """The job's ``PSMResponse``/``DMLResponse``; 409 until it has succeeded."""
+    job = get_job(job_id)
+    if job.status == SUCCEEDED:
+        return Response(content=job.result, media_type="application/json")
+    if job.status in (FAILED, CANCELLED):
+        raise HTTPException(status_code=409, detail=f"Job {job.status}: {job.error or 'no result'}")
+    raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+
+@router.delete("/jobs/{job_id}", response_model=JobStatus)
+async def job_cancel_endpoint(job_id: str):
+    try:
+        job = jobs.cancel(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown job_id '{job_id}'")
+    return job_status(job)
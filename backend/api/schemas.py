@@ -1,8 +1,38 @@
-from typing import List, Dict, Any, Optional, Union
-from pydantic import BaseModel, Field
+from typing import Annotated, List, Dict, Any, Literal, Optional, Union
+from pydantic import AfterValidator, BaseModel, Field, model_validator
 
-class PSMRequest(BaseModel):
-    data: List[Dict[str, Any]]
+def check_n_jobs(v: int) -> int:
+    if v == 0:
+        raise ValueError("n_jobs must be positive or -1")
+    return v
+
+# Worker count in joblib's convention: -1 uses every core
+NJobs = Annotated[int, Field(ge=-1), AfterValidator(check_n_jobs)]
+
+# Dataset IDs are SHA-256 content hashes (``core.datasets.content_id``), and
+# name files in the store's spill and share directories
+DATASET_ID_PATTERN = r"^[0-9a-f]{64}$"
+DatasetId = Annotated[str, Field(pattern=DATASET_ID_PATTERN)]
+
+class DatasetRef(BaseModel):
+    """Request data given inline as records, or as the ID of a registered dataset."""
+    data: Optional[List[Dict[str, Any]]] = None
+    dataset_id: Optional[DatasetId] = None
+
+    @model_validator(mode="after")
+    def check_one_source(self):
+        if (self.data is None) == (self.dataset_id is None):
+            raise ValueError("Provide exactly one of 'data' or 'dataset_id'")
+        return self
+
+class DatasetInfo(BaseModel):
+    dataset_id: str
+    n_rows: int
+    columns: List[str]
+    # The dataset this one was appended to
+    parent_id: Optional[str] = None
+
+class PSMParams(BaseModel):
     treatment_col: str
     outcome_col: str
     confounders: List[str]
@@ -13,21 +43,89 @@ class PSMRequest(BaseModel):
     caliper: Optional[float] = Field(default=0.1, ge=0.0)
     show_prop_hist: bool = True
     show_matched_pair_hist: bool = False
+    include_full_data: bool = False
+    include_matched_pairs: bool = False
+    plot_mode: Literal["binned", "raw"] = "binned"
+    n_bootstrap: int = Field(default=0, ge=0)
+    confidence_level: float = Field(default=0.95, gt=0.0, lt=1.0)
+    n_jobs: NJobs = 1
+    include_timings: bool = False
+    profile: bool = False
+    matching_method: Literal["nearest", "greedy", "optimal"] = "nearest"
+    # ipw/aipw weight by the propensity scores instead of matching; trim clips
+    # the scores to [trim, 1 - trim], and AIPW cross-fits outcome_learner (a
+    # DML outcome learner) over n_splits folds
+    estimator: Literal["matching", "ipw", "aipw"] = "matching"
+    trim: float = Field(default=0.01, ge=0.0, lt=0.5)
+    stabilize: bool = True
+    outcome_learner: str = "ridge"
+    n_splits: int = Field(default=5, ge=2)
+    # Covariate balance before and after matching (or weighting)
+    balance: bool = True
+
+class PSMRequest(PSMParams, DatasetRef):
+    # Continue from the state of an earlier incremental run on this dataset or
+    # one it was appended to; needs a dataset_id, and isn't kept for jobs
+    incremental: bool = False
 
 class PlotData(BaseModel):
     treated_values: Optional[List[float]] = None
     control_values: Optional[List[float]] = None
+    bin_edges: Optional[List[float]] = None
+    treated_counts: Optional[List[int]] = None
+    control_counts: Optional[List[int]] = None
     title: str
     xlabel: str
     ylabel: str
     legend_labels: Optional[List[str]] = None
 
+class EffectInference(BaseModel):
+    estimate: float
+    std_error: Optional[float] = None
+    ci_lower: Optional[float] = None
+    ci_upper: Optional[float] = None
+    # Coverage of [ci_lower, ci_upper]; None without an interval
+    confidence_level: Optional[float] = None
+    n_replicates: int
+
+class StageTiming(BaseModel):
+    seconds: float
+    peak_rss_mb: Optional[float] = None
+
 class MatchedPairInfo(BaseModel):
     treated_index: Union[int, str] 
     control_index: Union[int, str] 
     distance: float
 
+class IncrementalInfo(BaseModel):
+    """How an incremental run got its fit: from the state kept for
+    ``base_dataset_id`` (``None`` when it started over) plus ``rows_appended``
+    rows, recomputing ``recomputed`` matched units (PSM) or fold models (DML).
+
+    ``rows_since_fit`` rows were not seen by the propensity model (PSM) or by
+    the most out-of-date fold model (DML); while it is nonzero the run is
+    ``stale`` and its estimates can differ from a full refit's."""
+    base_dataset_id: Optional[str] = None
+    rows_appended: int = 0
+    recomputed: int = 0
+    rows_since_fit: int = 0
+    stale: bool = False
+
+class CovariateBalance(BaseModel):
+    """Balance of one design column: standardized mean difference, treated to
+    control variance ratio and eCDF gaps, before and after matching."""
+    covariate: str
+    smd_pre: Optional[float] = None
+    smd_post: Optional[float] = None
+    var_ratio_pre: Optional[float] = None
+    var_ratio_post: Optional[float] = None
+    ecdf_mean_pre: Optional[float] = None
+    ecdf_mean_post: Optional[float] = None
+    ecdf_max_pre: Optional[float] = None
+    ecdf_max_post: Optional[float] = None
+
 class PSMResponse(BaseModel):
+    result_id: Optional[str] = None
     att: Optional[float] = None
     ate_raw: Optional[float] = None 
     num_matched_pairs: Optional[int] = None
@@ -36,9 +134,13 @@ class PSMResponse(BaseModel):
     matched_outcome_plot_data: Optional[PlotData] = None
     full_data_with_psm_info: Optional[List[Dict[str, Any]]] = None
     matched_pairs_table: Optional[List[MatchedPairInfo]] = None
+    inference: Optional[Dict[str, EffectInference]] = None
+    balance: Optional[List[CovariateBalance]] = None
+    incremental: Optional[IncrementalInfo] = None
+    timings: Optional[Dict[str, StageTiming]] = None
+    profile: Optional[str] = None
 
-class DMLRequest(BaseModel):
-    data: List[Dict[str, Any]]
+class DMLParams(BaseModel):
     treatment_col: str
     outcome_col: str
     confounders: List[str]
@@ -46,10 +148,102 @@ class DMLRequest(BaseModel):
     random_state: int = 42
     scale_features: bool = True
     show_outcome_hist: bool = True
+    include_residuals: bool = False
+    plot_mode: Literal["binned", "raw"] = "binned"
+    n_jobs: NJobs = 1
+    n_repeats: int = Field(default=1, ge=1)
+    confidence_level: float = Field(default=0.95, gt=0.0, lt=1.0)
+    treatment_learner: str = "logistic"
+    outcome_learner: str = "random_forest"
+    cate: bool = False
+    include_timings: bool = False
+    profile: bool = False
+
+class DMLRequest(DMLParams, DatasetRef):
+    # As for PSMRequest
+    incremental: bool = False
+
+class DMLStreamRequest(DMLParams):
+    """DML over a server-side Parquet/CSV file, read in chunks of ``chunk_rows``.
+
+    ``source_path`` is relative to ``DML_SOURCE_ROOT``. ``categories`` pins the
+    levels of categorical confounders; otherwise they are collected in a first
+    pass. ``max_iter`` caps the passes spent fitting the propensity model.
+    ``n_jobs``, ``n_repeats``, ``plot_mode``, ``include_residuals``, ``cate``
+    and the nuisance learners don't apply to streaming runs, whose nuisance
+    models are always the ``logistic`` and ``ridge`` learners' models.
+    """
+    source_path: str
+    chunk_rows: int = Field(default=100_000, ge=1)
+    max_iter: int = Field(default=25, ge=1)
+    categories: Optional[Dict[str, List[str]]] = None
+
+class CATESummary(BaseModel):
+    """Distribution of the per-unit effects; ``model_id`` scores new rows."""
+    model_id: str
+    mean: float
+    std: float
+    quantiles: Dict[str, float]
 
 class DMLResponse(BaseModel):
+    result_id: Optional[str] = None
     ate: Optional[float] = None
     att: Optional[float] = None
     message: Optional[str] = None
     outcome_plot: Optional[PlotData] = None
-    linear_regression_plot: Optional[dict] = None
\ No newline at end of file
+    linear_regression_plot: Optional[dict] = None
+    inference: Optional[Dict[str, EffectInference]] = None
+    learners: Optional[Dict[str, str]] = None
+    cate: Optional[CATESummary] = None
+    incremental: Optional[IncrementalInfo] = None
+    timings: Optional[Dict[str, StageTiming]] = None
+    profile: Optional[str] = None
+
+class ScoreRequest(BaseModel):
+    """Confounder rows to score, as records or as ``{column: values}``; the
+    columnar form is much cheaper to parse for large batches."""
+    data: Optional[List[Dict[str, Any]]] = None
+    columns: Optional[Dict[str, List[Any]]] = None
+
+    @model_validator(mode="after")
+    def check_one_source(self):
+        if (self.data is None) == (self.columns is None):
+            raise ValueError("Provide exactly one of 'data' or 'columns'")
+        return self
+
+class ScoreResponse(BaseModel):
+    model_id: str
+    cate: List[float]
+
+class BatchRequest(DatasetRef):
+    """One dataset analysed under a grid of PSM and DML specifications.
+
+    Results stream back as NDJSON ``BatchItem`` lines in completion order;
+    ``n_jobs`` is how many specifications run at once.
+    """
+    psm: List[PSMParams] = Field(default_factory=list)
+    dml: List[DMLParams] = Field(default_factory=list)
+    n_jobs: NJobs = 1
+
+    @model_validator(mode="after")
+    def check_specs(self):
+        if not self.psm and not self.dml:
+            raise ValueError("Provide at least one 'psm' or 'dml' specification")
+        return self
+
+class BatchItem(BaseModel):
+    analysis: Literal["psm", "dml"]
+    index: int  # Position in the request's ``psm`` or ``dml`` list
+    result: Optional[Union[PSMResponse, DMLResponse]] = None
+    error: Optional[str] = None
+
+class JobStatus(BaseModel):
+    job_id: str
+    kind: str
+    status: str
+    progress: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    queue_position: Optional[int] = None
+    submitted_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
@@ -0,0 +1,137 @@
+"""Benchmark the PSM and DML engines on synthetic data with a known effect.
+
+Run from ``backend/``::
+
+    python -m benchmarks.run                           # compare against the baseline
+    python -m benchmarks.run --sizes 1000,10000 --engines psm,dml
+    python -m benchmarks.run --update-baseline         # record a new baseline
+
+Each case runs in a fresh process, so peak RSS is that case's alone. Wall
+time covers the engine call (or the HTTP round trip for the ``api_*``
+engines), not data generation. The exit status is 1 if any case regressed
+against the baseline.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import resource
+import sys
+import time
+from benchmarks.synthetic import make_confounded
+
+ENGINES = ["psm", "dml", "api_psm", "api_dml"]
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# Below this many seconds, timing differences are treated as noise
+TIME_FLOOR = 0.05
+
+def _run_case(engine, n, n_covariates, n_categories, treated_share, seed):
+    df, confounders, truth = make_confounded(n, n_covariates, n_categories, treated_share, seed=seed)
+    params = dict(treatment_col="t", outcome_col="y", confounders=confounders)
+
+    if engine == "psm":
+        from core.psm import psm
+        start = time.perf_counter()
+        result = psm(data=df, **params, n_neighbors=1, random_state=42, scale_features=True,
+                     use_caliper=False, caliper=0.1, show_prop_hist=True, show_matched_pair_hist=False)
+    elif engine == "dml":
+        from core.dml import dml
+        start = time.perf_counter()
+        result = dml(data=df, **params)
+    else:
+        from fastapi.testclient import TestClient
+        from main import app
+        client = TestClient(app)
+        records = df.to_dict(orient="records")
+        start = time.perf_counter()
+        response = client.post(f"/api/{engine[4:]}", json={"data": records, **params})
+        response.raise_for_status()
+        result = response.json()
+    wall = time.perf_counter() - start
+
+    result = result if isinstance(result, dict) else result.model_dump()
+    # PSM reports its ATE as ate_raw
+    ate = result["ate"] if "ate" in result else result["ate_raw"]
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+    return {
+        "wall_s": wall,
+        "peak_rss_mb": peak,
+        "ate": ate,
+        "att": result["att"],
+        "bias_ate": ate - truth["ate"] if ate is not None else None,
+        "bias_att": result["att"] - truth["att"] if result["att"] is not None else None
+    }
+
+def case_key(engine, n, args) -> str:
+    return f"{engine}/n={n}/p={args.covariates}/k={args.categories}/share={args.treated_share}"
+
+def regressions(current: dict, base: dict, args) -> list:
+    """Human-readable descriptions of every way ``current`` is worse than ``base``."""
+    found = []
+    if current["wall_s"] > base["wall_s"] * (1 + args.time_tolerance) and current["wall_s"] - base["wall_s"] > TIME_FLOOR:
+        found.append(f"wall time {base['wall_s']:.3f}s -> {current['wall_s']:.3f}s")
+    if current["peak_rss_mb"] > base["peak_rss_mb"] * (1 + args.rss_tolerance):
+        found.append(f"peak RSS {base['peak_rss_mb']:.0f}MB -> {current['peak_rss_mb']:.0f}MB")
+    for name in ("bias_ate", "bias_att"):
+        if current[name] is None or base[name] is None:
+            continue
+        if abs(current[name]) > abs(base[name]) + args.bias_tolerance:
+            found.append(f"|{name}| {abs(base[name]):.3f} -> {abs(current[name]):.3f}")
+    return found
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--engines", default=",".join(ENGINES), help="Comma-separated subset of " + ", ".join(ENGINES))
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="Comma-separated row counts")
+    parser.add_argument("--covariates", type=int, default=5)
+    parser.add_argument("--categories", type=int, default=3)
+    parser.add_argument("--treated-share", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="Store this run's results as the baseline")
+    parser.add_argument("--time-tolerance", type=float, default=0.25, help="Allowed relative wall time increase")
+    parser.add_argument("--rss-tolerance", type=float, default=0.25, help="Allowed relative peak RSS increase")
+    parser.add_argument("--bias-tolerance", type=float, default=0.05, help="Allowed absolute bias increase")
+    args = parser.parse_args(argv)
+
+    engines = args.engines.split(",")
+    unknown = set(engines) - set(ENGINES)
+    if unknown:
+        parser.error(f"unknown engines: {sorted(unknown)}")
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    ctx = mp.get_context("spawn")
+    results = {}
+    failed = False
+    print(f"{'case':<48} {'wall_s':>9} {'rss_mb':>8} {'bias_ate':>9} {'bias_att':>9}")
+    for engine in engines:
+        for n in sizes:
+            key = case_key(engine, n, args)
+            with ctx.Pool(1) as pool:
+                current = pool.apply(_run_case, (engine, n, args.covariates, args.categories, args.treated_share, args.seed))
+            results[key] = current
+            fmt = lambda v: f"{v:>9.4f}" if v is not None else f"{'-':>9}"
+            print(f"{key:<48} {current['wall_s']:>9.3f} {current['peak_rss_mb']:>8.0f} {fmt(current['bias_ate'])} {fmt(current['bias_att'])}")
+            if key in baseline and not args.update_baseline:
+                for problem in regressions(current, baseline[key], args):
+                    failed = True
+                    print(f"  REGRESSION: {problem}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({**baseline, **results}, f, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+    elif not baseline:
+        print(f"No baseline at {args.baseline}; run with --update-baseline to record one")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+def _logit_intercept(score: np.ndarray, treated_share: float) -> float:
+    """Intercept that makes the mean propensity ``sigmoid(intercept + score)`` equal ``treated_share``."""
+    lo, hi = -20.0, 20.0
+    for _ in range(60):
+        mid = (lo + hi) / 2
+        if np.mean(1 / (1 + np.exp(-(mid + score)))) < treated_share:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+def make_confounded(
+    n: int,
+    n_covariates: int = 5,
+    n_categories: int = 3,
+    treated_share: float = 0.5,
+    base_effect: float = 2.0,
+    heterogeneity: float = 0.5,
+    seed: int = 0
+):
+    """Confounded observational data with a known treatment effect.
+
+    Numeric covariates ``x0..x{n_covariates-1}`` and one categorical ``cat``
+    with ``n_categories`` levels drive both treatment assignment and the
+    outcome. Treatment ``t`` is drawn from a logistic propensity whose intercept
+    is tuned so that ``treated_share`` of rows are treated. The individual
+    effect is ``base_effect + heterogeneity * x0``, and ``x0`` also raises the
+    propensity, so the ATT differs from the ATE whenever ``heterogeneity`` is
+    non-zero.
+
+    Returns the DataFrame (columns ``x*``, ``cat``, ``t``, ``y``), the list of
+    confounder columns, and the sample ATE and ATT implied by the individual
+    effects.
+    """
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n, n_covariates))
+    cat = rng.integers(n_categories, size=n)
+    cat_shift = np.linspace(-0.5, 0.5, n_categories) if n_categories > 1 else np.zeros(1)
+
+    treatment_weights = rng.uniform(0.2, 0.6, size=n_covariates) * rng.choice([-1, 1], size=n_covariates)
+    treatment_weights[0] = abs(treatment_weights[0])
+    score = X @ treatment_weights + cat_shift[cat]
+    propensity = 1 / (1 + np.exp(-(_logit_intercept(score, treated_share) + score)))
+    t = (rng.random(n) < propensity).astype(int)
+
+    outcome_weights = rng.uniform(0.5, 1.5, size=n_covariates)
+    effect = base_effect + heterogeneity * X[:, 0]
+    y = effect * t + X @ outcome_weights + 2 * cat_shift[cat] + rng.normal(size=n)
+
+    df = pd.DataFrame(X, columns=[f"x{i}" for i in range(n_covariates)])
+    df["cat"] = np.array([f"c{i}" for i in range(n_categories)])[cat]
+    df["t"] = t
+    df["y"] = y
+    truth = {"ate": float(effect.mean()), "att": float(effect[t == 1].mean()) if t.any() else float("nan")}
+    return df, [*df.columns[:n_covariates], "cat"], truth
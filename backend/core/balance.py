@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from api.schemas import CovariateBalance
+from core.preprocessing import ConfounderEncoder
+
+BALANCE_COLUMNS = (
+    "smd_pre", "smd_post", "var_ratio_pre", "var_ratio_post",
+    "ecdf_mean_pre", "ecdf_mean_post", "ecdf_max_pre", "ecdf_max_post",
+)
+
+def _moments(X, weights):
+    """Weighted mean and variance of every column of a dense or sparse ``X``."""
+    total = weights.sum()
+    mean = np.asarray(X.T @ weights).ravel() / total
+    if sparse.issparse(X):
+        square = np.asarray(X.multiply(X).T @ weights).ravel() / total
+    else:
+        square = np.einsum("ij,ij,i->j", X, X, weights) / total
+    return mean, np.maximum(square - mean ** 2, 0.0)
+
+def _ecdf_gaps(ordered, order, treated, weights):
+    """Mean and max over the pooled distinct values of ``|F_treated - F_control|``,
+    per column, with weighted eCDFs.
+
+    ``order`` is the stable argsort of the dense values by column and
+    ``ordered`` the sorted values, so the pre- and post-match gaps share one sort.
+    """
+    rows = weights > 0
+    if not rows.any():
+        return np.full(ordered.shape[1], np.nan), np.full(ordered.shape[1], np.nan)
+    if not rows.all():
+        # Every column keeps the same rows, still in sorted order
+        kept = rows[order]
+        ordered = ordered.T[kept.T].reshape(ordered.shape[1], -1).T
+        order = order.T[kept.T].reshape(order.shape[1], -1).T
+    step = np.where(treated, weights / weights[treated & rows].sum(), -weights / weights[~treated & rows].sum())
+    gap = np.abs(np.cumsum(step[order], axis=0))
+    # Both eCDFs are only compared after the last of a run of tied values
+    last = np.ones(ordered.shape, dtype=bool)
+    last[:-1] = ordered[1:] != ordered[:-1]
+    return (gap * last).sum(axis=0) / last.sum(axis=0), np.where(last, gap, 0.0).max(axis=0)
+
+def balance_table(X, names: list, n_numeric: int, treated: np.ndarray, weights: np.ndarray) -> pd.DataFrame:
+    """Covariate balance of treated against control units, before and after
+    matching or weighting, for every column of the design ``X``.
+
+    ``weights`` are each unit's post-match weights (its match multiplicity,
+    zero if unmatched); before matching every unit counts once. Standardized
+    mean differences use the pre-match pooled standard deviation in both
+    cases, so they are comparable. The design's first ``n_numeric`` columns
+    get sorted eCDFs; the rest are two-valued indicators, whose eCDF gap is
+    the difference in shares at the lower value and zero at the upper one.
+    """
+    treated = np.asarray(treated, dtype=bool)
+    weights = np.asarray(weights, dtype=float)
+    columns = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats = {}
+        for stage, w in (("pre", np.ones(len(weights))), ("post", weights)):
+            stats[stage] = (_moments(X, np.where(treated, w, 0.0)), _moments(X, np.where(treated, 0.0, w)))
+        (mean_t, var_t), (mean_c, var_c) = stats["pre"]
+        pooled_sd = np.sqrt((var_t + var_c) / 2)
+        low = np.asarray(X.min(axis=0).toarray() if sparse.issparse(X) else X.min(axis=0)).ravel()
+        high = np.asarray(X.max(axis=0).toarray() if sparse.issparse(X) else X.max(axis=0)).ravel()
+        numeric = X[:, :n_numeric]
+        numeric = numeric.toarray() if sparse.issparse(numeric) else numeric
+        order = np.argsort(numeric, axis=0, kind="stable")
+        ordered = np.take_along_axis(numeric, order, axis=0)
+        for stage, w in (("pre", np.ones(len(weights))), ("post", weights)):
+            (mean_t, var_t), (mean_c, var_c) = stats[stage]
+            columns[f"smd_{stage}"] = np.where(pooled_sd > 0, (mean_t - mean_c) / pooled_sd, 0.0)
+            columns[f"var_ratio_{stage}"] = var_t / var_c
+            share_gap = np.abs(mean_t - mean_c)[n_numeric:] / (high - low)[n_numeric:]
+            share_gap = np.where((high - low)[n_numeric:] > 0, share_gap, 0.0)
+            ecdf_mean, ecdf_max = _ecdf_gaps(ordered, order, treated, w)
+            columns[f"ecdf_mean_{stage}"] = np.concatenate([ecdf_mean, share_gap / 2])
+            columns[f"ecdf_max_{stage}"] = np.concatenate([ecdf_max, share_gap])
+    return pd.DataFrame({"covariate": names, **{name: columns[name] for name in BALANCE_COLUMNS}})
+
+def covariate_balance(X, df: pd.DataFrame, encoder: ConfounderEncoder, treated, weights, tables: dict | None = None) -> list:
+    """``balance_table`` for the design ``encoder`` makes of ``df``, as response
+    rows; a ``tables`` dict also gets it as ``balance``."""
+    encoder.fit_columns(df)
+    table = balance_table(X, encoder.feature_names(), len(encoder.numeric), treated, weights)
+    if tables is not None:
+        tables["balance"] = table
+    return [
+        CovariateBalance(**{name: value if isinstance(value, str) or np.isfinite(value) else None for name, value in row.items()})
+        for row in table.to_dict(orient="records")
+    ]
@@ -0,0 +1,78 @@
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from joblib import effective_n_jobs
+from core.metrics import run_instrumented
+from core.psm import psm, propensity_scores
+from core.dml import dml
+
+# What a group of runs shares: PSM runs one propensity fit, DML runs the
+# out-of-fold nuisance predictions (through the model cache)
+_SHARED = {
+    "psm": ("treatment_col", "confounders", "scale_features", "random_state"),
+    "dml": ("treatment_col", "outcome_col", "confounders", "scale_features", "n_splits", "random_state",
+            "treatment_learner", "outcome_learner"),
+}
+_ENGINES = {"psm": psm, "dml": dml}
+
+def _signature(kwargs: dict, fields=None) -> tuple:
+    # data and design are the same objects for runs on the same confounders,
+    # so they are left out of the comparison
+    names = fields or sorted(name for name in kwargs if name not in ("data", "design"))
+    return tuple((name, repr(kwargs.get(name))) for name in names)
+
+def plan_batch(runs: list) -> list:
+    """Group ``(analysis, kwargs, include_timings, profile)`` runs by shared work.
+
+    Returns a list of groups, each a list of ``(positions, run)``, where
+    ``positions`` are all indices into ``runs`` of identical specifications,
+    which are computed once.
+    """
+    groups = {}
+    for position, (analysis, kwargs, include_timings, profile) in enumerate(runs):
+        group = groups.setdefault((analysis, _signature(kwargs, _SHARED[analysis])), {})
+        spec = group.setdefault((_signature(kwargs), include_timings, profile), ([], runs[position]))
+        spec[0].append(position)
+    return [list(group.values()) for group in groups.values()]
+
+def _run_group(group: list, emit) -> None:
+    analysis = group[0][1][0]
+    propensity = None
+    for positions, (_, kwargs, include_timings, profile) in group:
+        try:
+            if analysis == "psm" and propensity is None:
+                treatment = kwargs["data"][kwargs["treatment_col"]].to_numpy()
+                propensity, _ = propensity_scores(kwargs["design"], treatment, kwargs["random_state"])
+            if analysis == "psm":
+                kwargs = {**kwargs, "propensity": propensity}
+            tables = {}
+            result, timings = run_instrumented(_ENGINES[analysis], {**kwargs, "tables": tables}, include_timings, profile)
+        except Exception as e:
+            for position in positions:
+                emit((position, None, None, None, str(e)))
+            continue
+        for i, position in enumerate(positions):
+            emit((position, result if i == 0 else result.model_copy(), tables, timings.stages, None))
+
+def run_batch(runs: list, n_jobs: int = 1):
+    """Run a batch of PSM/DML specifications, yielding each result as it finishes.
+
+    ``runs`` holds ``(analysis, kwargs, include_timings, profile)`` tuples whose
+    kwargs carry the shared DataFrame and a precomputed ``design``. Groups from
+    ``plan_batch`` are spread over ``n_jobs`` threads; within a group, runs go
+    one after another so later ones reuse the shared fit, and only matching
+    (PSM) or the final stage (DML, when the model cache is on) is redone.
+    Yields ``(position, result, tables, stages, error)``, with ``error`` set
+    instead of a result when a run raised.
+    """
+    groups = plan_batch(runs)
+    finished = queue.Queue()
+    # The fits release the GIL for most of their time, so threads run them in parallel
+    executor = ThreadPoolExecutor(max_workers=min(effective_n_jobs(n_jobs), len(groups)) or 1)
+    try:
+        for group in groups:
+            executor.submit(_run_group, group, finished.put)
+        for _ in range(len(runs)):
+            yield finished.get()
+    finally:
+        # If the client went away, don't start the groups still queued
+        executor.shutdown(wait=False, cancel_futures=True)
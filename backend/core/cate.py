@@ -0,0 +1,139 @@
+import os
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+import joblib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.linear_model import RidgeCV
+from core.preprocessing import ConfounderEncoder
+
+CATE_ALPHAS = (1e-3, 1e-2, 1e-1, 1.0, 10.0, 100.0)
+
+class EffectModel:
+    """Linear conditional-effect model ``tau(x) = b0 + x @ b`` on encoded confounders.
+
+    The encoding is affine per column, so it is folded into the coefficients:
+    scoring raw rows is one product with the numeric columns plus a table
+    lookup per categorical, without building a design matrix, and the
+    nuisance models are not needed.
+    """
+
+    def __init__(self, encoder: ConfounderEncoder, coef: np.ndarray, model_id: str | None = None):
+        self.encoder = encoder
+        self.coef = coef
+        self.model_id = model_id or uuid.uuid4().hex
+        mean, scale = encoder.column_affine()
+        weights = coef[1:] / scale
+        self.intercept = coef[0] - weights @ mean
+        n_numeric = len(encoder.numeric)
+        self.numeric_weights = weights[:n_numeric]
+        # Per categorical, the effect of each code + 1: missing/unseen, the
+        # dropped first level, then the indicator columns
+        self.level_effects = {}
+        start = n_numeric
+        for name in encoder.categorical:
+            n_levels = max(len(encoder.levels[name]) - 1, 0)
+            self.level_effects[name] = np.concatenate([[0.0, 0.0], weights[start:start + n_levels]])
+            start += n_levels
+
+    @property
+    def confounders(self) -> list:
+        return self.encoder.confounders
+
+    def effects(self, X) -> np.ndarray:
+        """Conditional effects for an already encoded design."""
+        return self.coef[0] + np.asarray(X @ self.coef[1:]).ravel()
+
+    def predict(self, df: pd.DataFrame) -> np.ndarray:
+        """Conditional effects for raw confounder rows.
+
+        Raises ``KeyError`` on a missing column and ``ValueError`` naming the
+        column on a numeric value that is null or not a number. Missing or
+        unseen categorical levels score as the dropped first level.
+        """
+        effects = np.full(len(df), self.intercept)
+        for name, weight in zip(self.encoder.numeric, self.numeric_weights):
+            try:
+                values = df[name].to_numpy(dtype=float)
+            except (ValueError, TypeError):
+                raise ValueError(f"Confounder column '{name}' must be numeric")
+            if np.isnan(values).any():
+                raise ValueError(f"Confounder column '{name}' has null values")
+            effects += values * weight
+        for name, lookup in self.level_effects.items():
+            effects += lookup[self.encoder.codes(df, name) + 1]
+        return effects
+
+def fit_effect_model(X, treatment_residuals, outcome_residuals, encoder: ConfounderEncoder) -> EffectModel:
+    """R-learner final stage on the cross-fitted residuals.
+
+    Minimizes ``sum((outcome_residual - tau(x) * treatment_residual)^2)`` over
+    linear ``tau``, i.e. regresses the outcome residuals on the treatment
+    residual times ``[1, x]``, with the ridge penalty picked by efficient
+    leave-one-out CV. A sparse design stays sparse.
+    """
+    t = treatment_residuals.reshape(-1, 1)
+    if sparse.issparse(X):
+        Z = sparse.hstack([sparse.csr_matrix(t), sparse.csr_matrix(X).multiply(t)], format="csr")
+    else:
+        Z = np.hstack([t, X * t])
+    final_model = RidgeCV(alphas=CATE_ALPHAS).fit(Z, outcome_residuals)
+    return EffectModel(encoder, np.asarray(final_model.coef_, dtype=float))
+
+class EffectModelStore:
+    """LRU of fitted effect models, written through to ``persist_dir``.
+
+    Models are small (an encoder and a coefficient vector), so all of them are
+    kept on disk; only the ``max_models`` most recently used also stay in
+    memory. Job worker processes write their models to the same directory,
+    which is how the API process finds them.
+    """
+
+    def __init__(self, persist_dir: str, max_models: int = 64):
+        self.persist_dir = persist_dir
+        self.max_models = max_models
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(persist_dir, exist_ok=True)
+
+    def put(self, model: EffectModel) -> str:
+        # Write then rename, so readers in other processes never see half a file
+        path = self._path(model.model_id)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        joblib.dump(model, tmp)
+        os.replace(tmp, path)
+        self._remember(model)
+        return model.model_id
+
+    def get(self, model_id: str) -> EffectModel:
+        """Return the model for ``model_id``; raises ``KeyError`` if unknown."""
+        with self._lock:
+            model = self._entries.get(model_id)
+            if model is not None:
+                self._entries.move_to_end(model_id)
+                return model
+        # IDs are hex UUIDs; anything else can't name a file in persist_dir
+        path = self._path(model_id)
+        if not model_id.isalnum() or not os.path.exists(path):
+            raise KeyError(model_id)
+        model = joblib.load(path)
+        self._remember(model)
+        return model
+
+    def _remember(self, model: EffectModel) -> None:
+        with self._lock:
+            self._entries[model.model_id] = model
+            self._entries.move_to_end(model.model_id)
+            while len(self._entries) > self.max_models:
+                self._entries.popitem(last=False)
+
+    def _path(self, model_id: str) -> str:
+        return os.path.join(self.persist_dir, f"{model_id}.joblib")
+
+effect_models = EffectModelStore(
+    persist_dir=os.environ.get("EFFECT_MODEL_DIR") or os.path.join(tempfile.gettempdir(), "causal_effect_models"),
+    max_models=int(os.environ.get("EFFECT_MODEL_CACHE_SIZE", 64)),
+)
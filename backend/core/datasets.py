@@ -0,0 +1,193 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+import pandas as pd
+from api.schemas import DATASET_ID_PATTERN
+from core.preprocessing import design_nbytes, encode_confounders, freeze_design
+
+def content_id(body: bytes) -> str:
+    """Dataset ID for an uploaded body: the SHA-256 of its bytes."""
+    return hashlib.sha256(body).hexdigest()
+
+def is_dataset_id(value: str) -> bool:
+    """Whether ``value`` has the form of a dataset ID, and so can name a file."""
+    return isinstance(value, str) and re.fullmatch(DATASET_ID_PATTERN, value) is not None
+
+class _Entry:
+    __slots__ = ("df", "designs", "nbytes")
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self.designs = {}
+        self.nbytes = int(df.memory_usage(deep=True).sum())
+
+class DatasetStore:
+    """LRU store of parsed datasets and their encoded design matrices.
+
+    Entries are evicted least-recently-used first once their combined size passes
+    ``max_bytes``. With a ``spill_dir``, evicted DataFrames are written there as
+    Parquet and reloaded on the next access; design matrices are recomputed.
+
+    A dataset registered with ``append`` remembers the one it extends, so
+    incremental analyses can continue from a state kept for an ancestor.
+
+    ``share`` writes a dataset to ``share_dir`` for job worker processes, which
+    load it by ID into a store of their own with that directory as spill dir.
+
+    IDs that aren't content IDs (``is_dataset_id``) are unknown, so they never
+    reach a file path.
+    """
+
+    def __init__(self, max_bytes: int, spill_dir: str | None = None, share_dir: str | None = None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.share_dir = share_dir
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._parents = {}
+        self._lock = threading.RLock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __contains__(self, dataset_id: str) -> bool:
+        if not is_dataset_id(dataset_id):
+            return False
+        with self._lock:
+            return dataset_id in self._entries or os.path.exists(self._spill_path(dataset_id))
+
+    def put(self, dataset_id: str, df: pd.DataFrame) -> None:
+        if not is_dataset_id(dataset_id):
+            raise ValueError(f"Invalid dataset ID '{dataset_id}'")
+        with self._lock:
+            if dataset_id in self._entries:
+                self._entries.move_to_end(dataset_id)
+                return
+            entry = _Entry(df)
+            self._entries[dataset_id] = entry
+            self._nbytes += entry.nbytes
+            self._evict()
+
+    def append(self, dataset_id: str, new_id: str, rows: pd.DataFrame) -> pd.DataFrame:
+        """Register ``dataset_id``'s rows followed by ``rows`` as ``new_id``.
+
+        Raises ``KeyError`` if ``dataset_id`` is unknown and ``ValueError`` if
+        ``rows`` doesn't have its columns.
+        """
+        df = self.get(dataset_id)
+        if list(rows.columns) != list(df.columns):
+            raise ValueError(f"Appended rows must have the columns {[str(c) for c in df.columns]}")
+        # Categoricals get the union of their levels, existing ones first, so
+        # they stay categorical instead of falling back to object columns
+        levels = {}
+        for name in df.columns:
+            if isinstance(df[name].dtype, pd.CategoricalDtype) and isinstance(rows[name].dtype, pd.CategoricalDtype):
+                known = df[name].cat.categories
+                levels[name] = known.append(rows[name].cat.categories.difference(known))
+        df = df.assign(**{name: df[name].cat.set_categories(values) for name, values in levels.items()})
+        rows = rows.assign(**{name: rows[name].cat.set_categories(values) for name, values in levels.items()})
+        # Appended rows keep counting up from the existing row labels
+        combined = pd.concat([df, rows], ignore_index=True)
+        with self._lock:
+            self._parents[new_id] = dataset_id
+            self.put(new_id, combined)
+        return self.get(new_id)
+
+    def lineage(self, dataset_id: str):
+        """``dataset_id``, then the datasets it was appended to, newest first."""
+        with self._lock:
+            chain = []
+            while dataset_id is not None and dataset_id not in chain:
+                chain.append(dataset_id)
+                dataset_id = self._parents.get(dataset_id)
+        return chain
+
+    def get(self, dataset_id: str) -> pd.DataFrame:
+        """Return the DataFrame for ``dataset_id``; raises ``KeyError`` if unknown."""
+        return self._entry(dataset_id).df
+
+    def design(self, dataset_id: str, confounders: list, scale_features: bool):
+        """Encoded (and optionally scaled) confounder matrix, computed once per spec."""
+        with self._lock:
+            entry = self._entry(dataset_id)
+            key = (tuple(confounders), bool(scale_features))
+            X = entry.designs.get(key)
+            if X is None:
+                X = encode_confounders(entry.df, confounders, scale_features)
+                # Shared between requests, so nobody may modify it in place
+                freeze_design(X)
+                entry.designs[key] = X
+                nbytes = design_nbytes(X)
+                entry.nbytes += nbytes
+                self._nbytes += nbytes
+                self._evict()
+            return X
+
+    def share(self, dataset_id: str) -> None:
+        """Write ``dataset_id`` to ``share_dir`` as Parquet, once; raises ``KeyError`` if unknown."""
+        path = self._share_path(dataset_id)
+        if os.path.exists(path):
+            return
+        df = self.get(dataset_id)
+        os.makedirs(self.share_dir, exist_ok=True)
+        # Written aside and renamed, so a worker never reads a partial file
+        partial = f"{path}.{uuid.uuid4().hex}.tmp"
+        df.to_parquet(partial)
+        os.replace(partial, path)
+
+    def delete(self, dataset_id: str) -> None:
+        with self._lock:
+            entry = self._entries.pop(dataset_id, None)
+            self._parents.pop(dataset_id, None)
+            if entry is not None:
+                self._nbytes -= entry.nbytes
+            path = self._spill_path(dataset_id)
+            if entry is None and not os.path.exists(path):
+                raise KeyError(dataset_id)
+            for path in (path, self._share_path(dataset_id)):
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+    def _entry(self, dataset_id: str) -> _Entry:
+        with self._lock:
+            entry = self._entries.get(dataset_id)
+            if entry is not None:
+                self._entries.move_to_end(dataset_id)
+                return entry
+            path = self._spill_path(dataset_id)
+            if not os.path.exists(path):
+                raise KeyError(dataset_id)
+            self.put(dataset_id, pd.read_parquet(path))
+            return self._entries[dataset_id]
+
+    def _evict(self) -> None:
+        # Never evict the most recently used entry, even if it alone is over budget
+        while self._nbytes > self.max_bytes and len(self._entries) > 1:
+            dataset_id, entry = self._entries.popitem(last=False)
+            self._nbytes -= entry.nbytes
+            path = self._spill_path(dataset_id)
+            if path and not os.path.exists(path):
+                entry.df.to_parquet(path)
+
+    def _spill_path(self, dataset_id: str) -> str:
+        if not is_dataset_id(dataset_id):
+            raise KeyError(dataset_id)
+        if not self.spill_dir:
+            return ""
+        return os.path.join(self.spill_dir, f"{dataset_id}.parquet")
+
+    def _share_path(self, dataset_id: str) -> str:
+        if not is_dataset_id(dataset_id):
+            raise KeyError(dataset_id)
+        if not self.share_dir:
+            return ""
+        return os.path.join(self.share_dir, f"{dataset_id}.parquet")
+
+store = DatasetStore(
+    max_bytes=int(os.environ.get("DATASET_CACHE_BYTES", 1 << 30)),
+    spill_dir=os.environ.get("DATASET_SPILL_DIR") or None,
+    share_dir=os.environ.get("DATASET_SHARE_DIR") or os.path.join(tempfile.gettempdir(), "causal_datasets"),
+)
@@ -1,58 +1,232 @@
+from typing import Callable
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed, effective_n_jobs
+from threadpoolctl import threadpool_limits
 from sklearn.model_selection import KFold
-from sklearn.linear_model import LassoCV, LogisticRegression
-from sklearn.ensemble import RandomForestRegressor
-from api.schemas import DMLResponse, PlotData
-from sklearn.preprocessing import StandardScaler
+from sklearn.linear_model import LassoCV
+from api.schemas import CATESummary, DMLResponse
+from core.preprocessing import ConfounderEncoder, compact_frame, to_dense
+from core.plots import histogram_plot, residual_summary
+from core.inference import median_aggregate, residual_std_error
+from core.cate import effect_models, fit_effect_model
+from core.learners import OUTCOME, TREATMENT, resolve_learner
+from core.metrics import lap
+from core.model_cache import models
+
+CATE_QUANTILES = (10, 25, 50, 75, 90)
+
+def _fit_nuisance(learner, X, y, folds, random_state, n_threads):
+    """Fit a nuisance learner on each training fold and predict its held-out fold.
+
+    A warm-starting learner keeps one estimator across ``folds``, so each fit
+    starts from the previous fold's solution.
+    """
+    model = None
+    predictions = []
+    rows = (lambda idx: X[idx]) if learner.accepts_sparse else (lambda idx: to_dense(X[idx]))
+    with threadpool_limits(limits=n_threads):
+        for train_idx, test_idx in folds:
+            if model is None or not learner.warm_start:
+                model = learner.build(random_state, n_threads)
+            model.fit(rows(train_idx), y[train_idx])
+            predictions.append(learner.predict(model, rows(test_idx)))
+    return predictions
+
+def _cross_fit(X, treatment, outcomes, learners, n_splits, n_repeats, random_state, n_jobs, progress):
+    """Out-of-fold nuisance predictions, one ``{role: predictions}`` dict per split."""
+    # Split r of n_repeats shuffles with random_state + r, so the first split
+    # is the one a single-split run uses.
+    splits = [
+        list(KFold(n_splits=n_splits, shuffle=True, random_state=random_state + repeat).split(X))
+        for repeat in range(n_repeats)
+    ]
+    targets = {TREATMENT: treatment, OUTCOME: outcomes}
+
+    # A split's out-of-fold predictions are cached, so only splits never fitted
+    # on this data with these learners before need any model fitting.
+    cache_keys = [
+        models.key(
+            "dml_nuisance", X, treatment, outcomes, n_splits, random_state, repeat,
+            learners[TREATMENT].name, learners[OUTCOME].name
+        )
+        for repeat in range(n_repeats)
+    ]
+    cached = [models.get(key) for key in cache_keys]
+
+    # Every (split, fold, nuisance model) triple is an independent task, except
+    # that a warm-starting learner takes all folds of a split as one task.
+    # Workers read X through a read-only memmap instead of receiving a pickled
+    # copy, and a learner without its own thread budget gets an even share of
+    # the cores left over. Seeds don't depend on n_jobs, so the estimates are
+    # identical for any degree of parallelism.
+    tasks = []
+    for repeat, hit in enumerate(cached):
+        if hit is not None:
+            continue
+        for role, learner in learners.items():
+            groups = [range(n_splits)] if learner.warm_start else [[fold] for fold in range(n_splits)]
+            tasks.extend((repeat, role, list(group)) for group in groups)
+    shared_threads = max(1, effective_n_jobs(n_jobs) // max(1, len(tasks)))
+    fitted = Parallel(n_jobs=n_jobs, max_nbytes="1M", mmap_mode="r", return_as="generator")(
+        delayed(_fit_nuisance)(
+            learners[role], X, targets[role], [splits[repeat][fold] for fold in group],
+            random_state, learners[role].threads or shared_threads
+        )
+        for repeat, role, group in tasks
+    )
+
+    predictions = []
+    for repeat, hit in enumerate(cached):
+        if hit is not None:
+            predictions.append(dict(zip((TREATMENT, OUTCOME), hit)))
+            if progress is not None:
+                progress({"stage": "cross_fitting", "repeat": repeat + 1, "n_repeats": n_repeats, "cached": True})
+        else:
+            predictions.append({role: np.zeros(len(treatment)) for role in learners})
+
+    # A fold is done once both of its nuisance models are
+    pending = {}
+    folds_done = [0] * n_repeats
+    for (repeat, role, group), fold_predictions in zip(tasks, fitted):
+        for fold, prediction in zip(group, fold_predictions):
+            predictions[repeat][role][splits[repeat][fold][1]] = prediction
+            pending[repeat, fold] = pending.get((repeat, fold), len(learners)) - 1
+            if pending[repeat, fold] == 0:
+                folds_done[repeat] += 1
+                if progress is not None:
+                    progress({"stage": "cross_fitting", "fold": folds_done[repeat], "n_folds": n_splits,
+                              "repeat": repeat + 1, "n_repeats": n_repeats})
+    for repeat, hit in enumerate(cached):
+        if hit is None:
+            models.put(cache_keys[repeat], (predictions[repeat][TREATMENT], predictions[repeat][OUTCOME]))
+    return predictions
+
+def arm_outcome_predictions(X, treatment, outcomes, outcome_learner, n_splits, random_state, n_jobs=1) -> tuple:
+    """Cross-fitted outcome predictions under control and under treatment, ``(mu0, mu1)``.
+
+    On DML's first split, each fold is predicted by models of ``outcome_learner``
+    fitted on the other folds' control and treated rows respectively. Cached
+    like the nuisance predictions.
+    """
+    learner = resolve_learner(OUTCOME, outcome_learner, len(treatment))
+    cache_key = models.key("arm_outcomes", X, treatment, outcomes, n_splits, random_state, learner.name)
+    cached = models.get(cache_key)
+    if cached is not None:
+        return cached
+    splits = list(KFold(n_splits=n_splits, shuffle=True, random_state=random_state).split(X))
+    n_threads = learner.threads or max(1, effective_n_jobs(n_jobs) // 2)
+    fitted = Parallel(n_jobs=n_jobs, max_nbytes="1M", mmap_mode="r")(
+        delayed(_fit_nuisance)(
+            learner, X, outcomes, [(train_idx[arm[train_idx]], test_idx) for train_idx, test_idx in splits],
+            random_state, n_threads
+        )
+        for arm in (treatment == 0, treatment == 1)
+    )
+    predictions = []
+    for fold_predictions in fitted:
+        values = np.zeros(len(treatment))
+        for (_, test_idx), prediction in zip(splits, fold_predictions):
+            values[test_idx] = prediction
+        predictions.append(values)
+    models.put(cache_key, tuple(predictions))
+    return tuple(predictions)
 
 def dml(
-    data: list,
+    data: list | pd.DataFrame,
     treatment_col: str,
     outcome_col: str,
     confounders: list,
     n_splits: int = 2,
     random_state: int = 42,
-    scale_features: bool = True
+    scale_features: bool = True,
+    design=None,
+    n_jobs: int = 1,
+    progress: Callable[[dict], None] | None = None,
+    include_residuals: bool = False,
+    tables: dict | None = None,
+    plot_mode: str = "binned",
+    n_repeats: int = 1,
+    confidence_level: float = 0.95,
+    treatment_learner: str = "logistic",
+    outcome_learner: str = "random_forest",
+    cate: bool = False,
+    nuisance_predictions: list | None = None
 ) -> DMLResponse:
-    df = pd.DataFrame(data)
-    X = pd.get_dummies(df[confounders], drop_first=True)
-    if scale_features:
-        scaler = StandardScaler()
-        X = pd.DataFrame(scaler.fit_transform(X), columns=X.columns)
+    """Double machine learning with cross-fitted nuisance models.
+
+    The per-row residuals are only inlined in ``linear_regression_plot`` when
+    ``include_residuals`` is set. If a ``tables`` dict is passed, they are also
+    put there as a ``residuals`` DataFrame for the caller to serve separately.
+
+    With ``n_repeats`` > 1, cross-fitting is repeated on that many random
+    splits and the estimates are median-aggregated. Standard errors and
+    intervals are reported either way.
+
+    The nuisance models are picked by name from ``core.learners``;
+    ``"fast"`` chooses histogram gradient boosting on large inputs.
+
+    With ``cate``, a linear R-learner is also fitted on the first split's
+    residuals and persisted in ``core.cate.effect_models``; the response
+    summarizes the per-unit effects, and a ``tables`` dict gets them as a
+    ``cate`` DataFrame.
+
+    Precomputed ``nuisance_predictions``, a ``(treatment, outcome)`` pair of
+    out-of-fold prediction arrays per split, skip cross-fitting; the
+    confounders are then only encoded for ``cate``.
+    """
+    df = compact_frame(data, confounders)
+    encoder = ConfounderEncoder(confounders, scale_features)
+    X = design
+    if X is None and (nuisance_predictions is None or cate):
+        X = encoder.fit_transform(df)
+    lap("encode")
     treatment = df[treatment_col].values
     outcomes = df[outcome_col].values
-    kf = KFold(n_splits=n_splits, shuffle=True, random_state=random_state)
-    treatment_difference = np.zeros_like(treatment, dtype=float)
-    outcome_difference = np.zeros_like(outcomes, dtype=float)
-
-    for train_idx, test_idx in kf.split(X):
-        # Model for treatment
-        treatment_model = LogisticRegression(max_iter=1000)
-        treatment_model.fit(X.iloc[train_idx], treatment[train_idx])
-        treatment_model_prediction = treatment_model.predict_proba(X.iloc[test_idx])[:, 1]
 
-        # Model for outcome
-        outcome_model = RandomForestRegressor(random_state=random_state)
-        outcome_model.fit(X.iloc[train_idx], outcomes[train_idx])
-        outcome_model_prediction = outcome_model.predict(X.iloc[test_idx])
+    learners = {
+        TREATMENT: resolve_learner(TREATMENT, treatment_learner, len(df)),
+        OUTCOME: resolve_learner(OUTCOME, outcome_learner, len(df)),
+    }
+    if nuisance_predictions is None:
+        predictions = _cross_fit(
+            X, treatment, outcomes, learners, n_splits, n_repeats, random_state, n_jobs, progress
+        )
+    else:
+        predictions = [dict(zip((TREATMENT, OUTCOME), split)) for split in nuisance_predictions]
+        n_repeats = len(predictions)
+    lap("cross_fitting")
 
+    estimates = {"ate": [], "att": []}
+    std_errors = {"ate": [], "att": []}
+    mask = (treatment == 1)
+    for repeat in range(n_repeats):
         # Residuals
-        treatment_difference[test_idx] = treatment[test_idx] - treatment_model_prediction
-        outcome_difference[test_idx] = outcomes[test_idx] - outcome_model_prediction
+        treatment_difference = treatment - predictions[repeat][TREATMENT]
+        outcome_difference = outcomes - predictions[repeat][OUTCOME]
 
-    final_model = LassoCV(cv=3, random_state=random_state)
-    final_model.fit(treatment_difference.reshape(-1, 1), outcome_difference)
-    ate = final_model.coef_[0]
-    
-    mask = (treatment == 1)
-    att_final_model = LassoCV(cv=3, random_state=random_state)
-    att_final_model.fit(treatment_difference[mask].reshape(-1, 1), outcome_difference[mask])
-    att = att_final_model.coef_[0]
+        for name, rows in (("ate", slice(None)), ("att", mask)):
+            final_model = LassoCV(cv=3, random_state=random_state)
+            final_model.fit(treatment_difference[rows].reshape(-1, 1), outcome_difference[rows])
+            estimates[name].append(final_model.coef_[0])
+            std_errors[name].append(residual_std_error(
+                treatment_difference[rows], outcome_difference[rows], final_model.coef_[0], final_model.intercept_
+            ))
+            if repeat == 0 and name == "ate":
+                # The first split's residuals and fit are the ones plotted and stored
+                plotted = (treatment_difference, outcome_difference, final_model)
+        lap("final_stage")
 
-    outcome_plot = PlotData(
-        treated_values=outcomes[treatment == 1].tolist(),
-        control_values=outcomes[treatment == 0].tolist(),
+    inference = {name: median_aggregate(estimates[name], std_errors[name], confidence_level) for name in estimates}
+    ate = inference["ate"].estimate
+    att = inference["att"].estimate
+    treatment_difference, outcome_difference, final_model = plotted
+
+    outcome_plot = histogram_plot(
+        outcomes[treatment == 1],
+        outcomes[treatment == 0],
+        bins=20,
+        plot_mode=plot_mode,
         title="Outcome Distribution by Treatment Group",
         xlabel="Outcome",
         ylabel="Count",
@@ -60,16 +234,46 @@ def dml(
     )
 
     linear_regression_plot = {
-        "treatment_residuals": treatment_difference.tolist(),
-        "outcome_residuals": outcome_difference.tolist(),
         "intercept": float(final_model.intercept_),
-        "coef": float(final_model.coef_[0])
+        "coef": float(final_model.coef_[0]),
+        **residual_summary(treatment_difference, outcome_difference, random_state)
     }
+    if include_residuals:
+        linear_regression_plot["treatment_residuals"] = treatment_difference.tolist()
+        linear_regression_plot["outcome_residuals"] = outcome_difference.tolist()
+    if tables is not None:
+        tables["residuals"] = pd.DataFrame({
+            "treatment_residuals": treatment_difference,
+            "outcome_residuals": outcome_difference
+        })
+    lap("plots")
+
+    cate_summary = None
+    if cate:
+        if design is not None:
+            # The precomputed design came from the same encoding of this frame
+            encoder.fit(df)
+        effect_model = fit_effect_model(X, treatment_difference, outcome_difference, encoder)
+        unit_effects = effect_model.effects(X)
+        cate_summary = CATESummary(
+            model_id=effect_models.put(effect_model),
+            mean=float(unit_effects.mean()),
+            std=float(unit_effects.std()),
+            quantiles={f"p{q}": float(v) for q, v in zip(CATE_QUANTILES, np.percentile(unit_effects, CATE_QUANTILES))}
+        )
+        if tables is not None:
+            tables["cate"] = pd.DataFrame({"cate": unit_effects})
+        lap("cate")
 
-    return DMLResponse(
+    response = DMLResponse(
         att=att,
         ate=ate,
         message="DML analysis complete.",
         outcome_plot=outcome_plot,
-        linear_regression_plot=linear_regression_plot
-    )
\ No newline at end of file
+        linear_regression_plot=linear_regression_plot,
+        inference=inference,
+        learners={role: learner.name for role, learner in learners.items()},
+        cate=cate_summary
+    )
+    lap("build_response")
+    return response
\ No newline at end of file
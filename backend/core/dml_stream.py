@@ -0,0 +1,304 @@
+import os
+from typing import Callable
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from scipy.special import expit
+from api.schemas import DMLResponse, PlotData
+from core.inference import median_aggregate
+from core.plots import residual_summary, RESIDUAL_SAMPLE_POINTS
+from core.metrics import lap
+
+SOURCE_ROOT = os.environ.get("DML_SOURCE_ROOT") or None
+
+# Penalties of the streamed nuisance models, those of the in-memory "ridge"
+# outcome learner and "logistic" treatment learner (Ridge() and
+# LogisticRegression(), i.e. alpha = 1 and C = 1), intercepts unpenalized
+OUTCOME_ALPHA = 1.0
+TREATMENT_ALPHA = 1.0
+# Newton steps on the propensity model stop once no coefficient moves more than this
+NEWTON_TOL = 1e-6
+
+def resolve_source(path: str) -> str:
+    """Absolute path of a server-side source file, which must live under ``DML_SOURCE_ROOT``.
+
+    Raises ``PermissionError`` when streaming sources are disabled or the path
+    escapes the root, and ``FileNotFoundError`` when it doesn't exist.
+    """
+    if SOURCE_ROOT is None:
+        raise PermissionError("Streaming sources are disabled; set DML_SOURCE_ROOT to enable them")
+    root = os.path.realpath(SOURCE_ROOT)
+    full = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full]) != root:
+        raise PermissionError(f"'{path}' is outside the source root")
+    if not os.path.isfile(full):
+        raise FileNotFoundError(f"No such source file: '{path}'")
+    return full
+
+def iter_chunks(path: str, columns: list, chunk_rows: int):
+    """Yield DataFrames of at most ``chunk_rows`` rows from a Parquet or CSV file."""
+    if path.endswith(".parquet"):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_rows)
+
+class _Encoder:
+    """Chunk-wise equivalent of ``pd.get_dummies(drop_first=True)`` plus ``StandardScaler``.
+
+    The category vocabulary and the scaling moments are fixed before the first
+    chunk is encoded; levels outside the vocabulary encode as all zeros.
+    """
+
+    def __init__(self, numeric: list, vocabulary: dict, mean=None, scale=None):
+        self.numeric = numeric
+        self.vocabulary = vocabulary
+        self.mean = mean
+        self.scale = scale
+
+    def transform(self, chunk: pd.DataFrame) -> np.ndarray:
+        parts = [chunk[self.numeric].to_numpy(dtype=float)]
+        for col, levels in self.vocabulary.items():
+            codes = pd.Categorical(chunk[col], categories=levels).codes
+            parts.append((codes[:, None] == np.arange(1, len(levels))[None, :]).astype(float))
+        X = np.hstack(parts)
+        if self.mean is not None:
+            X = (X - self.mean) / self.scale
+        return X
+
+def _chunk_rng(random_state: int, stream: int, chunk: int) -> np.random.Generator:
+    # Independent, reproducible randomness per (purpose, chunk) without per-row state
+    return np.random.default_rng([int(random_state), stream, chunk])
+
+# Residual moments: n, Σv, Σu, Σv², Σvu, Σv³, Σv⁴, Σv²u, Σv³u, Σv²u²
+def _moments(v: np.ndarray, u: np.ndarray) -> np.ndarray:
+    v2 = v * v
+    return np.array([len(v), v.sum(), u.sum(), v2.sum(), (v * u).sum(),
+                     (v2 * v).sum(), (v2 * v2).sum(), (v2 * u).sum(), (v2 * v * u).sum(), (v2 * u * u).sum()])
+
+def _ols_from_moments(m: np.ndarray):
+    """Slope, intercept and robust slope SE of ``u ~ 1 + v`` from streamed moments.
+
+    The SE is the same sandwich as ``residual_std_error``, with Σv²ε² expanded
+    in terms of the moments.
+    """
+    n, sv, su, svv, svu, sv3, sv4, svvu, sv3u, svvuu = m
+    coef = (n * svu - sv * su) / (n * svv - sv ** 2)
+    intercept = (su - coef * sv) / n
+    sum_v2_eps2 = (svvuu + intercept ** 2 * svv + coef ** 2 * sv4
+                   - 2 * intercept * svvu - 2 * coef * sv3u + 2 * intercept * coef * sv3)
+    std_error = np.sqrt(max(sum_v2_eps2, 0.0) / n / (svv / n) ** 2 / n)
+    return coef, intercept, std_error
+
+def _with_intercept(X: np.ndarray) -> np.ndarray:
+    return np.hstack([np.ones((len(X), 1)), X])
+
+def _penalty(width: int, alpha: float) -> np.ndarray:
+    penalty = np.full(width, alpha)
+    penalty[0] = 0.0
+    return np.diag(penalty)
+
+def dml_streaming(
+    source_path: str,
+    treatment_col: str,
+    outcome_col: str,
+    confounders: list,
+    n_splits: int = 5,
+    random_state: int = 42,
+    scale_features: bool = True,
+    chunk_rows: int = 100_000,
+    max_iter: int = 25,
+    categories: dict | None = None,
+    confidence_level: float = 0.95,
+    progress: Callable[[dict], None] | None = None,
+    tables: dict | None = None
+) -> DMLResponse:
+    """Out-of-core DML over a Parquet/CSV file, holding one chunk in memory at a time.
+
+    Pass 1 fixes the category vocabulary (unless ``categories`` is given) and the
+    scaling and outcome moments. Pass 2 fits one treatment and outcome model per
+    fold to convergence from streamed moment matrices: the outcome model is a
+    ridge regression, solved exactly from the Gram matrix of its first round,
+    and the treatment model an L2-penalized logistic regression, fitted by
+    Newton steps (IRLS), one round over the file each, until no coefficient
+    moves more than ``NEWTON_TOL`` or ``max_iter`` rounds have run. These are
+    the in-memory ``ridge`` and ``logistic`` learners, so ``check_against_dml``
+    can compare the two. Pass 3 predicts each row with its held-out fold's
+    models and reduces the residuals to the sufficient statistics of the final
+    regression. Fold labels are redrawn per chunk from seeded generators, so no
+    per-row state outlives its chunk.
+
+    The final stage is OLS with an intercept instead of ``LassoCV``, which needs
+    the residuals in memory. No row-level tables are produced, so ``tables`` is
+    left empty.
+    """
+    path = resolve_source(source_path)
+    columns = list(dict.fromkeys([*confounders, treatment_col, outcome_col]))
+
+    # Pass 1: vocabulary and moments
+    n = 0
+    numeric = level_counts = None
+    sums = sumsq = None
+    y_min, y_max = np.inf, -np.inf
+    for chunk in iter_chunks(path, columns, chunk_rows):
+        if numeric is None:
+            # Same split as pd.get_dummies: object/string/category columns are encoded
+            numeric = [c for c in confounders if pd.api.types.is_numeric_dtype(chunk[c]) or pd.api.types.is_bool_dtype(chunk[c])]
+            level_counts = {c: pd.Series(dtype=float) for c in confounders if c not in numeric}
+            sums = np.zeros(len(numeric))
+            sumsq = np.zeros(len(numeric))
+        for c in level_counts:
+            level_counts[c] = level_counts[c].add(chunk[c].value_counts(), fill_value=0)
+        values = chunk[numeric].to_numpy(dtype=float)
+        sums += values.sum(axis=0)
+        sumsq += (values ** 2).sum(axis=0)
+        y = chunk[outcome_col].to_numpy(dtype=float)
+        y_min, y_max = min(y_min, y.min()), max(y_max, y.max())
+        n += len(chunk)
+    if n == 0:
+        raise ValueError(f"Source '{source_path}' has no rows")
+
+    categories = categories or {}
+    vocabulary = {c: sorted(categories.get(c, counts.index.tolist())) for c, counts in level_counts.items()}
+    encoder = _Encoder(numeric, vocabulary)
+    if scale_features:
+        # A dummy's mean and second moment are both its level's share of rows
+        shares = [level_counts[c].reindex(levels[1:], fill_value=0).to_numpy() / n for c, levels in vocabulary.items()]
+        mean = np.concatenate([sums / n, *shares])
+        second = np.concatenate([sumsq / n, *shares])
+        scale = np.sqrt(np.maximum(second - mean ** 2, 0.0))
+        encoder.mean = mean
+        encoder.scale = np.where(scale == 0, 1.0, scale)
+    lap("scan")
+
+    # Pass 2: per fold, the outcome ridge from its training rows' Gram matrix
+    # and X'y, and Newton steps on the treatment model's penalized log-loss
+    # until they settle. Each round is one pass over the file.
+    width = len(encoder.numeric) + sum(max(len(levels) - 1, 0) for levels in vocabulary.values()) + 1
+    treatment_coef = np.zeros((n_splits, width))
+    outcome_coef = np.zeros((n_splits, width))
+    gram = np.zeros((n_splits, width, width))
+    moment = np.zeros((n_splits, width))
+    converged = False
+    n_iter = 0
+    while n_iter < max_iter and not converged:
+        hessian = np.zeros((n_splits, width, width))
+        gradient = np.zeros((n_splits, width))
+        for i, chunk in enumerate(iter_chunks(path, columns, chunk_rows)):
+            Z = _with_intercept(encoder.transform(chunk))
+            t = chunk[treatment_col].to_numpy(dtype=float)
+            folds = _chunk_rng(random_state, 0, i).integers(n_splits, size=len(chunk))
+            p = expit(Z @ treatment_coef.T)
+            for k in range(n_splits):
+                train = folds != k
+                Z_train = Z[train]
+                p_train = p[train, k]
+                hessian[k] += Z_train.T @ (Z_train * (p_train * (1 - p_train))[:, None])
+                gradient[k] += Z_train.T @ (p_train - t[train])
+                if n_iter == 0:
+                    gram[k] += Z_train.T @ Z_train
+                    moment[k] += Z_train.T @ chunk[outcome_col].to_numpy(dtype=float)[train]
+            if progress is not None:
+                progress({"stage": "training", "iteration": n_iter + 1, "max_iter": max_iter, "chunk": i + 1})
+        if n_iter == 0:
+            outcome_penalty = _penalty(width, OUTCOME_ALPHA)
+            outcome_coef = np.stack([np.linalg.solve(gram[k] + outcome_penalty, moment[k]) for k in range(n_splits)])
+        treatment_penalty = _penalty(width, TREATMENT_ALPHA)
+        step = np.stack([
+            np.linalg.solve(hessian[k] + treatment_penalty, gradient[k] + treatment_penalty @ treatment_coef[k])
+            for k in range(n_splits)
+        ])
+        treatment_coef -= step
+        n_iter += 1
+        converged = np.abs(step).max() <= NEWTON_TOL
+
+    lap("training")
+
+    # Pass 3: held-out residuals, reduced to moments, histograms and a fixed-size sample
+    moments = {"ate": np.zeros(10), "att": np.zeros(10)}
+    edges = np.histogram_bin_edges([y_min, y_max], bins=20)
+    treated_counts = np.zeros(len(edges) - 1, dtype=int)
+    control_counts = np.zeros(len(edges) - 1, dtype=int)
+    sample_keys = sample_v = sample_u = np.empty(0)
+    v_min, v_max = np.inf, -np.inf
+    for i, chunk in enumerate(iter_chunks(path, columns, chunk_rows)):
+        Z = _with_intercept(encoder.transform(chunk))
+        t = chunk[treatment_col].to_numpy()
+        y = chunk[outcome_col].to_numpy(dtype=float)
+        folds = _chunk_rng(random_state, 0, i).integers(n_splits, size=len(chunk))
+        # Each row's predictions come from the models of its own (held-out) fold
+        t_hat = np.take_along_axis(expit(Z @ treatment_coef.T), folds[:, None], axis=1).ravel()
+        y_hat = np.take_along_axis(Z @ outcome_coef.T, folds[:, None], axis=1).ravel()
+        v = t - t_hat
+        u = y - y_hat
+        moments["ate"] += _moments(v, u)
+        moments["att"] += _moments(v[t == 1], u[t == 1])
+        treated_counts += np.histogram(y[t == 1], bins=edges)[0]
+        control_counts += np.histogram(y[t == 0], bins=edges)[0]
+        # Bottom-k sampling: keep the rows with the smallest random keys
+        sample_keys = np.concatenate([sample_keys, _chunk_rng(random_state, 1, i).random(len(chunk))])
+        sample_v = np.concatenate([sample_v, v])
+        sample_u = np.concatenate([sample_u, u])
+        if len(sample_keys) > RESIDUAL_SAMPLE_POINTS:
+            keep = np.argpartition(sample_keys, RESIDUAL_SAMPLE_POINTS)[:RESIDUAL_SAMPLE_POINTS]
+            sample_keys, sample_v, sample_u = sample_keys[keep], sample_v[keep], sample_u[keep]
+        v_min, v_max = min(v_min, v.min()), max(v_max, v.max())
+        if progress is not None:
+            progress({"stage": "residuals", "chunk": i + 1})
+
+    lap("residuals")
+
+    fits = {name: _ols_from_moments(m) for name, m in moments.items()}
+    inference = {name: median_aggregate([coef], [std_error], confidence_level) for name, (coef, _, std_error) in fits.items()}
+    coef, intercept, _ = fits["ate"]
+    summary = residual_summary(sample_v, sample_u, random_state)
+    summary["x_min"], summary["x_max"] = float(v_min), float(v_max)
+
+    return DMLResponse(
+        att=inference["att"].estimate,
+        ate=inference["ate"].estimate,
+        message=f"Streaming DML analysis complete ({n} rows)." if converged else
+                f"Streaming DML analysis complete ({n} rows); the propensity model had not converged "
+                f"after {max_iter} iterations.",
+        outcome_plot=PlotData(
+            bin_edges=edges.tolist(),
+            treated_counts=treated_counts.tolist(),
+            control_counts=control_counts.tolist(),
+            title="Outcome Distribution by Treatment Group",
+            xlabel="Outcome",
+            ylabel="Count",
+            legend_labels=["Treated", "Control"]
+        ),
+        linear_regression_plot={"intercept": float(intercept), "coef": float(coef), **summary},
+        inference=inference
+    )
+
+def check_against_dml(source_path: str, treatment_col: str, outcome_col: str, confounders: list, **kwargs) -> dict:
+    """Run ``dml_streaming`` and in-memory ``dml`` with the same nuisance models on one file.
+
+    The whole file is loaded for the in-memory run, so this is for checking the
+    streamed fit on files that fit in memory. Folds are drawn differently, so
+    the estimates agree up to cross-fitting noise: for each of ``ate`` and
+    ``att``, the result has both estimates and their difference in units of the
+    streamed standard error (``z``). Takes ``dml_streaming``'s keyword arguments.
+    """
+    from core.dml import dml
+    streamed = dml_streaming(source_path, treatment_col, outcome_col, confounders, **kwargs)
+    columns = list(dict.fromkeys([*confounders, treatment_col, outcome_col]))
+    df = pd.concat(iter_chunks(resolve_source(source_path), columns, kwargs.get("chunk_rows", 100_000)), ignore_index=True)
+    in_memory = dml(
+        df, treatment_col, outcome_col, confounders,
+        n_splits=kwargs.get("n_splits", 5), random_state=kwargs.get("random_state", 42),
+        scale_features=kwargs.get("scale_features", True), confidence_level=kwargs.get("confidence_level", 0.95),
+        treatment_learner="logistic", outcome_learner="ridge"
+    )
+    check = {}
+    for name in ("ate", "att"):
+        stream_estimate, memory_estimate = getattr(streamed, name), getattr(in_memory, name)
+        std_error = streamed.inference[name].std_error
+        check[name] = {
+            "streaming": stream_estimate,
+            "in_memory": memory_estimate,
+            "z": (stream_estimate - memory_estimate) / std_error if std_error else None,
+        }
+    return check
@@ -0,0 +1,277 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from joblib import Parallel, delayed, effective_n_jobs
+from threadpoolctl import threadpool_limits
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import KFold
+from api.schemas import DMLResponse, IncrementalInfo, PSMResponse
+from core.datasets import store
+from core.dml import dml
+from core.learners import OUTCOME, TREATMENT, resolve_learner
+from core.matching import extend_nearest, match
+from core.metrics import lap
+from core.preprocessing import ConfounderEncoder, compact_frame, freeze_design, to_dense
+from core.psm import psm
+
+# A model is refit once the rows appended since its fit pass this share of
+# the rows it was fitted on; until then it is extended as it is
+REFIT_FRACTION = float(os.environ.get("INCREMENTAL_REFIT_FRACTION", 0.1))
+
+# What a state depends on; runs differing only in other options share it
+_SPECS = {
+    "psm": ("treatment_col", "confounders", "scale_features", "random_state", "n_neighbors",
+            "use_caliper", "caliper", "matching_method"),
+    "dml": ("treatment_col", "outcome_col", "confounders", "scale_features", "n_splits", "random_state",
+            "n_repeats", "treatment_learner", "outcome_learner"),
+}
+
+class _PSMState:
+    """A frozen propensity model, the design, scores and matches of every row so far.
+
+    Appended rows are encoded and scored with the encoder and model as fitted
+    and added to the sorted score index; with ``nearest`` matching only the
+    queries they can affect are rematched (``core.matching.extend_nearest``).
+    """
+
+    def __init__(self, df: pd.DataFrame, kwargs: dict):
+        self.treatment_col = kwargs["treatment_col"]
+        self.n_neighbors = kwargs["n_neighbors"]
+        self.caliper = kwargs["caliper"] if kwargs["use_caliper"] else None
+        self.matching_method = kwargs["matching_method"]
+        self.encoder = ConfounderEncoder(kwargs["confounders"], kwargs["scale_features"])
+        self.X = self.encoder.fit_transform(df)
+        # Shared with the runs that read it, so nobody may modify it in place
+        freeze_design(self.X)
+        self.treatment = df[self.treatment_col].to_numpy()
+        # The same fit as core.psm.propensity_scores
+        self.model = LogisticRegression(random_state=int(kwargs["random_state"]), solver="lbfgs", max_iter=1000)
+        self.model.fit(self.X, self.treatment)
+        self.scores = self.model.predict_proba(self.X)[:, 1]
+        self.fit_rows = self.n_rows = len(df)
+        self.matches = self._match()
+        self.recomputed = len(self.scores)
+
+    def _match(self) -> dict:
+        treated, control = self.scores[self.treatment == 1], self.scores[self.treatment == 0]
+        return {
+            "att": match(treated, control, self.n_neighbors, self.caliper, self.matching_method),
+            "atc": match(control, treated, self.n_neighbors, self.caliper, self.matching_method),
+        }
+
+    @property
+    def rows_since_fit(self) -> int:
+        return self.n_rows - self.fit_rows
+
+    def design(self, df: pd.DataFrame):
+        """The kept design if it still has every column ``df`` encodes to, else ``None``."""
+        columns = ConfounderEncoder(self.encoder.confounders, self.encoder.scale_features).fit_columns(df)
+        return self.X if columns.feature_names() == self.encoder.feature_names() else None
+
+    def can_extend(self, df: pd.DataFrame) -> bool:
+        return self.n_rows <= len(df) and len(df) - self.fit_rows <= REFIT_FRACTION * self.fit_rows
+
+    def extend(self, df: pd.DataFrame) -> int:
+        """Add the rows of ``df`` past ``n_rows``; returns how many units were rematched."""
+        rows = df.iloc[self.n_rows:]
+        n_treated, n_control = (self.treatment == 1).sum(), (self.treatment == 0).sum()
+        self.treatment = np.concatenate([self.treatment, rows[self.treatment_col].to_numpy()])
+        X_new = self.encoder.transform(rows)
+        self.X = sparse.vstack([self.X, X_new], format="csr") if sparse.issparse(self.X) else np.vstack([self.X, X_new])
+        freeze_design(self.X)
+        self.scores = np.concatenate([self.scores, self.model.predict_proba(X_new)[:, 1]])
+        self.n_rows = len(df)
+        if self.matching_method != "nearest":
+            # Matching without replacement is a global assignment, so it starts over
+            self.matches = self._match()
+            return len(self.scores)
+        treated, control = self.scores[self.treatment == 1], self.scores[self.treatment == 0]
+        *att, n_att = extend_nearest(self.matches["att"], treated, control, n_treated, n_control,
+                                     self.n_neighbors, self.caliper)
+        *atc, n_atc = extend_nearest(self.matches["atc"], control, treated, n_control, n_treated,
+                                     self.n_neighbors, self.caliper)
+        self.matches = {"att": tuple(att), "atc": tuple(atc)}
+        return n_att + n_atc
+
+def _fit_fold(learner, X, y, train_idx, test_idx, random_state, n_threads):
+    """Fit a nuisance learner on one training fold; returns the model and its held-out predictions."""
+    rows = (lambda idx: X[idx]) if learner.accepts_sparse else (lambda idx: to_dense(X[idx]))
+    with threadpool_limits(limits=n_threads):
+        model = learner.build(random_state, n_threads)
+        model.fit(rows(train_idx), y[train_idx])
+        return model, learner.predict(model, rows(test_idx))
+
+class _DMLState:
+    """Fold assignments, fitted fold models and out-of-fold predictions for every split.
+
+    Appended rows all join the smallest fold of each split, whose models never
+    trained on them and so predict them out of fold as they are. Every other
+    fold's models are touched, as their training folds grew; each is refit
+    only once it has missed ``REFIT_FRACTION`` of its training rows, and then
+    re-predicts its own fold.
+    """
+
+    def __init__(self, df: pd.DataFrame, kwargs: dict):
+        self.treatment_col = kwargs["treatment_col"]
+        self.outcome_col = kwargs["outcome_col"]
+        self.n_splits = kwargs["n_splits"]
+        self.random_state = kwargs["random_state"]
+        self.n_jobs = kwargs["n_jobs"]
+        self.learner_names = {TREATMENT: kwargs["treatment_learner"], OUTCOME: kwargs["outcome_learner"]}
+        self.learners = self._resolve(len(df))
+        self.encoder = ConfounderEncoder(kwargs["confounders"], kwargs["scale_features"])
+        X = self.encoder.fit_transform(df)
+        # The same splits as core.dml, so a fresh state predicts what dml() does
+        self.folds = []
+        for repeat in range(kwargs["n_repeats"]):
+            folds = np.empty(len(df), dtype=np.int32)
+            kfold = KFold(n_splits=self.n_splits, shuffle=True, random_state=self.random_state + repeat)
+            for fold, (_, test_idx) in enumerate(kfold.split(X)):
+                folds[test_idx] = fold
+            self.folds.append(folds)
+        self.models = {}
+        self.predictions = [{role: np.zeros(len(df)) for role in self.learners} for _ in self.folds]
+        self.fit_rows, self.appended = {}, {}
+        self.n_rows = len(df)
+        self.recomputed = self._refit(df, X, [(r, f) for r in range(len(self.folds)) for f in range(self.n_splits)])
+
+    def _resolve(self, n_rows: int) -> dict:
+        return {role: resolve_learner(role, name, n_rows) for role, name in self.learner_names.items()}
+
+    def _refit(self, df: pd.DataFrame, X, folds: list) -> int:
+        targets = {TREATMENT: df[self.treatment_col].to_numpy(), OUTCOME: df[self.outcome_col].to_numpy()}
+        tasks = [(repeat, role, fold) for repeat, fold in folds for role in self.learners]
+        shared_threads = max(1, effective_n_jobs(self.n_jobs) // len(tasks))
+        fitted = Parallel(n_jobs=self.n_jobs, max_nbytes="1M", mmap_mode="r")(
+            delayed(_fit_fold)(
+                self.learners[role], X, targets[role],
+                np.flatnonzero(self.folds[repeat] != fold), np.flatnonzero(self.folds[repeat] == fold),
+                self.random_state, self.learners[role].threads or shared_threads
+            )
+            for repeat, role, fold in tasks
+        )
+        # Runs that already took these predictions keep reading the old arrays
+        self.predictions = [{role: values.copy() for role, values in split.items()} for split in self.predictions]
+        for (repeat, role, fold), (model, prediction) in zip(tasks, fitted):
+            self.models[repeat, role, fold] = model
+            self.predictions[repeat][role][self.folds[repeat] == fold] = prediction
+        for repeat, fold in folds:
+            self.fit_rows[repeat, fold] = int((self.folds[repeat] != fold).sum())
+            self.appended[repeat, fold] = 0
+        return len(tasks)
+
+    @property
+    def rows_since_fit(self) -> int:
+        return max(self.appended.values(), default=0)
+
+    def can_extend(self, df: pd.DataFrame) -> bool:
+        # "fast" may pick other learners once the data has grown
+        resolved = self._resolve(len(df))
+        return self.n_rows <= len(df) and all(resolved[role] is self.learners[role] for role in resolved)
+
+    def extend(self, df: pd.DataFrame) -> int:
+        """Add the rows of ``df`` past ``n_rows``; returns how many fold models were refit."""
+        rows = df.iloc[self.n_rows:]
+        X_new = self.encoder.transform(rows)
+        touched = []
+        for repeat, folds in enumerate(self.folds):
+            fold = int(np.argmin(np.bincount(folds, minlength=self.n_splits)))
+            self.folds[repeat] = np.concatenate([folds, np.full(len(rows), fold, dtype=folds.dtype)])
+            for role, learner in self.learners.items():
+                prediction = learner.predict(
+                    self.models[repeat, role, fold], X_new if learner.accepts_sparse else to_dense(X_new)
+                )
+                self.predictions[repeat][role] = np.concatenate([self.predictions[repeat][role], prediction])
+            for other in range(self.n_splits):
+                if other == fold:
+                    continue
+                self.appended[repeat, other] += len(rows)
+                if self.appended[repeat, other] > REFIT_FRACTION * self.fit_rows[repeat, other]:
+                    touched.append((repeat, other))
+        self.n_rows = len(df)
+        if not touched:
+            return 0
+        return self._refit(df, self.encoder.transform(df), touched)
+
+class IncrementalStates:
+    """LRU of the states incremental runs continue from, one per dataset and
+    specification.
+
+    A run takes the state kept for its dataset or the nearest dataset it was
+    appended to, extends it and puts it back under its own dataset, so two
+    runs never extend the same state at once; a run that finds none starts a
+    new one.
+    """
+
+    def __init__(self, max_states: int = 8):
+        self.max_states = max_states
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, dataset_id: str, spec: tuple) -> tuple:
+        """``(state, dataset_id it was kept for)``, or ``(None, None)``."""
+        with self._lock:
+            for candidate in store.lineage(dataset_id):
+                state = self._entries.pop((candidate, spec), None)
+                if state is not None:
+                    return state, candidate
+        return None, None
+
+    def put(self, dataset_id: str, spec: tuple, state) -> None:
+        with self._lock:
+            self._entries[dataset_id, spec] = state
+            self._entries.move_to_end((dataset_id, spec))
+            while len(self._entries) > self.max_states:
+                self._entries.popitem(last=False)
+
+states = IncrementalStates(max_states=int(os.environ.get("INCREMENTAL_STATE_CACHE_SIZE", 8)))
+
+def _resume(analysis: str, dataset_id: str, kwargs: dict, df: pd.DataFrame, state_type) -> tuple:
+    """The state for this run, extended to all of ``df``, and how it got there."""
+    spec = (analysis, *((name, repr(kwargs.get(name))) for name in _SPECS[analysis]))
+    state, base_id = states.take(dataset_id, spec)
+    if state is not None and state.can_extend(df):
+        rows_appended = len(df) - state.n_rows
+        recomputed = state.extend(df) if rows_appended else 0
+        info = IncrementalInfo(base_dataset_id=base_id, rows_appended=rows_appended, recomputed=recomputed)
+    else:
+        state = state_type(df, kwargs)
+        info = IncrementalInfo(recomputed=state.recomputed)
+    info.rows_since_fit = state.rows_since_fit
+    info.stale = info.rows_since_fit > 0
+    states.put(dataset_id, spec, state)
+    lap("incremental")
+    return state, info
+
+def psm_incremental(dataset_id: str, **kwargs) -> PSMResponse:
+    """``psm`` on registered dataset ``dataset_id``, continuing from an earlier
+    run's propensity model and matches (see ``_PSMState``).
+
+    The propensity model is refit, and everything rematched, once the rows
+    appended since its fit pass ``REFIT_FRACTION``. The kept design is reused,
+    so balance and bootstrap don't re-encode every row; appended rows with
+    categorical levels it lacks get a fresh encoding instead. Takes ``psm``'s
+    arguments.
+    """
+    df = compact_frame(kwargs["data"], kwargs["confounders"])
+    state, info = _resume("psm", dataset_id, kwargs, df, _PSMState)
+    response = psm(**{**kwargs, "data": df, "design": state.design(df), "propensity": state.scores,
+                      "matches": state.matches})
+    response.incremental = info
+    return response
+
+def dml_incremental(dataset_id: str, **kwargs) -> DMLResponse:
+    """``dml`` on registered dataset ``dataset_id``, continuing from an earlier
+    run's fold models (see ``_DMLState``); only the final stage is always redone.
+
+    Takes ``dml``'s arguments.
+    """
+    df = compact_frame(kwargs["data"], kwargs["confounders"])
+    state, info = _resume("dml", dataset_id, kwargs, df, _DMLState)
+    nuisance_predictions = [(split[TREATMENT], split[OUTCOME]) for split in state.predictions]
+    response = dml(**{**kwargs, "data": df, "nuisance_predictions": nuisance_predictions})
+    response.incremental = info
+    return response
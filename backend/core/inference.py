@@ -0,0 +1,67 @@
+import numpy as np
+from scipy.stats import norm
+from api.schemas import EffectInference
+
+def replicate_seeds(random_state: int, n: int) -> list:
+    """Independent per-replicate seeds derived from ``random_state``.
+
+    Each replicate gets its own seed up front, so results don't depend on how
+    replicates are spread over workers.
+    """
+    return [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(int(random_state)).spawn(n)]
+
+def percentile_interval(estimate, replicates, confidence_level: float) -> EffectInference:
+    """Bootstrap standard error and percentile interval; non-finite replicates are dropped."""
+    replicates = np.asarray(replicates, dtype=float)
+    replicates = replicates[np.isfinite(replicates)]
+    if len(replicates) < 2:
+        return EffectInference(estimate=float(estimate), n_replicates=len(replicates))
+    alpha = 1 - confidence_level
+    lower, upper = np.percentile(replicates, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+    return EffectInference(
+        estimate=float(estimate),
+        std_error=float(replicates.std(ddof=1)),
+        ci_lower=float(lower),
+        ci_upper=float(upper),
+        confidence_level=confidence_level,
+        n_replicates=len(replicates)
+    )
+
+def median_aggregate(estimates, std_errors, confidence_level: float) -> EffectInference:
+    """Combine repeated cross-fitting splits by the median (Chernozhukov et al., 2018).
+
+    The point estimate is the median over splits. Its variance is the median
+    of each split's variance plus that split's squared deviation from the
+    median estimate. The interval is normal-approximation.
+    """
+    estimates = np.asarray(estimates, dtype=float)
+    std_errors = np.asarray(std_errors, dtype=float)
+    estimate = np.median(estimates)
+    std_error = np.sqrt(np.median(std_errors ** 2 + (estimates - estimate) ** 2))
+    z = norm.ppf(0.5 + confidence_level / 2)
+    return EffectInference(
+        estimate=float(estimate),
+        std_error=float(std_error),
+        ci_lower=float(estimate - z * std_error),
+        ci_upper=float(estimate + z * std_error),
+        confidence_level=confidence_level,
+        n_replicates=len(estimates)
+    )
+
+def normal_interval(estimate, std_error, confidence_level: float) -> EffectInference:
+    """Normal-approximation interval from an analytic standard error."""
+    z = norm.ppf(0.5 + confidence_level / 2)
+    return EffectInference(
+        estimate=float(estimate),
+        std_error=float(std_error),
+        ci_lower=float(estimate - z * std_error),
+        ci_upper=float(estimate + z * std_error),
+        confidence_level=confidence_level,
+        n_replicates=1
+    )
+
+def residual_std_error(treatment_residuals, outcome_residuals, coef: float, intercept: float) -> float:
+    """Heteroskedasticity-robust standard error of the residual-on-residual slope."""
+    v = np.asarray(treatment_residuals, dtype=float)
+    eps = np.asarray(outcome_residuals, dtype=float) - intercept - coef * v
+    return float(np.sqrt(np.mean(v ** 2 * eps ** 2) / np.mean(v ** 2) ** 2 / len(v)))
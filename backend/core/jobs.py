@@ -0,0 +1,327 @@
+import atexit
+import logging
+import multiprocessing as mp
+import os
+import signal
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from multiprocessing.connection import wait
+from core.datasets import DatasetStore, store
+from core.results import results
+from core.metrics import observe_stages, run_instrumented, serialize
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = "queued", "running", "succeeded", "failed", "cancelled"
+
+# Budget for the datasets each worker keeps loaded between jobs
+WORKER_DATASET_BYTES = int(os.environ.get("JOB_WORKER_DATASET_BYTES", 512 << 20))
+
+class QueueFullError(Exception):
+    """Raised by ``JobManager.submit`` when the pending queue is at capacity."""
+
+def _run_job(job_id, kind, kwargs, options, events, datasets: DatasetStore):
+    """Run one analysis in a worker process and send its events back over ``events``.
+
+    Jobs on a registered dataset carry its ``dataset_id`` instead of the data,
+    and load it (and its design matrix) from the worker's own store.
+    """
+    from core.psm import psm
+    from core.dml import dml
+    from core.dml_stream import dml_streaming
+    fn = {"psm": psm, "dml": dml, "dml_stream": dml_streaming}[kind]
+    try:
+        dataset_id = kwargs.pop("dataset_id", None)
+        if dataset_id is not None:
+            kwargs["data"] = datasets.get(dataset_id)
+            kwargs["design"] = datasets.design(dataset_id, kwargs["confounders"], kwargs["scale_features"])
+        tables = {}
+        progress = lambda info: events.send(("progress", info))
+        result, timings = run_instrumented(fn, {**kwargs, "progress": progress, "tables": tables}, **options)
+        # The result's tables are stored under the job's ID once they reach the API process
+        result.result_id = job_id
+        # Serialized here, by the response model, so the API can return it as is
+        body = serialize(result, timings)
+        events.send(("done", (body, tables, timings.stages)))
+    except Exception as e:
+        events.send(("failed", f"{type(e).__name__}: {e}"))
+
+def _worker_main(tasks, events, warm: bool, share_dir: str | None):
+    """Worker-process loop: warm up if asked, then run the jobs sent over
+    ``tasks`` one at a time until it sends ``None`` or closes."""
+    if hasattr(os, "setpgrp"):
+        # Its own process group, so stopping it also stops joblib's workers
+        os.setpgrp()
+    if warm:
+        from core.warmup import warm_up
+        try:
+            warm_up()
+            events.send(("warm", None))
+        except Exception as e:
+            events.send(("warm", f"{type(e).__name__}: {e}"))
+    datasets = DatasetStore(max_bytes=WORKER_DATASET_BYTES, spill_dir=share_dir)
+    while True:
+        try:
+            task = tasks.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        _run_job(*task, events, datasets)
+
+def _kill(process) -> None:
+    """Terminate ``process`` and whatever else is left in its process group."""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except (AttributeError, ProcessLookupError, PermissionError):
+        if process.is_alive():
+            process.terminate()
+
+class _Worker:
+    __slots__ = ("process", "tasks", "events", "job", "warming", "warm")
+
+    def __init__(self, process, tasks, events, warming: bool):
+        self.process = process
+        self.tasks = tasks
+        self.events = events
+        self.job = None
+        self.warming = warming
+        self.warm = False
+
+class Job:
+    __slots__ = ("job_id", "kind", "status", "progress", "result", "error",
+                 "submitted_at", "started_at", "finished_at", "kwargs", "options", "worker")
+
+    def __init__(self, kind: str, kwargs: dict, options: dict):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = QUEUED
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.kwargs = kwargs
+        self.options = options
+        self.worker = None
+
+class JobManager:
+    """Runs PSM/DML analyses in a pool of worker processes, off the API's event loop.
+
+    At most ``max_workers`` jobs run at once and at most ``max_queued`` wait
+    behind them; further submissions are rejected with ``QueueFullError``.
+    Workers are started on demand (or ahead of time by ``start``) and reused
+    across jobs, so imports, warm-up and loaded datasets carry over. They are
+    not daemonic, so analyses inside them can use joblib's process pools. A
+    running job is cancelled by terminating its worker, which is replaced on
+    the next dispatch. The last ``max_finished`` finished jobs are kept for
+    status and result lookups.
+    """
+
+    def __init__(self, max_workers: int, max_queued: int, max_finished: int = 100, share_dir: str | None = None):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self.share_dir = share_dir
+        self._ctx = mp.get_context("spawn")
+        self._jobs = {}
+        self._pending = deque()
+        self._running = {}
+        self._finished = OrderedDict()
+        self._workers = []
+        self._lock = threading.RLock()
+        self._warmed = threading.Condition(self._lock)
+        self._listener = None
+        self._closed = False
+        self._exit_hook = False
+
+    def start(self, warm: bool = True, n_workers: int | None = None) -> None:
+        """Start ``n_workers`` workers (every one by default) now, each warming
+        up before it takes a job if ``warm``."""
+        target = self.max_workers if n_workers is None else min(n_workers, self.max_workers)
+        with self._lock:
+            while len(self._workers) < target and not self._closed:
+                self._spawn(warm)
+
+    def wait_warm(self, timeout: float) -> bool:
+        """Wait until every started worker has warmed up; returns whether they all did."""
+        with self._warmed:
+            return self._warmed.wait_for(lambda: not any(worker.warming for worker in self._workers), timeout)
+
+    def warm_workers(self) -> int:
+        with self._lock:
+            return sum(worker.warm for worker in self._workers)
+
+    def submit(self, kind: str, kwargs: dict, include_timings: bool = False, profile: bool = False) -> Job:
+        with self._lock:
+            if len(self._pending) >= self.max_queued and len(self._running) >= self.max_workers:
+                raise QueueFullError(f"{len(self._pending)} jobs already queued")
+            job = Job(kind, kwargs, {"include_timings": include_timings, "profile": profile})
+            self._jobs[job.job_id] = job
+            self._pending.append(job)
+            self._dispatch()
+            return job
+
+    def get(self, job_id: str) -> Job:
+        """Return the job for ``job_id``; raises ``KeyError`` if unknown."""
+        with self._lock:
+            return self._jobs[job_id]
+
+    def queue_position(self, job: Job) -> int | None:
+        with self._lock:
+            if job.status != QUEUED:
+                return None
+            return self._pending.index(job)
+
+    def cancel(self, job_id: str) -> Job:
+        with self._lock:
+            job = self._jobs[job_id]
+            if job.status == QUEUED:
+                self._pending.remove(job)
+            elif job.status == RUNNING:
+                self._stop(job.worker)
+            else:
+                return job
+            self._finish(job, CANCELLED)
+            self._dispatch()
+            return job
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._closed = True
+            for job in list(self._pending) + list(self._running.values()):
+                self.cancel(job.job_id)
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            try:
+                worker.tasks.send(None)
+            except OSError:
+                pass
+        for worker in workers:
+            worker.process.join(timeout=5)
+            _kill(worker.process)
+            worker.process.join()
+            worker.tasks.close()
+            worker.events.close()
+
+    def _spawn(self, warm: bool) -> _Worker:
+        task_recv, task_send = self._ctx.Pipe(duplex=False)
+        event_recv, event_send = self._ctx.Pipe(duplex=False)
+        process = self._ctx.Process(target=_worker_main, args=(task_recv, event_send, warm, self.share_dir),
+                                    name="job-worker")
+        process.start()
+        # Close our copies of the worker's ends so a dead worker shows up as EOF
+        task_recv.close()
+        event_send.close()
+        worker = _Worker(process, task_send, event_recv, warming=warm)
+        self._workers.append(worker)
+        if self._listener is None:
+            self._listener = threading.Thread(target=self._listen, name="job-listener", daemon=True)
+            self._listener.start()
+        if not self._exit_hook:
+            # Non-daemonic children are joined at exit, so idle ones must be told to stop first
+            atexit.register(self.shutdown)
+            self._exit_hook = True
+        return worker
+
+    def _stop(self, worker: _Worker) -> int | None:
+        """Terminate ``worker`` and drop it from the pool; returns its exit code."""
+        if worker in self._workers:
+            self._workers.remove(worker)
+        _kill(worker.process)
+        worker.process.join(timeout=5)
+        worker.tasks.close()
+        worker.events.close()
+        self._warmed.notify_all()
+        return worker.process.exitcode
+
+    def _dispatch(self) -> None:
+        while self._pending and not self._closed:
+            # A worker still warming up counts as idle; it takes the job once warm
+            worker = next((worker for worker in self._workers if worker.job is None), None)
+            if worker is None:
+                if len(self._workers) >= self.max_workers:
+                    return
+                worker = self._spawn(warm=False)
+            job = self._pending.popleft()
+            try:
+                worker.tasks.send((job.job_id, job.kind, job.kwargs, job.options))
+            except OSError:
+                self._stop(worker)
+                self._pending.appendleft(job)
+                continue
+            worker.job = job
+            job.worker = worker
+            job.kwargs = None
+            job.status = RUNNING
+            job.started_at = time.time()
+            self._running[job.job_id] = job
+
+    def _finish(self, job: Job, status: str, result=None, error=None) -> None:
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        job.kwargs = None
+        self._running.pop(job.job_id, None)
+        if job.worker is not None:
+            job.worker.job = None
+            job.worker = None
+        self._finished[job.job_id] = job
+        while len(self._finished) > self.max_finished:
+            old_id, _ = self._finished.popitem(last=False)
+            del self._jobs[old_id]
+
+    def _listen(self) -> None:
+        while True:
+            with self._lock:
+                conns = {worker.events: worker for worker in self._workers}
+            if not conns:
+                time.sleep(0.1)
+                continue
+            try:
+                ready = wait(list(conns), timeout=0.1)
+            except OSError:
+                # A pipe was closed by a concurrent cancel; rebuild the set
+                continue
+            for conn in ready:
+                worker = conns[conn]
+                try:
+                    event, payload = conn.recv()
+                except (EOFError, OSError):
+                    event, payload = None, None
+                with self._lock:
+                    # Stopped by a cancel while we were reading
+                    if worker not in self._workers:
+                        continue
+                    job = worker.job
+                    if event == "warm":
+                        if payload is not None:
+                            logger.warning("Job worker warm-up failed: %s", payload)
+                        worker.warming = False
+                        worker.warm = payload is None
+                        self._warmed.notify_all()
+                        continue
+                    if event is None:
+                        exitcode = self._stop(worker)
+                        if job is not None:
+                            self._finish(job, FAILED, error=f"Worker exited with code {exitcode}")
+                    elif event == "progress":
+                        job.progress = payload
+                    elif event == "done":
+                        result, tables, stages = payload
+                        results.put(tables, result_id=job.job_id)
+                        observe_stages(job.kind, stages)
+                        self._finish(job, SUCCEEDED, result=result)
+                    elif event == "failed":
+                        self._finish(job, FAILED, error=payload)
+                    self._dispatch()
+
+jobs = JobManager(
+    max_workers=int(os.environ.get("JOB_MAX_WORKERS", os.cpu_count() or 1)),
+    max_queued=int(os.environ.get("JOB_MAX_QUEUED", 16)),
+    share_dir=store.share_dir,
+)
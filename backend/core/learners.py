@@ -0,0 +1,101 @@
+import importlib
+import os
+from typing import Callable
+from sklearn.ensemble import HistGradientBoostingClassifier, HistGradientBoostingRegressor, RandomForestRegressor
+from sklearn.linear_model import LogisticRegression, Ridge
+
+TREATMENT, OUTCOME = "treatment", "outcome"
+DEFAULT_LEARNERS = {TREATMENT: "logistic", OUTCOME: "random_forest"}
+
+# "fast" resolves to the histogram-based learners from this many rows up, and
+# to the defaults below it
+FAST_PROFILE = "fast"
+FAST_PROFILE_MIN_ROWS = int(os.environ.get("DML_FAST_PROFILE_ROWS", 50_000))
+FAST_LEARNERS = {TREATMENT: "hist_gradient_boosting", OUTCOME: "hist_gradient_boosting"}
+
+class Learner:
+    """A nuisance model for one DML role.
+
+    ``factory(random_state, n_threads)`` returns an unfitted estimator.
+    ``threads`` caps the threads one fit may use; ``None`` gives it an even
+    share of the cores left over after ``n_jobs``. A ``warm_start`` learner
+    has all folds of a split fitted in order on one estimator, each fit
+    starting from the previous fold's solution. A learner that can't take
+    sparse input (``accepts_sparse=False``) is given each fold densified.
+    """
+
+    def __init__(
+        self, name: str, role: str, factory: Callable, threads: int | None = None,
+        warm_start: bool = False, accepts_sparse: bool = True
+    ):
+        self.name = name
+        self.role = role
+        self.factory = factory
+        self.threads = threads
+        self.warm_start = warm_start
+        self.accepts_sparse = accepts_sparse
+
+    def build(self, random_state: int, n_threads: int):
+        return self.factory(random_state, n_threads)
+
+    def predict(self, model, X):
+        # The treatment model's prediction is the propensity score
+        if self.role == TREATMENT:
+            return model.predict_proba(X)[:, 1]
+        return model.predict(X)
+
+_registry = {TREATMENT: {}, OUTCOME: {}}
+
+def register_learner(
+    name: str, role: str, factory: Callable, threads: int | None = None,
+    warm_start: bool = False, accepts_sparse: bool = True
+) -> None:
+    """Make an estimator selectable as ``treatment_learner``/``outcome_learner``.
+
+    Modules listed in ``DML_LEARNER_PLUGINS`` are imported at startup (also in
+    job and joblib worker processes) and can call this to add their own.
+    """
+    if role not in _registry:
+        raise ValueError(f"role must be '{TREATMENT}' or '{OUTCOME}'")
+    if name == FAST_PROFILE:
+        raise ValueError(f"'{FAST_PROFILE}' is reserved for the automatic profile")
+    _registry[role][name] = Learner(name, role, factory, threads, warm_start, accepts_sparse)
+
+def learner_names(role: str) -> list:
+    return [FAST_PROFILE, *_registry[role]]
+
+def resolve_learner(role: str, name: str, n_rows: int) -> Learner:
+    """The learner called ``name``, with ``fast`` picked by row count; raises
+    ``ValueError`` for unknown names."""
+    if name == FAST_PROFILE:
+        name = FAST_LEARNERS[role] if n_rows >= FAST_PROFILE_MIN_ROWS else DEFAULT_LEARNERS[role]
+    try:
+        return _registry[role][name]
+    except KeyError:
+        raise ValueError(f"Unknown {role} learner '{name}'; choose from {learner_names(role)}")
+
+register_learner("logistic", TREATMENT, lambda random_state, n_threads: LogisticRegression(max_iter=1000))
+register_learner(
+    "logistic_warm", TREATMENT,
+    lambda random_state, n_threads: LogisticRegression(max_iter=1000, warm_start=True),
+    warm_start=True
+)
+register_learner(
+    "hist_gradient_boosting", TREATMENT,
+    lambda random_state, n_threads: HistGradientBoostingClassifier(random_state=random_state),
+    accepts_sparse=False
+)
+register_learner(
+    "random_forest", OUTCOME,
+    lambda random_state, n_threads: RandomForestRegressor(random_state=random_state, n_jobs=n_threads)
+)
+# Ridge is solved in closed form, so there is no iterate to warm-start from
+register_learner("ridge", OUTCOME, lambda random_state, n_threads: Ridge())
+register_learner(
+    "hist_gradient_boosting", OUTCOME,
+    lambda random_state, n_threads: HistGradientBoostingRegressor(random_state=random_state),
+    accepts_sparse=False
+)
+
+for module in filter(None, os.environ.get("DML_LEARNER_PLUGINS", "").split(",")):
+    importlib.import_module(module.strip())
@@ -0,0 +1,218 @@
+import numpy as np
+
+MATCHING_METHODS = ("nearest", "greedy", "optimal")
+
+# References per match slot searched on each side of the greedy solution
+# by optimal matching
+OPTIMAL_BAND = 8
+
+def _sorted_candidates(query_scores, sorted_ref, width):
+    """Positions ``[pos - width, pos + width)`` around each query's insertion point
+    in ``sorted_ref``, and their distances (``inf`` outside the array)."""
+    pos = np.searchsorted(sorted_ref, query_scores)
+    cand = pos[:, None] + np.arange(-width, width)[None, :]
+    valid = (cand >= 0) & (cand < len(sorted_ref))
+    cand = np.clip(cand, 0, max(len(sorted_ref) - 1, 0))
+    dist = np.where(valid, np.abs(sorted_ref[cand] - query_scores[:, None]), np.inf)
+    return cand, dist
+
+def _nearest(query_scores, sorted_ref, k, caliper, order):
+    # In 1-D the k nearest scores are contiguous in sorted order, so they are
+    # among the k positions on either side of the insertion point
+    cand, dist = _sorted_candidates(query_scores, sorted_ref, k)
+    nearest = np.argsort(dist, axis=1, kind="stable")[:, :k]
+    ref_pos = np.take_along_axis(cand, nearest, axis=1)
+    dist_k = np.take_along_axis(dist, nearest, axis=1)
+    # Only a tie at the k-th distance leaves a choice to make: another window
+    # candidate that far away, or the k-th's block of equal scores going on
+    # past the window
+    last = ref_pos[:, -1]
+    value = sorted_ref[last]
+    same_block = (sorted_ref[np.maximum(last - 1, 0)] == value) & (last > 0)
+    same_block |= (sorted_ref[np.minimum(last + 1, len(sorted_ref) - 1)] == value) & (last < len(sorted_ref) - 1)
+    tied = np.flatnonzero(((dist == dist_k[:, -1:]).sum(axis=1) > 1) | same_block)
+    if len(tied):
+        ref_pos[tied], dist_k[tied] = _break_ties(query_scores[tied], sorted_ref, k, order, cand[tied], dist[tied])
+    ref_pos, dist = ref_pos.ravel(), dist_k.ravel()
+    query_pos = np.repeat(np.arange(len(query_scores)), k)
+    keep = np.isfinite(dist) if caliper is None else dist <= caliper
+    return query_pos[keep], ref_pos[keep], dist[keep]
+
+def _break_ties(query_scores, sorted_ref, k, order, cand, dist):
+    """The k nearest of ``_nearest``'s window candidates, ties going to the lowest original index.
+
+    References at the k-th distance have one of at most two scores, and each
+    score's block of equal values can reach past the window. In a block
+    (sorted stably) the lowest original indices come first, so the window
+    keeps only the strictly nearer references and each boundary block
+    contributes its first k positions.
+    """
+    kth = np.partition(dist, k - 1, axis=1)[:, k - 1]
+    boundary = np.where(dist == kth[:, None], sorted_ref[cand], np.nan)
+    low, high = np.nanmin(boundary, axis=1), np.nanmax(boundary, axis=1)
+    cands, dists = [cand], [np.where(dist < kth[:, None], dist, np.inf)]
+    for value, block in ((low, np.ones(len(low), dtype=bool)), (high, high != low)):
+        start = np.searchsorted(sorted_ref, value, side="left")
+        stop = np.searchsorted(sorted_ref, value, side="right")
+        pos = start[:, None] + np.arange(k)[None, :]
+        valid = (pos < stop[:, None]) & block[:, None]
+        pos = np.minimum(pos, len(sorted_ref) - 1)
+        cands.append(pos)
+        dists.append(np.where(valid, np.abs(sorted_ref[pos] - query_scores[:, None]), np.inf))
+    cand, dist = np.hstack(cands), np.hstack(dists)
+    nearest = np.lexsort((order[cand], dist), axis=-1)[:, :k]
+    return np.take_along_axis(cand, nearest, axis=1), np.take_along_axis(dist, nearest, axis=1)
+
+def _find(parent, i):
+    """Union-find root with path compression, used as a "next unused position" pointer."""
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:
+        parent[i], i = root, parent[i]
+    return root
+
+def _greedy(query_scores, sorted_ref, k, caliper):
+    # Queries take turns, highest score first, each round taking the nearest
+    # reference not used yet. Used references are skipped through two
+    # union-find pointer arrays, so each lookup is near-constant time.
+    n = len(sorted_ref)
+    right = list(range(n + 1))  # right[i]: first unused position >= i (n = none)
+    left = list(range(n + 1))   # left[i + 1]: last unused position <= i, shifted by one (0 = none)
+    refs = sorted_ref.tolist()
+    scores = query_scores.tolist()
+    insertion = np.searchsorted(sorted_ref, query_scores).tolist()
+    active = np.argsort(-query_scores, kind="stable").tolist()
+    query_pos, ref_pos, dist = [], [], []
+    for _ in range(k):
+        still_active = []
+        for q in active:
+            score, p = scores[q], insertion[q]
+            r = _find(right, p)
+            l = _find(left, p) - 1
+            d_r = refs[r] - score if r < n else np.inf
+            d_l = score - refs[l] if l >= 0 else np.inf
+            best, d = (l, d_l) if d_l <= d_r else (r, d_r)
+            if d == np.inf or (caliper is not None and d > caliper):
+                continue
+            right[best] = best + 1
+            left[best + 1] = best
+            query_pos.append(q)
+            ref_pos.append(best)
+            dist.append(d)
+            still_active.append(q)
+        active = still_active
+    return np.array(query_pos, dtype=int), np.array(ref_pos, dtype=int), np.array(dist, dtype=float)
+
+def _optimal(query_scores, sorted_ref, k, caliper):
+    # With |distance| costs on a line, some minimum-cost assignment of match
+    # slots (k per query) to distinct references keeps both in sorted order,
+    # so it is a shortest path through (slot, reference) pairs. Greedy matching
+    # picks which slots get filled; pairing its slots and references in sorted
+    # order is feasible and no worse than greedy, and the search is limited to
+    # OPTIMAL_BAND * k references either side of that path.
+    greedy_query, greedy_ref, _ = _greedy(query_scores, sorted_ref, k, caliper)
+    n_slots, n_ref = len(greedy_query), len(sorted_ref)
+    if n_slots == 0:
+        return greedy_query, greedy_ref, np.empty(0)
+    slot_query = greedy_query[np.argsort(query_scores[greedy_query], kind="stable")]
+    slot_score = query_scores[slot_query]
+    center = np.sort(greedy_ref)
+    width = OPTIMAL_BAND * k
+    start = np.clip(center - width, 0, None)
+    stop = np.minimum(center + width + 1, n_ref)
+    limit = np.inf if caliper is None else caliper
+
+    back = []
+    for i in range(n_slots):
+        cols = np.arange(start[i], stop[i])
+        cost = np.abs(sorted_ref[cols] - slot_score[i])
+        cost[cost > limit] = np.inf
+        if i == 0:
+            total, pointer = cost, np.full(len(cols), -1)
+        else:
+            # Cheapest path into any reference strictly left of each column
+            j = np.clip(cols - 1 - start[i - 1], -1, len(best_total) - 1)
+            before = np.where(j >= 0, best_total[np.maximum(j, 0)], np.inf)
+            pointer = np.where(j >= 0, best_col[np.maximum(j, 0)], -1)
+            total = cost + before
+        back.append(pointer)
+        # Running minimum over the band, and the column it is reached at
+        best_total = np.minimum.accumulate(total)
+        reached = np.flatnonzero(total == best_total)
+        best_col = cols[reached[np.searchsorted(reached, np.arange(len(total)), side="right") - 1]]
+
+    ref_pos = np.empty(n_slots, dtype=int)
+    ref_pos[-1] = best_col[-1]
+    for i in range(n_slots - 1, 0, -1):
+        ref_pos[i - 1] = back[i][ref_pos[i] - start[i]]
+    return slot_query, ref_pos, np.abs(sorted_ref[ref_pos] - slot_score)
+
+def match(query_scores, ref_scores, n_neighbors, caliper=None, method="nearest"):
+    """Match query units to reference units on one-dimensional scores.
+
+    ``nearest`` takes each query's ``n_neighbors`` nearest references, with
+    replacement; among references equally far away, those with the lowest
+    index in ``ref_scores`` win. (scikit-learn's ball tree, used before, broke
+    such ties by its tree layout, so on tied scores the matches can differ.) ``greedy`` and ``optimal`` match without replacement: greedy
+    lets queries pick in turn, highest score first; optimal minimizes the total
+    distance of the matched pairs over references near each query. With a
+    ``caliper``, only pairs at most that far apart are formed.
+
+    All methods work on the sorted reference scores and never build a dense
+    distance matrix. Returns flat ``(query_pos, ref_pos, distance)`` arrays in
+    query order, nearest first.
+    """
+    query_scores = np.asarray(query_scores, dtype=float)
+    ref_scores = np.asarray(ref_scores, dtype=float)
+    k = min(int(n_neighbors), len(ref_scores))
+    if k == 0 or len(query_scores) == 0:
+        return np.empty(0, int), np.empty(0, int), np.empty(0)
+    order = np.argsort(ref_scores, kind="stable")
+    sorted_ref = ref_scores[order]
+    if method == "nearest":
+        query_pos, ref_pos, dist = _nearest(query_scores, sorted_ref, k, caliper, order)
+    else:
+        query_pos, ref_pos, dist = {"greedy": _greedy, "optimal": _optimal}[method](query_scores, sorted_ref, k, caliper)
+    # Ties in distance keep the lower original index first
+    ranking = np.lexsort((order[ref_pos], dist, query_pos))
+    return query_pos[ranking], order[ref_pos[ranking]], dist[ranking]
+
+def extend_nearest(matches, query_scores, ref_scores, n_old_query, n_old_ref, n_neighbors, caliper=None):
+    """Update ``nearest`` matches after query and reference units were appended.
+
+    ``matches`` is what ``match`` returned for the first ``n_old_query`` query
+    and ``n_old_ref`` reference scores; the rest of each array is new. An old
+    query can only change its matches if some new reference is at least as
+    close as its farthest match (or, short of ``n_neighbors`` matches under a
+    caliper, within the caliper), so only those and the new queries are
+    rematched. Returns what ``match`` on all scores returns, plus the number
+    of queries rematched.
+    """
+    query_scores = np.asarray(query_scores, dtype=float)
+    ref_scores = np.asarray(ref_scores, dtype=float)
+    k = min(int(n_neighbors), len(ref_scores))
+    if k == 0 or k != min(int(n_neighbors), n_old_ref):
+        # No references at all, or the new ones give every query more matches
+        return (*match(query_scores, ref_scores, n_neighbors, caliper), len(query_scores))
+    query_pos, ref_pos, dist = matches
+    counts = np.bincount(query_pos, minlength=n_old_query)
+    farthest = np.full(n_old_query, np.inf if caliper is None else float(caliper))
+    full = counts == k
+    # Matches are in query order, nearest first, so a query's farthest is its last
+    farthest[full] = dist[np.cumsum(counts)[full] - 1]
+    new_refs = np.sort(ref_scores[n_old_ref:])
+    if len(new_refs) and n_old_query:
+        _, gap = _sorted_candidates(query_scores[:n_old_query], new_refs, 1)
+        affected = np.flatnonzero(gap.min(axis=1) <= farthest)
+    else:
+        affected = np.empty(0, dtype=int)
+    rematch = np.concatenate([affected, np.arange(n_old_query, len(query_scores))])
+    sub_query, sub_ref, sub_dist = match(query_scores[rematch], ref_scores, k, caliper)
+    keep = ~np.isin(query_pos, affected)
+    query_pos = np.concatenate([query_pos[keep], rematch[sub_query]])
+    ref_pos = np.concatenate([ref_pos[keep], sub_ref])
+    dist = np.concatenate([dist[keep], sub_dist])
+    # Each query's matches are already nearest first
+    order = np.argsort(query_pos, kind="stable")
+    return query_pos[order], ref_pos[order], dist[order], len(rematch)
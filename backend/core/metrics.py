@@ -0,0 +1,216 @@
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+from api.schemas import StageTiming
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+PROFILE_TOP_N = 40
+# Seconds between stack samples of a profiled run
+PROFILE_INTERVAL = 0.005
+
+def peak_rss_mb() -> float | None:
+    """Peak resident set size of this process so far, in MB."""
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label values, in Prometheus' text format."""
+
+    def __init__(self, name: str, help: str, label_names: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            counts, total, n = self._series.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._series[key] = (counts, total + value, n + 1)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, list(counts), total, n) for key, (counts, total, n) in self._series.items())
+        for key, counts, total, n in series:
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, key))
+            prefix = labels + "," if labels else ""
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {n}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {n}")
+        return lines
+
+http_latency = Histogram(
+    "http_request_duration_seconds", "Time from receiving a request to sending the response headers.",
+    ("method", "endpoint", "status")
+)
+stage_latency = Histogram(
+    "analysis_stage_seconds", "Time spent in each stage of an analysis.",
+    ("analysis", "stage")
+)
+
+def render_metrics() -> str:
+    return "\n".join([*http_latency.render(), *stage_latency.render()]) + "\n"
+
+class StageTimings:
+    """Wall time and process peak RSS per stage of one analysis run."""
+
+    def __init__(self):
+        self.stages = {}
+        self._last = time.perf_counter()
+
+    def lap(self, name: str, seconds: float | None = None) -> None:
+        now = time.perf_counter()
+        seconds = now - self._last if seconds is None else seconds
+        self._last = now
+        entry = self.stages.setdefault(name, {"seconds": 0.0, "peak_rss_mb": None})
+        entry["seconds"] += seconds
+        entry["peak_rss_mb"] = peak_rss_mb()
+
+    def server_timing(self) -> str:
+        """The stages as a ``Server-Timing`` header value (durations in ms)."""
+        return ", ".join(f"{name};dur={entry['seconds'] * 1000:.1f}" for name, entry in self.stages.items())
+
+_timings: ContextVar = ContextVar("stage_timings", default=None)
+_request_start: ContextVar = ContextVar("request_start", default=None)
+
+def lap(name: str) -> None:
+    """Close the current stage of the running analysis as ``name``.
+
+    A stage runs from the previous ``lap`` (or the start of recording) to now.
+    Outside ``record_stages`` this does nothing, so the engines can call it
+    unconditionally.
+    """
+    timings = _timings.get()
+    if timings is not None:
+        timings.lap(name)
+
+def mark_request_start() -> None:
+    """Note when the HTTP request arrived, so the time spent reading and
+    validating its body shows up as the first stage."""
+    _request_start.set(time.perf_counter())
+
+@contextmanager
+def record_stages():
+    timings = StageTimings()
+    request_start = _request_start.get()
+    if request_start is not None:
+        timings.lap("parse_and_validate", seconds=time.perf_counter() - request_start)
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+def observe_stages(analysis: str, stages: dict) -> None:
+    for name, entry in stages.items():
+        stage_latency.observe(entry["seconds"], analysis=analysis, stage=name)
+
+class Profile:
+    text: str | None = None
+
+class StackSampler:
+    """Samples one thread's Python stack every ``interval`` seconds from a
+    background thread, counting per function the samples it was on the stack
+    (total) and on top of it (self).
+
+    Unlike a tracing profiler it adds no per-call overhead. Samples are only
+    taken when the sampler gets the GIL, so time in long C calls that hold it
+    is attributed to whatever runs next.
+    """
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.total = Counter()
+        self.own = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            self.samples += 1
+            self.own[stack[0]] += 1
+            self.total.update(set(stack))
+
+    def report(self, top_n: int = PROFILE_TOP_N) -> str:
+        lines = [f"{self.samples} samples every {self.interval * 1000:g} ms", "  total%   self%  function"]
+        for key, count in self.total.most_common(top_n):
+            name, filename, line = key
+            lines.append(f"{100 * count / self.samples:7.1f} {100 * self.own[key] / self.samples:7.1f}  {name} ({filename}:{line})")
+        return "\n".join(lines) + "\n"
+
+@contextmanager
+def profiled(enabled: bool):
+    """Sample the block's stacks when ``enabled``; the report ends up in ``.text``."""
+    profile = Profile()
+    if not enabled:
+        yield profile
+        return
+    sampler = StackSampler(threading.get_ident())
+    sampler.start()
+    try:
+        yield profile
+    finally:
+        sampler.stop()
+        profile.text = sampler.report()
+
+def run_instrumented(fn, kwargs: dict, include_timings: bool = False, profile: bool = False):
+    """Run an analysis, recording its stages; returns ``(result, timings)``.
+
+    The stage timings are attached to the result when ``include_timings`` is
+    set, and a profile report when ``profile`` is. Callers feed
+    ``timings.stages`` to ``observe_stages`` in the process that serves
+    ``/metrics``.
+    """
+    with record_stages() as timings, profiled(profile) as report:
+        result = fn(**kwargs)
+    if include_timings:
+        result.timings = {name: StageTiming(**entry) for name, entry in timings.stages.items()}
+    if profile:
+        result.profile = report.text
+    return result, timings
+
+def serialize(result, timings: StageTimings) -> str:
+    """``result`` as JSON, timed as the ``serialize`` stage of ``timings``.
+
+    That stage comes after the result is built, so it shows up in
+    ``Server-Timing`` and ``/metrics`` but not in the result's own ``timings``.
+    """
+    start = time.perf_counter()
+    body = result.model_dump_json()
+    timings.lap("serialize", seconds=time.perf_counter() - start)
+    return body
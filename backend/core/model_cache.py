@@ -0,0 +1,92 @@
+import os
+import threading
+from collections import OrderedDict
+import joblib
+
+class ModelCache:
+    """LRU cache of fitted-model outputs: propensity scores and out-of-fold
+    nuisance predictions.
+
+    Keys hash the model inputs themselves (design matrix, treatment and
+    outcome values) together with everything else the fit depends on, so a
+    request that only changes matching or plotting options reuses the fit,
+    whether its data came inline, as an upload or as a registered dataset.
+    Least-recently-used entries are dropped once their combined size passes
+    ``max_bytes``; ``max_bytes=0`` disables the cache. With a ``persist_dir``,
+    entries are also written there with joblib and survive restarts, which is
+    also how job worker processes share them.
+    """
+
+    def __init__(self, max_bytes: int, persist_dir: str | None = None):
+        self.max_bytes = max_bytes
+        self.persist_dir = persist_dir
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def key(self, *parts) -> str | None:
+        """Cache key for a fit; ``None`` when the cache is disabled, so callers
+        skip hashing their inputs."""
+        return joblib.hash(parts) if self.enabled else None
+
+    def get(self, key: str | None):
+        """The cached arrays for ``key``, or ``None`` on a miss."""
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+        path = self._path(key)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            value = joblib.load(path)
+        except Exception:
+            # A partial write from a crashed process; refit instead
+            return None
+        self._remember(key, value)
+        return value
+
+    def put(self, key: str | None, value: tuple) -> None:
+        if key is None:
+            return
+        for array in value:
+            # Shared between requests, so nobody may modify it in place
+            array.setflags(write=False)
+        self._remember(key, value)
+        path = self._path(key)
+        if path and not os.path.exists(path):
+            # Write then rename, so readers in other processes never see half a file
+            tmp = f"{path}.{os.getpid()}.tmp"
+            joblib.dump(value, tmp)
+            os.replace(tmp, path)
+
+    def _remember(self, key: str, value: tuple) -> None:
+        nbytes = sum(array.nbytes for array in value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[1]
+            self._entries[key] = (value, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes and self._entries:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self._nbytes -= dropped
+
+    def _path(self, key: str) -> str:
+        if not self.persist_dir:
+            return ""
+        return os.path.join(self.persist_dir, f"{key}.joblib")
+
+models = ModelCache(
+    max_bytes=int(os.environ.get("MODEL_CACHE_BYTES", 256 << 20)),
+    persist_dir=os.environ.get("MODEL_CACHE_DIR") or None,
+)
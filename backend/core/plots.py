@@ -0,0 +1,61 @@
+import numpy as np
+from api.schemas import PlotData
+
+RESIDUAL_SAMPLE_POINTS = 2000
+RESIDUAL_QUANTILE_BINS = 50
+
+def histogram_plot(treated_values, control_values, bins: int, plot_mode: str, **labels) -> PlotData:
+    """Two-group histogram, either pre-binned on shared edges or as raw values.
+
+    In ``binned`` mode the payload holds ``bins + 1`` edges and two count
+    vectors, so its size doesn't depend on the number of rows.
+    """
+    treated_values = np.asarray(treated_values, dtype=float)
+    control_values = np.asarray(control_values, dtype=float)
+    if plot_mode == "raw":
+        return PlotData(treated_values=treated_values.tolist(), control_values=control_values.tolist(), **labels)
+    treated_values = treated_values[np.isfinite(treated_values)]
+    control_values = control_values[np.isfinite(control_values)]
+    edges = np.histogram_bin_edges(np.concatenate([treated_values, control_values]), bins=bins)
+    treated_counts, _ = np.histogram(treated_values, bins=edges)
+    control_counts, _ = np.histogram(control_values, bins=edges)
+    return PlotData(
+        bin_edges=edges.tolist(),
+        treated_counts=treated_counts.tolist(),
+        control_counts=control_counts.tolist(),
+        **labels
+    )
+
+def residual_summary(treatment_residuals, outcome_residuals, random_state: int) -> dict:
+    """Fixed-size view of the DML residual scatter.
+
+    A uniform random sample of at most ``RESIDUAL_SAMPLE_POINTS`` points, plus
+    the mean treatment and outcome residual within each of
+    ``RESIDUAL_QUANTILE_BINS`` quantile bins of the treatment residual.
+    """
+    x = np.asarray(treatment_residuals, dtype=float)
+    y = np.asarray(outcome_residuals, dtype=float)
+    rng = np.random.default_rng(random_state)
+    sample = np.sort(rng.choice(len(x), size=min(RESIDUAL_SAMPLE_POINTS, len(x)), replace=False))
+
+    edges = np.unique(np.quantile(x, np.linspace(0, 1, RESIDUAL_QUANTILE_BINS + 1))) if len(x) else np.array([])
+    if len(edges) > 1:
+        n_bins = len(edges) - 1
+        which = np.clip(np.searchsorted(edges, x, side="right") - 1, 0, n_bins - 1)
+        counts = np.bincount(which, minlength=n_bins)
+        nonempty = counts > 0
+        x_means = np.bincount(which, weights=x, minlength=n_bins)[nonempty] / counts[nonempty]
+        y_means = np.bincount(which, weights=y, minlength=n_bins)[nonempty] / counts[nonempty]
+        counts = counts[nonempty]
+    else:
+        x_means = y_means = counts = np.array([])
+
+    return {
+        "x_min": float(x.min()) if len(x) else None,
+        "x_max": float(x.max()) if len(x) else None,
+        "sample_treatment_residuals": x[sample].tolist(),
+        "sample_outcome_residuals": y[sample].tolist(),
+        "binned_treatment_residuals": x_means.tolist(),
+        "binned_outcome_residuals": y_means.tolist(),
+        "bin_counts": counts.astype(int).tolist()
+    }
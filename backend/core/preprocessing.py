@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Designs with at most this share of nonzero entries stay sparse; denser ones
+# are cheaper to fit dense (tree learners slow down a lot on sparse input)
+SPARSE_MAX_DENSITY = 0.1
+
+def compact_frame(data: list | pd.DataFrame, columns: list) -> pd.DataFrame:
+    """Build the analysis DataFrame, storing ``columns`` in compact dtypes.
+
+    Integers are downcast to the smallest integer type and floats to float32
+    when every value survives the round trip; strings become categoricals.
+    Values never change, only their storage. Other columns, including the
+    treatment and outcome, are left alone, and a passed DataFrame is not
+    modified.
+    """
+    df = pd.DataFrame(data)
+    compacted = {}
+    for name in columns:
+        column = df[name]
+        if pd.api.types.is_bool_dtype(column) or isinstance(column.dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_integer_dtype(column):
+            compacted[name] = pd.to_numeric(column, downcast="integer")
+        elif pd.api.types.is_float_dtype(column) and column.dtype.itemsize > 4:
+            narrow = column.astype(np.float32)
+            if np.array_equal(narrow.to_numpy(dtype=float), column.to_numpy(dtype=float), equal_nan=True):
+                compacted[name] = narrow
+        elif pd.api.types.is_object_dtype(column) or pd.api.types.is_string_dtype(column):
+            compacted[name] = column.astype("category")
+    return df.assign(**compacted) if compacted else df
+
+def _is_categorical(column: pd.Series) -> bool:
+    return isinstance(column.dtype, pd.CategoricalDtype) or (
+        not pd.api.types.is_bool_dtype(column) and
+        (pd.api.types.is_object_dtype(column) or pd.api.types.is_string_dtype(column))
+    )
+
+def _sorted_levels(column: pd.Series) -> pd.Index:
+    """A categorical column's levels, sorted, so the dropped first level and the
+    indicator order don't depend on row order or on how the data arrived
+    (Arrow keeps levels in order of appearance; ``astype("category")`` sorts)."""
+    levels = column.cat.categories if isinstance(column.dtype, pd.CategoricalDtype) else column.astype("category").cat.categories
+    try:
+        return levels.sort_values()
+    except TypeError:
+        # Mixed types don't sort; pandas keeps them in order of appearance too
+        return levels
+
+class ConfounderEncoder:
+    """One-hot encoding (dropping the first level) and optional standardization
+    of the confounders, fitted on one frame and reusable on new rows.
+
+    Categorical confounders are one-hot encoded straight into a sparse matrix.
+    If the indicators would leave the design mostly zeros (density below
+    ``SPARSE_MAX_DENSITY``, i.e. high-cardinality columns), the design is a
+    CSR matrix and never gets a dense indicator copy; its indicators are
+    scaled but not centered, which would make them dense, and the models fit
+    an intercept that absorbs the shift. Otherwise it is a dense float64
+    array, with the numeric columns first, then the indicators. Levels unseen
+    in the fitted frame, like missing values, encode as all zeros.
+    """
+
+    def __init__(self, confounders: list, scale_features: bool):
+        self.confounders = list(confounders)
+        self.scale_features = scale_features
+
+    def fit(self, df: pd.DataFrame) -> "ConfounderEncoder":
+        self.fit_transform(df)
+        return self
+
+    def fit_transform(self, df: pd.DataFrame) -> np.ndarray | sparse.csr_matrix:
+        self.fit_columns(df)
+        return self._encode(df, fit=True)
+
+    def fit_columns(self, df: pd.DataFrame) -> "ConfounderEncoder":
+        """Learn the design's columns (but not the scaling) from ``df``."""
+        self.categorical = [name for name in self.confounders if _is_categorical(df[name])]
+        self.numeric = [name for name in self.confounders if name not in self.categorical]
+        self.levels = {name: _sorted_levels(df[name]) for name in self.categorical}
+        width = len(self.numeric) + sum(max(len(levels) - 1, 0) for levels in self.levels.values())
+        self.sparse = bool(self.categorical) and len(self.confounders) / max(width, 1) < SPARSE_MAX_DENSITY
+        return self
+
+    def feature_names(self) -> list:
+        """Design column names, as ``pd.get_dummies`` would name the indicators."""
+        return self.numeric + [f"{name}_{level}" for name in self.categorical for level in self.levels[name][1:]]
+
+    def transform(self, df: pd.DataFrame) -> np.ndarray | sparse.csr_matrix:
+        return self._encode(df, fit=False)
+
+    def codes(self, df: pd.DataFrame, name: str) -> np.ndarray:
+        """Level codes of categorical confounder ``name`` in ``df``; -1 for missing or unseen."""
+        return pd.Categorical(df[name], categories=self.levels[name]).codes
+
+    def column_affine(self) -> tuple:
+        """``(mean, scale)`` per design column: every column is ``(raw - mean) / scale``,
+        with ``raw`` the numeric value or the 0/1 indicator."""
+        width = len(self.numeric) + sum(max(len(levels) - 1, 0) for levels in self.levels.values())
+        mean, scale = np.zeros(width), np.ones(width)
+        if self.scale_features and not self.sparse:
+            mean, scale = self.scaler.mean_, self.scaler.scale_
+        elif self.scale_features:
+            if self.scaler is not None:
+                mean[:len(self.numeric)] = self.scaler.mean_
+                scale[:len(self.numeric)] = self.scaler.scale_
+            if self.indicator_scales:
+                scale[len(self.numeric):] = 1.0 / np.concatenate(self.indicator_scales)
+        return mean, scale
+
+    def _one_hot(self, df: pd.DataFrame, name: str) -> sparse.csr_matrix:
+        """Sparse indicator columns for every level but the first."""
+        codes = self.codes(df, name)
+        n_levels = max(len(self.levels[name]) - 1, 0)
+        # Code -1 (missing or unseen) and 0 (the dropped first level) are all-zero rows
+        rows = np.flatnonzero(codes > 0)
+        cols = codes[rows].astype(np.int64) - 1
+        return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(codes), n_levels))
+
+    def _encode(self, df: pd.DataFrame, fit: bool):
+        if fit and self.scale_features:
+            # Imported on first fit, so loading the API doesn't load scikit-learn
+            from sklearn.preprocessing import StandardScaler
+        X_numeric = df[self.numeric].to_numpy(dtype=float)
+        indicators = [self._one_hot(df, name) for name in self.categorical]
+        if not self.sparse:
+            X = np.hstack([X_numeric, *(block.toarray() for block in indicators)])
+            if not self.scale_features:
+                return X
+            if fit:
+                self.scaler = StandardScaler().fit(X)
+            return self.scaler.transform(X)
+        if self.scale_features:
+            if fit:
+                self.scaler = StandardScaler().fit(X_numeric) if self.numeric else None
+                self.indicator_scales = []
+                for block in indicators:
+                    share = np.asarray(block.sum(axis=0)).ravel() / max(block.shape[0], 1)
+                    std = np.sqrt(share * (1 - share))
+                    std[std == 0] = 1.0
+                    self.indicator_scales.append(1.0 / std)
+            if self.scaler is not None:
+                X_numeric = self.scaler.transform(X_numeric)
+            indicators = [block.multiply(scale).tocsr() for block, scale in zip(indicators, self.indicator_scales)]
+        return sparse.hstack([sparse.csr_matrix(X_numeric), *indicators], format="csr")
+
+def encode_confounders(df: pd.DataFrame, confounders: list, scale_features: bool) -> np.ndarray | sparse.csr_matrix:
+    """The confounders' design matrix; see ``ConfounderEncoder``."""
+    return ConfounderEncoder(confounders, scale_features).fit_transform(df)
+
+def design_nbytes(X) -> int:
+    """Memory held by a dense or sparse design matrix."""
+    if sparse.issparse(X):
+        return X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+    return X.nbytes
+
+def to_dense(X) -> np.ndarray:
+    """``X`` as a dense array, for estimators without sparse support."""
+    return X.toarray() if sparse.issparse(X) else X
+
+def freeze_design(X) -> None:
+    """Make a shared design matrix read-only."""
+    for array in (X.data, X.indices, X.indptr) if sparse.issparse(X) else (X,):
+        array.setflags(write=False)
@@ -1,12 +1,76 @@
+import logging
+from typing import Callable
 import pandas as pd
 import numpy as np
 from sklearn.linear_model import LogisticRegression
-from sklearn.neighbors import NearestNeighbors
-from sklearn.preprocessing import StandardScaler
-from api.schemas import PSMResponse, PlotData, MatchedPairInfo
+from joblib import Parallel, delayed
+from api.schemas import PSMResponse, MatchedPairInfo
+from core.preprocessing import ConfounderEncoder, compact_frame
+from core.matching import match
+from core.weighting import weighting
+from core.balance import covariate_balance
+from core.plots import histogram_plot
+from core.inference import replicate_seeds, percentile_interval
+from core.metrics import lap
+from core.model_cache import models
+
+logger = logging.getLogger(__name__)
+
+
+def _last_occurrence(positions):
+    """Indices into ``positions`` of the last occurrence of each distinct value."""
+    _, first_in_reversed = np.unique(positions[::-1], return_index=True)
+    return len(positions) - 1 - first_in_reversed
+
+def _match_effects(prop_score, treatment, outcomes, n_neighbors, caliper, matching_method):
+    """ATT, ATC and their share-weighted ATE from matching on ``prop_score``."""
+    treated, control = treatment == 1, treatment == 0
+    t_pos, c_pos, _ = match(prop_score[treated], prop_score[control], n_neighbors, caliper, matching_method)
+    att_effects = outcomes[treated][t_pos] - outcomes[control][c_pos]
+    c_pos, t_pos, _ = match(prop_score[control], prop_score[treated], n_neighbors, caliper, matching_method)
+    atc_effects = outcomes[treated][t_pos] - outcomes[control][c_pos]
+    att = att_effects.mean() if len(att_effects) else np.nan
+    atc = atc_effects.mean() if len(atc_effects) else np.nan
+    n_treated, n_control = treated.sum(), control.sum()
+    ate = (n_treated * att + n_control * atc) / (n_treated + n_control)
+    return att, atc, ate
+
+def propensity_scores(X, treatment, random_state):
+  """Propensity scores from a logistic fit on ``X``; returns ``(scores, cached)``.
+
+  Fits are cached on their inputs, so requests that only change matching
+  options reuse the scores as they are.
+  """
+  cache_key = models.key("propensity", X, treatment, int(random_state))
+  cached = models.get(cache_key)
+  if cached is not None:
+    return cached[0], True
+  lr = LogisticRegression(random_state=int(random_state), solver="lbfgs", max_iter=1000)
+  lr.fit(X, treatment)
+  prop_score = lr.predict_proba(X)[:, 1]
+  models.put(cache_key, (prop_score,))
+  return prop_score, False
+
+def _bootstrap_replicate(X, treatment, outcomes, seed, random_state, n_neighbors, caliper, matching_method):
+    """Refit the propensity model and rematch on one stratified bootstrap resample.
+
+    Treated and control units are resampled separately so group sizes stay
+    fixed; rows are selected by index array, never by copying the DataFrame.
+    """
+    rng = np.random.default_rng(seed)
+    treated_rows = np.flatnonzero(treatment == 1)
+    control_rows = np.flatnonzero(treatment == 0)
+    idx = np.concatenate([
+        rng.choice(treated_rows, size=len(treated_rows)),
+        rng.choice(control_rows, size=len(control_rows))
+    ])
+    lr = LogisticRegression(random_state=int(random_state), solver="lbfgs", max_iter=1000)
+    lr.fit(X[idx], treatment[idx])
+    prop_score = lr.predict_proba(X[idx])[:, 1]
+    return _match_effects(prop_score, treatment[idx], outcomes[idx], n_neighbors, caliper, matching_method)
 
 def psm(
-    data: list,
+    data: list | pd.DataFrame,
     treatment_col: str,
     outcome_col: str,
     confounders: list,
@@ -16,92 +80,162 @@ def psm(
     use_caliper: bool,
     caliper: float | None,
     show_prop_hist: bool,
-    show_matched_pair_hist: bool
+    show_matched_pair_hist: bool,
+    design=None,
+    progress: Callable[[dict], None] | None = None,
+    include_full_data: bool = False,
+    include_matched_pairs: bool = False,
+    tables: dict | None = None,
+    plot_mode: str = "binned",
+    n_bootstrap: int = 0,
+    confidence_level: float = 0.95,
+    n_jobs: int = 1,
+    matching_method: str = "nearest",
+    propensity: np.ndarray | None = None,
+    matches: dict | None = None,
+    estimator: str = "matching",
+    trim: float = 0.01,
+    stabilize: bool = True,
+    outcome_learner: str = "ridge",
+    n_splits: int = 5,
+    balance: bool = True
 ) -> PSMResponse:
+  """Propensity score matching.
+
+  The row-level tables are only inlined in the response when asked for with
+  ``include_full_data``/``include_matched_pairs``. If a ``tables`` dict is
+  passed, they are also put there as DataFrames (``full_data``,
+  ``matched_pairs``) for the caller to serve separately.
+
+  With ``n_bootstrap`` > 0, ATT/ATC/ATE standard errors and percentile
+  intervals come from that many bootstrap replicates, run on ``n_jobs`` workers.
+
+  ``matching_method`` is one of ``core.matching.MATCHING_METHODS``: ``nearest``
+  matches with replacement, ``greedy`` and ``optimal`` without.
+
+  Precomputed ``propensity`` scores (from ``propensity_scores`` on the same
+  design) skip the propensity fit, and precomputed ``matches`` (``match``
+  results on them, treated to control as ``"att"`` and control to treated as
+  ``"atc"``) skip matching. Without a propensity fit or bootstrap to run, the
+  confounders aren't encoded at all.
+
+  ``estimator`` ``ipw`` or ``aipw`` weights by the propensity scores instead
+  of matching (see ``core.weighting.weighting``, which takes ``trim``,
+  ``stabilize``, ``outcome_learner`` and ``n_splits``); the estimates come
+  with analytic standard errors, and ``n_bootstrap`` and the matching options
+  don't apply.
+
+  With ``balance``, the response gets per-column covariate balance before
+  and after matching, with units weighted by how often they were matched
+  (see ``core.balance``); a ``tables`` dict gets it as ``balance``.
+  """
   try:
-    df = pd.DataFrame(data)
-    X = df[confounders]
+    inference = None
+    df = compact_frame(data, confounders)
     treatment = df[treatment_col]
     Y = df[outcome_col]
 
-    X_enc = pd.get_dummies(X, drop_first=True)
-    if scale_features:
-        scaler = StandardScaler()
-        X_scaled = scaler.fit_transform(X_enc)
-    else:
-        X_scaled = X_enc.values
+    # A precomputed design (e.g. from the dataset store) skips the encoding pass
+    encoder = ConfounderEncoder(confounders, scale_features)
+    X_scaled = design
+    if X_scaled is None and (propensity is None or n_bootstrap > 0 or estimator == "aipw" or balance):
+        X_scaled = encoder.fit_transform(df)
+    lap("encode")
 
     #  Calculate Propensity
-    lr = LogisticRegression(random_state=int(random_state), solver="lbfgs", max_iter=1000)
-    lr.fit(X_scaled, treatment)
-    prop_score = lr.predict_proba(X_scaled)[:, 1]
+    if propensity is None:
+        prop_score, cached = propensity_scores(X_scaled, treatment.to_numpy(), random_state)
+    else:
+        prop_score, cached = propensity, True
+    lap("propensity")
+    if progress is not None:
+        progress({"stage": "propensity", "cached": cached})
+
+    if estimator != "matching":
+        return weighting(
+            df, X_scaled, treatment_col, outcome_col, prop_score, estimator, trim, stabilize, outcome_learner,
+            n_splits, random_state, n_jobs, confidence_level, show_prop_hist, plot_mode, include_full_data, tables,
+            encoder if balance else None
+        )
 
     df_psm = df.copy()
     df_psm["_propensity_score"] = prop_score
 
+    caliper = caliper if use_caliper else None
     treated_idx = treatment == 1
     control_idx = treatment == 0
     treated = df_psm[treated_idx].copy()
     control = df_psm[control_idx].copy()
 
-    df_psm["_matched_id"] = np.nan
-    df_psm["_match_distance"] = np.nan
-    df_psm["_matched_group"] = np.nan
-
     # Match
-    nbrs = NearestNeighbors(n_neighbors=int(n_neighbors), algorithm="ball_tree")
-    nbrs.fit(control[["_propensity_score"]])
-
-    # For matched control table
-    matched_controls = []
-    matched_treated = []
-    matched_distances = []
-    matched_pairs = []
-
-    for treated_index, treated_row in treated.iterrows():
-      distances, indices = nbrs.kneighbors( pd.DataFrame([[treated_row["_propensity_score"]]], columns=["_propensity_score"]) )
-      matched_ids = []
-      for d, idx in zip(distances[0], indices[0]):
-        if use_caliper and d > caliper:
-            continue
-        control_idx_in_df = control.index[idx]
-        matched_controls.append(control.loc[control_idx_in_df, outcome_col])
-        matched_treated.append(treated_row[outcome_col])
-        matched_distances.append(d)
-        matched_ids.append(control_idx_in_df)
-        # Mark both treated and control as matched
-        df_psm.at[treated_index, "_matched_id"] = str(control_idx_in_df)
-        df_psm.at[treated_index, "_match_distance"] = float(d)
-        df_psm.at[treated_index, "_matched_group"] = "Treated"
-        df_psm.at[control_idx_in_df, "_matched_id"] = str(treated_index)
-        df_psm.at[control_idx_in_df, "_match_distance"] = float(d)
-        df_psm.at[control_idx_in_df, "_matched_group"] = "Control"
-        matched_pairs.append(MatchedPairInfo(
-            treated_index=str(treated_index),
-            control_index=str(control_idx_in_df),
-            distance=float(d)
-        ))
-
-    matched_controls = np.array(matched_controls)
-    matched_treated = np.array(matched_treated)
+    if matches is not None:
+        t_pos, c_pos, distances = matches["att"]
+    else:
+        t_pos, c_pos, distances = match(
+            treated["_propensity_score"].to_numpy(),
+            control["_propensity_score"].to_numpy(),
+            n_neighbors, caliper, matching_method
+        )
+    treated_rows = np.flatnonzero(treated_idx)
+    control_rows = np.flatnonzero(control_idx)
+    treated_labels = treated.index[t_pos]
+    control_labels = control.index[c_pos]
+    matched_treated = treated[outcome_col].to_numpy()[t_pos]
+    matched_controls = control[outcome_col].to_numpy()[c_pos]
+
+    # Mark both treated and control as matched; a unit keeps its last pair
+    matched_id = np.full(len(df_psm), np.nan, dtype=object)
+    match_distance = np.full(len(df_psm), np.nan)
+    matched_group = np.full(len(df_psm), np.nan, dtype=object)
+    for own_rows, own_pos, other_labels, group in (
+        (treated_rows, t_pos, control_labels, "Treated"),
+        (control_rows, c_pos, treated_labels, "Control"),
+    ):
+        last = _last_occurrence(own_pos)
+        rows = own_rows[own_pos[last]]
+        matched_id[rows] = other_labels[last].astype(str)
+        match_distance[rows] = distances[last]
+        matched_group[rows] = group
+    df_psm["_matched_id"] = matched_id
+    df_psm["_match_distance"] = match_distance
+    df_psm["_matched_group"] = matched_group
+
+    treated_ids = treated_labels.astype(str)
+    control_ids = control_labels.astype(str)
+    matched_pairs = None
+    if include_matched_pairs:
+        matched_pairs = [
+            MatchedPairInfo(treated_index=t, control_index=c, distance=d)
+            for t, c, d in zip(treated_ids, control_ids, distances.tolist())
+        ]
+    if tables is not None:
+        tables["full_data"] = df_psm
+        tables["matched_pairs"] = pd.DataFrame({
+            "treated_index": treated_ids,
+            "control_index": control_ids,
+            "distance": distances
+        })
 
     att = (matched_treated - matched_controls).mean()
     num_matched = len(matched_controls)
+    lap("att_matching")
+    if progress is not None:
+        progress({"stage": "att_matching", "matched_units": num_matched})
 
-    nbrs_atc = NearestNeighbors(n_neighbors=int(n_neighbors), algorithm="ball_tree")
-    nbrs_atc.fit(treated[["_propensity_score"]])
-
-    atc_effects = []
-    for control_index, control_row in control.iterrows():
-        distances, indices = nbrs_atc.kneighbors(pd.DataFrame([[control_row["_propensity_score"]]], columns=["_propensity_score"]))
-        for d, idx in zip(distances[0], indices[0]):
-            if use_caliper and d > caliper:
-                continue
-            treated_idx_in_df = treated.index[idx]
-            matched_outcome = treated.loc[treated_idx_in_df, outcome_col]
-            atc_effects.append(matched_outcome - control_row[outcome_col])
+    if matches is not None:
+        c_pos_atc, t_pos_atc, _ = matches["atc"]
+    else:
+        c_pos_atc, t_pos_atc, _ = match(
+            control["_propensity_score"].to_numpy(),
+            treated["_propensity_score"].to_numpy(),
+            n_neighbors, caliper, matching_method
+        )
+    atc_effects = treated[outcome_col].to_numpy()[t_pos_atc] - control[outcome_col].to_numpy()[c_pos_atc]
 
-    atc = np.mean(atc_effects) if atc_effects else np.nan
+    atc = np.mean(atc_effects) if len(atc_effects) else np.nan
+    lap("atc_matching")
+    if progress is not None:
+        progress({"stage": "atc_matching", "matched_units": num_matched + len(atc_effects)})
 
     n_treated = len(treated)
     n_control = len(control)
@@ -109,13 +243,44 @@ def psm(
 
     ate = (n_treated / n_total) * att + (n_control / n_total) * atc
 
+    balance_rows = None
+    if balance:
+        weights = np.zeros(len(df_psm))
+        weights[treated_rows] = np.bincount(t_pos, minlength=len(treated_rows))
+        weights[control_rows] = np.bincount(c_pos, minlength=len(control_rows))
+        balance_rows = covariate_balance(X_scaled, df, encoder, treated_idx.to_numpy(), weights, tables)
+        lap("balance")
+
+    if n_bootstrap > 0:
+        treatment_arr = treatment.to_numpy()
+        outcome_arr = Y.to_numpy(dtype=float)
+        replicates = Parallel(n_jobs=n_jobs, max_nbytes="1M", mmap_mode="r", return_as="generator")(
+            delayed(_bootstrap_replicate)(
+                X_scaled, treatment_arr, outcome_arr, seed, random_state, n_neighbors, caliper, matching_method
+            )
+            for seed in replicate_seeds(random_state, n_bootstrap)
+        )
+        effects = []
+        for replicate in replicates:
+            effects.append(replicate)
+            if progress is not None:
+                progress({"stage": "bootstrap", "replicate": len(effects), "n_replicates": n_bootstrap})
+        effects = np.array(effects).reshape(-1, 3)
+        inference = {
+            name: percentile_interval(estimate, effects[:, i], confidence_level)
+            for i, (name, estimate) in enumerate([("att", att), ("atc", atc), ("ate", ate)])
+        }
+        lap("bootstrap")
+
     prop_hist_data = None
     matched_outcome_hist_data = None
 
     if show_prop_hist:
-        prop_hist_data = PlotData(
-            treated_values=df_psm.loc[treated_idx, "_propensity_score"].tolist(),
-            control_values=df_psm.loc[control_idx, "_propensity_score"].tolist(),
+        prop_hist_data = histogram_plot(
+            df_psm.loc[treated_idx, "_propensity_score"],
+            df_psm.loc[control_idx, "_propensity_score"],
+            bins=20,
+            plot_mode=plot_mode,
             title="Propensity Score Distribution",
             xlabel="Propensity Score",
             ylabel="Count",
@@ -123,23 +288,31 @@ def psm(
         )
 
     if show_matched_pair_hist:
-        matched_outcome_hist_data = PlotData(
-            treated_values=matched_treated.tolist(),
-            control_values=matched_controls.tolist(),
+        matched_outcome_hist_data = histogram_plot(
+            matched_treated,
+            matched_controls,
+            bins=10,
+            plot_mode=plot_mode,
             title="Outcome Distribution of Matched Units",
             xlabel="Outcome",
             ylabel="Count",
             legend_labels=["Matched Treated", "Matched Control"]
         )
+    lap("plots")
   except Exception as e:
-     print(f"error: {e}")
-  return PSMResponse (
+     logger.exception("PSM analysis failed")
+     return PSMResponse(message=f"Error: PSM analysis failed: {type(e).__name__}: {e}")
+  response = PSMResponse (
         att=att,
         ate_raw=ate,
         num_matched_pairs=num_matched,
         message="PSM analysis complete.",
         propensity_score_plot_data=prop_hist_data,
         matched_outcome_plot_data=matched_outcome_hist_data,
-        full_data_with_psm_info=[{str(k): v for k, v in row.items()} for row in df_psm.to_dict(orient='records')],
-        matched_pairs_table=matched_pairs
-  )
\ No newline at end of file
+        full_data_with_psm_info=[{str(k): v for k, v in row.items()} for row in df_psm.to_dict(orient='records')] if include_full_data else None,
+        matched_pairs_table=matched_pairs,
+        inference=inference,
+        balance=balance_rows
+  )
+  lap("build_response")
+  return response
\ No newline at end of file
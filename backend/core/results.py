@@ -0,0 +1,51 @@
+import os
+import threading
+import uuid
+from collections import OrderedDict
+import pandas as pd
+
+def _with_str_columns(df: pd.DataFrame) -> pd.DataFrame:
+    # Only copy when a column label actually needs converting
+    if all(isinstance(c, str) for c in df.columns):
+        return df
+    return df.rename(columns=str)
+
+class ResultStore:
+    """LRU store of the row-level tables behind analysis responses.
+
+    Responses carry only a ``result_id``; the tables (PSM data with matching
+    info, matched pairs, DML residuals) stay here and are served in pages by the
+    results endpoint. Least-recently-used results are dropped once their
+    combined size passes ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, tables: dict, result_id: str | None = None) -> str:
+        result_id = result_id or uuid.uuid4().hex
+        tables = {name: _with_str_columns(df) for name, df in tables.items()}
+        nbytes = sum(int(df.memory_usage(deep=True).sum()) for df in tables.values())
+        with self._lock:
+            old = self._entries.pop(result_id, None)
+            if old is not None:
+                self._nbytes -= old[1]
+            self._entries[result_id] = (tables, nbytes)
+            self._nbytes += nbytes
+            # Never drop the result that was just stored
+            while self._nbytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self._nbytes -= dropped
+        return result_id
+
+    def get(self, result_id: str, table: str) -> pd.DataFrame:
+        """Return one table of a result; raises ``KeyError`` if either is unknown."""
+        with self._lock:
+            tables, _ = self._entries[result_id]
+            self._entries.move_to_end(result_id)
+            return tables[table]
+
+results = ResultStore(max_bytes=int(os.environ.get("RESULT_CACHE_BYTES", 512 << 20)))
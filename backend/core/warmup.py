@@ -0,0 +1,124 @@
+import logging
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# off: load estimators on the first request; blocking: warm up before serving;
+# background: serve at once and report ready once warm
+WARMUP_MODES = ("off", "blocking", "background")
+WARMUP_MODE = os.environ.get("WARMUP_MODE", "background")
+# Ready is reported after this long even if the warm-up hasn't finished
+WARMUP_TIMEOUT_SECONDS = float(os.environ.get("WARMUP_TIMEOUT_SECONDS", 60))
+WARMUP_ROWS = 200
+# Job workers to start and warm up at boot, capped at the pool size; by
+# default none, and workers start (cold) on the first job submitted
+WARMUP_JOB_WORKERS = int(os.environ.get("WARMUP_JOB_WORKERS", 0))
+
+def warm_up(n_rows: int = WARMUP_ROWS) -> None:
+    """Import the estimators and run PSM, IPW and DML once on a tiny synthetic dataset.
+
+    Beyond the imports, this loads what the libraries only load on first use
+    (solvers, BLAS thread pools, pandas' categorical and groupby paths), so
+    the first real request doesn't pay for it.
+    """
+    from core.psm import psm
+    from core.dml import dml
+
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(n_rows, 2))
+    treatment = (rng.random(n_rows) < 1 / (1 + np.exp(-x[:, 0]))).astype(int)
+    df = pd.DataFrame({
+        "x0": x[:, 0],
+        "x1": x[:, 1],
+        "group": rng.choice(["a", "b", "c"], n_rows),
+        "treatment": treatment,
+        "outcome": treatment + x[:, 0] + rng.normal(size=n_rows),
+    })
+    confounders = ["x0", "x1", "group"]
+    psm(df, "treatment", "outcome", confounders, 1, 0, True, False, None, True, True)
+    psm(df, "treatment", "outcome", confounders, 1, 0, True, False, None, True, False, estimator="ipw")
+    dml(df, "treatment", "outcome", confounders, n_splits=2)
+
+class Startup:
+    """How far the process has got towards serving warm requests.
+
+    Times are seconds since ``started``, the start of the app's imports. With
+    a ``workers`` pool (``core.jobs.JobManager``) and ``n_workers`` above zero,
+    the warm-up also starts that many of its workers and waits, within the
+    timeout, for each to warm up on its own.
+    """
+
+    def __init__(self, started: float, mode: str = WARMUP_MODE, timeout: float = WARMUP_TIMEOUT_SECONDS,
+                 workers=None, n_workers: int = WARMUP_JOB_WORKERS):
+        if mode not in WARMUP_MODES:
+            raise ValueError(f"WARMUP_MODE must be one of {WARMUP_MODES}")
+        self.started = started
+        self.mode = mode
+        self.timeout = timeout
+        self.workers = workers
+        self.n_workers = n_workers
+        self.imported = None
+        self.warmed = None
+        self.first_request = None
+        self.error = None
+        self._done = threading.Event()
+
+    def _since_start(self) -> float:
+        return time.perf_counter() - self.started
+
+    def mark_imported(self) -> None:
+        self.imported = self._since_start()
+        if self.mode == "off":
+            self._done.set()
+
+    def mark_request(self) -> None:
+        if self.first_request is None:
+            self.first_request = self._since_start()
+
+    def warm_up(self) -> None:
+        """Run ``warm_up`` here and in ``n_workers`` job workers; a failure is
+        logged and reported, and still counts as done."""
+        try:
+            warm_workers = self.workers is not None and self.n_workers > 0
+            if warm_workers:
+                # Started first, so they warm up alongside this process
+                self.workers.start(warm=True, n_workers=self.n_workers)
+            warm_up()
+            if warm_workers and not self.workers.wait_warm(self._remaining()):
+                logger.warning("Job workers still warming up after %.0fs", self.timeout)
+        except Exception as e:
+            logger.exception("Warm-up failed")
+            self.error = f"{type(e).__name__}: {e}"
+        finally:
+            self.warmed = self._since_start()
+            self._done.set()
+
+    def _remaining(self) -> float:
+        return max(0.0, self.timeout - (self._since_start() - (self.imported or 0.0)))
+
+    def wait(self) -> None:
+        """Block until the warm-up is done or ``timeout`` has passed since the imports."""
+        self._done.wait(self._remaining())
+
+    @property
+    def ready(self) -> bool:
+        return self._done.is_set() or (
+            self.imported is not None and self._since_start() - self.imported >= self.timeout
+        )
+
+    def status(self) -> dict:
+        return {
+            "status": "ok",
+            "ready": self.ready,
+            "warmup_mode": self.mode,
+            "import_seconds": self.imported,
+            "warmup_seconds": None if self.warmed is None else self.warmed - self.imported,
+            "ready_seconds": self.warmed if self.mode != "off" else self.imported,
+            "first_request_seconds": self.first_request,
+            "warm_job_workers": None if self.workers is None else self.workers.warm_workers(),
+            "warmup_error": self.error,
+        }
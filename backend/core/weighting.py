@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+from api.schemas import PSMResponse
+from core.balance import covariate_balance
+from core.dml import arm_outcome_predictions
+from core.inference import normal_interval
+from core.metrics import lap
+from core.plots import histogram_plot
+from core.preprocessing import ConfounderEncoder
+
+ESTIMATORS = ("matching", "ipw", "aipw")
+
+def _ratio_sum(terms, n: int) -> tuple:
+    """Estimate ``sum(sign * a.sum() / b.sum())`` over ``(sign, a, b)`` terms,
+    and its standard error from the linearized influence of every unit."""
+    estimate = 0.0
+    influence = np.zeros(n)
+    for sign, a, b in terms:
+        total = b.sum()
+        value = a.sum() / total
+        estimate += sign * value
+        influence += sign * n * (a - value * b) / total
+    return estimate, np.sqrt(np.sum(influence ** 2)) / n
+
+def weighted_effects(
+    treatment, outcomes, propensity, trim: float = 0.01, stabilize: bool = True,
+    outcome_predictions: tuple | None = None, confidence_level: float = 0.95
+) -> tuple:
+    """ATE, ATT and ATC by inverse-probability weighting, in one vectorized pass.
+
+    Propensities are clipped to ``[trim, 1 - trim]``. ``stabilize`` normalizes
+    the weights to sum to the group they stand in for (Hajek); otherwise they
+    are plain Horvitz-Thompson weights. With ``outcome_predictions``
+    ``(mu0, mu1)`` the estimates are doubly robust (AIPW): the weights apply to
+    the outcome models' residuals. Standard errors are influence-function
+    based, taking the propensities and outcome models as given.
+
+    Returns ``({name: EffectInference}, weights)``, with the ATE weights per row.
+    """
+    e = np.clip(np.asarray(propensity, dtype=float), trim, 1 - trim)
+    y = np.asarray(outcomes, dtype=float)
+    t = (np.asarray(treatment) == 1).astype(float)
+    c = (np.asarray(treatment) == 0).astype(float)
+    ones = np.ones(len(y))
+    mu0, mu1 = outcome_predictions if outcome_predictions is not None else (np.zeros(len(y)), np.zeros(len(y)))
+    w1, w0 = t / e, c / (1 - e)
+    w_att, w_atc = c * e / (1 - e), t * (1 - e) / e
+    terms = {
+        "ate": [(1, w1 * (y - mu1), w1 if stabilize else ones), (-1, w0 * (y - mu0), w0 if stabilize else ones)],
+        "att": [(1, t * (y - mu0), t), (-1, w_att * (y - mu0), w_att if stabilize else t)],
+        "atc": [(1, c * (mu1 - y), c), (1, w_atc * (y - mu1), w_atc if stabilize else c)],
+    }
+    if outcome_predictions is not None:
+        terms["ate"].insert(0, (1, mu1 - mu0, ones))
+    inference = {
+        name: normal_interval(*_ratio_sum(name_terms, len(y)), confidence_level)
+        for name, name_terms in terms.items()
+    }
+    return inference, w1 + w0
+
+def weighting(
+    df: pd.DataFrame, X, treatment_col: str, outcome_col: str, propensity, estimator: str,
+    trim: float = 0.01, stabilize: bool = True, outcome_learner: str = "ridge", n_splits: int = 5,
+    random_state: int = 42, n_jobs: int = 1, confidence_level: float = 0.95, show_prop_hist: bool = True,
+    plot_mode: str = "binned", include_full_data: bool = False, tables: dict | None = None,
+    encoder: ConfounderEncoder | None = None
+) -> PSMResponse:
+    """The PSM response for ``estimator`` ``ipw`` or ``aipw`` on fitted ``propensity`` scores.
+
+    AIPW cross-fits its outcome models with DML's learners
+    (``core.dml.arm_outcome_predictions``) on the design ``X``. A ``tables``
+    dict gets the rows with their propensity score and ATE weight as
+    ``full_data``. With the ``encoder`` that made ``X``, the response also
+    gets the covariate balance under the ATE weights.
+    """
+    treatment = df[treatment_col].to_numpy()
+    outcomes = df[outcome_col].to_numpy(dtype=float)
+    outcome_predictions = None
+    if estimator == "aipw":
+        outcome_predictions = arm_outcome_predictions(
+            X, treatment, outcomes, outcome_learner, n_splits, random_state, n_jobs
+        )
+        lap("outcome_models")
+    inference, weights = weighted_effects(
+        treatment, outcomes, propensity, trim, stabilize, outcome_predictions, confidence_level
+    )
+    lap("weighting")
+
+    balance = None
+    if encoder is not None:
+        balance = covariate_balance(X, df, encoder, treatment == 1, weights, tables)
+        lap("balance")
+
+    df_weighted = df.assign(_propensity_score=propensity, _weight=weights)
+    if tables is not None:
+        tables["full_data"] = df_weighted
+    prop_hist_data = None
+    if show_prop_hist:
+        prop_hist_data = histogram_plot(
+            propensity[treatment == 1],
+            propensity[treatment == 0],
+            bins=20,
+            plot_mode=plot_mode,
+            title="Propensity Score Distribution",
+            xlabel="Propensity Score",
+            ylabel="Count",
+            legend_labels=["Treated", "Control"]
+        )
+    lap("plots")
+    return PSMResponse(
+        att=inference["att"].estimate,
+        ate_raw=inference["ate"].estimate,
+        message=f"{estimator.upper()} analysis complete.",
+        propensity_score_plot_data=prop_hist_data,
+        full_data_with_psm_info=[{str(k): v for k, v in row.items()} for row in df_weighted.to_dict(orient="records")] if include_full_data else None,
+        inference=inference,
+        balance=balance
+    )
@@ -1,8 +1,68 @@
-from fastapi import FastAPI, HTTPException
+import time
+_started = time.perf_counter()
+import threading
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse
 from api import routes
+from api.compression import add_compression
+from core.jobs import jobs
+from core.metrics import http_latency, mark_request_start, render_metrics
+from core.warmup import Startup
 
-app = FastAPI(title = "Causal Inference Analysis Tool")
+startup = Startup(_started, workers=jobs)
+# Probes and scrapes, which aren't the first request a user waits on
+UNTIMED_PATHS = ("/health", "/health/ready", "/metrics")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup.mark_imported()
+    if startup.mode != "off":
+        threading.Thread(target=startup.warm_up, name="warmup", daemon=True).start()
+    if startup.mode == "blocking":
+        # Serve only once warm, but never wait longer than the timeout
+        await run_in_threadpool(startup.wait)
+    yield
+    # Don't leave worker processes behind when the server stops
+    jobs.shutdown()
+
+app = FastAPI(title = "Causal Inference Analysis Tool", lifespan=lifespan)
 app.include_router(routes.router, prefix="/api", tags=["routes"])
+add_compression(app)
+
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    start = time.perf_counter()
+    mark_request_start()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - start
+    # Label by endpoint, not raw path, so IDs in the path don't each get a series
+    route = request.scope.get("route")
+    http_latency.observe(
+        elapsed, method=request.method, endpoint=route.name if route is not None else "unmatched", status=response.status_code
+    )
+    timing = f"total;dur={elapsed * 1000:.1f}"
+    stages = response.headers.get("Server-Timing")
+    response.headers["Server-Timing"] = f"{stages}, {timing}" if stages else timing
+    if request.url.path not in UNTIMED_PATHS:
+        startup.mark_request()
+    return response
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Request and analysis-stage latency histograms in Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health")
+async def health():
+    """Liveness, with startup timings: imports, warm-up and the first request."""
+    return startup.status()
+
+@app.get("/health/ready")
+async def ready():
+    """200 once the estimators are warm (see ``WARMUP_MODE``), 503 until then."""
+    return JSONResponse(startup.status(), status_code=200 if startup.ready else 503)
 
 @app.get("/")
 async def root():
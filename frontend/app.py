@@ -3,12 +3,304 @@ import requests
 import pandas as pd
 import matplotlib.pyplot as plt
 import os
+import time
+import hashlib
+import gzip
+import io
+import json
 import numpy as np
+import pyarrow as pa
 
 st.set_page_config(page_title="Causal Inference Analysis Tool", layout="centered")
 st.title("Causal Inference Analysis Tool")
 
 FASTAPI_URL = os.environ.get("FASTAPI_URL", "http://localhost:8000/api")
+PREVIEW_ROWS = 1000
+# Request bodies smaller than this are sent uncompressed
+GZIP_MIN_BYTES = 1024
+# Analysis results kept per browser session, by dataset and parameters
+RESULT_CACHE_SIZE = 32
+
+@st.cache_resource
+def http_session():
+    """One keep-alive connection pool to the backend, shared by every rerun and browser session."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def post(path, timeout, **kwargs):
+    """POST to the backend over the pooled session, gzipping bodies of ``GZIP_MIN_BYTES`` or more."""
+    session = http_session()
+    request = session.prepare_request(requests.Request("POST", f"{FASTAPI_URL}/{path}", **kwargs))
+    if request.body is not None and len(request.body) >= GZIP_MIN_BYTES:
+        body = request.body.encode() if isinstance(request.body, str) else request.body
+        request.body = gzip.compress(body, compresslevel=5)
+        request.headers["Content-Encoding"] = "gzip"
+        request.headers["Content-Length"] = str(len(request.body))
+    return session.send(request, timeout=timeout)
+
+def get(path, timeout, **kwargs):
+    """GET from the backend over the pooled session; responses arrive gzipped when large."""
+    return http_session().get(f"{FASTAPI_URL}/{path}", timeout=timeout, **kwargs)
+
+def to_arrow_ipc(df):
+    """Serialize a DataFrame to Arrow IPC stream bytes for the upload endpoints."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+@st.cache_data(max_entries=4, show_spinner="Reading CSV...")
+def parse_upload(raw):
+    """Parse an uploaded CSV once per distinct file; returns the DataFrame, its Arrow IPC bytes and its dataset ID."""
+    df = pd.read_csv(io.BytesIO(raw))
+    data = to_arrow_ipc(df)
+    # The backend keys datasets by the SHA-256 of the uploaded bytes
+    return df, data, hashlib.sha256(data).hexdigest()
+
+def register_dataset():
+    """Upload the Arrow IPC data to the backend dataset store."""
+    files = {"file": ("data.arrow", st.session_state.df_data, "application/vnd.apache.arrow.stream")}
+    response = post("datasets", timeout=120, files=files)
+    response.raise_for_status()
+
+def submit_job(endpoint, params):
+    """Submit an analysis job against the registered dataset, uploading it only if the backend doesn't have it."""
+    payload = {**params, "dataset_id": st.session_state.dataset_id}
+    response = post(f"jobs/{endpoint}", timeout=30, json=payload)
+    if response.status_code == 404:
+        register_dataset()
+        response = post(f"jobs/{endpoint}", timeout=30, json=payload)
+    response.raise_for_status()
+    return response.json()["job_id"]
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def fetch_table(result_id, table, limit=None):
+    """Fetch (a page of) a result table as Arrow; returns the rows and the table's total row count."""
+    params = {"format": "arrow"}
+    if limit is not None:
+        params["limit"] = limit
+    response = get(f"results/{result_id}/{table}", timeout=120, params=params)
+    response.raise_for_status()
+    rows = pa.ipc.open_stream(response.content).read_all().to_pandas()
+    return rows, int(response.headers["X-Total-Rows"])
+
+def plot_histogram(ax, plot_data, group, bins, label, color):
+    """Draw one group of a PlotData histogram, from backend bin counts or raw values."""
+    if plot_data.get("bin_edges") is not None:
+        edges = plot_data["bin_edges"]
+        ax.hist(edges[:-1], bins=edges, weights=plot_data[f"{group}_counts"], alpha=0.6, label=label, color=color)
+    elif plot_data.get(f"{group}_values"):
+        ax.hist(plot_data[f"{group}_values"], bins=bins, alpha=0.6, label=label, color=color)
+
+def show_inference(results):
+    """List standard errors and confidence intervals, when the backend computed them."""
+    for name, inference in (results.get("inference") or {}).items():
+        if inference.get("std_error") is not None:
+            level = f"{100 * (inference.get('confidence_level') or 0.95):g}%"
+            # Analytic intervals come from a single fit
+            replicates = f", {inference['n_replicates']} replicates" if inference["n_replicates"] > 1 else ""
+            st.write(f"**{name.upper()}:** {inference['estimate']:.4f} (SE {inference['std_error']:.4f}, "
+                     f"{level} CI [{inference['ci_lower']:.4f}, {inference['ci_upper']:.4f}]{replicates})")
+
+def show_balance(results):
+    """Covariate balance table, when the backend computed it."""
+    if results.get("balance"):
+        with st.expander("Covariate balance", expanded=False):
+            st.dataframe(pd.DataFrame(results["balance"]).set_index("covariate").round(4))
+
+def describe_progress(progress):
+    if not progress:
+        return "Running..."
+    if progress.get("stage") == "cross_fitting":
+        if progress.get("cached"):
+            return f"Reusing cached fits for split {progress['repeat']}/{progress['n_repeats']}..."
+        return f"Cross-fitting split {progress['repeat']}/{progress['n_repeats']}, fold {progress['fold']}/{progress['n_folds']}..."
+    if progress.get("stage") == "bootstrap":
+        return f"Bootstrap replicate {progress['replicate']}/{progress['n_replicates']}..."
+    if "matched_units" in progress:
+        return f"Matching ({progress['matched_units']} units matched)..."
+    return f"Running ({progress['stage']})..."
+
+def run_analysis(endpoint, params):
+    """Run an analysis as a backend job, showing its progress until it finishes."""
+    job_id = submit_job(endpoint, params)
+    status_text = st.empty()
+    while True:
+        status = get(f"jobs/{job_id}", timeout=30).json()
+        if status["status"] == "queued":
+            status_text.text(f"Queued (position {status['queue_position'] + 1})...")
+        elif status["status"] == "running":
+            status_text.text(describe_progress(status["progress"]))
+        else:
+            break
+        time.sleep(0.5)
+    status_text.empty()
+    if status["status"] != "succeeded":
+        return {"message": f"Error: analysis {status['status']}: {status.get('error') or ''}"}
+    return get(f"jobs/{job_id}/result", timeout=120).json()
+
+def analysis_key(endpoint, params):
+    return st.session_state.dataset_id, endpoint, json.dumps(params, sort_keys=True)
+
+def cached_result(endpoint, params):
+    """This session's result for ``params`` on the current dataset, if it has one."""
+    return st.session_state.analysis_results.get(analysis_key(endpoint, params))
+
+def cached_analysis(endpoint, params):
+    """``run_analysis``, reusing this session's result for the same dataset and parameters."""
+    key = analysis_key(endpoint, params)
+    cache = st.session_state.analysis_results
+    if key not in cache:
+        results = run_analysis(endpoint, params)
+        if "Error" in (results.get("message") or ""):
+            return results
+        cache[key] = results
+        while len(cache) > RESULT_CACHE_SIZE:
+            del cache[next(iter(cache))]
+    return cache[key]
+
+def show_psm_results(results, show_prop_hist, show_matched_pair_hist):
+    """Estimates, conclusions, result tables and plots of a PSM response."""
+    if results.get("message"):
+        if "Error" in results["message"] or "No " in results["message"]:
+            st.error(results["message"])
+        elif not "complete" in results["message"]:
+            st.info(results["message"])
+    # A failed or cancelled job has only its message
+    if results.get("att") is None or results.get("ate_raw") is None:
+        return
+
+    if results.get("att") is not None:
+        st.write(f"**ATT (Matched units):** {results['att']:.4f}")
+    if results.get("ate_raw") is not None:
+        st.write(f"**ATE (Raw difference):** {results['ate_raw']:.4f}")
+    if results.get("num_matched_pairs") is not None:
+        st.write(f"**Number of matched units/pairs:** {results['num_matched_pairs']}")
+    show_inference(results)
+    show_balance(results)
+
+    # Conclusions
+    col5, col6 = st.columns(2)
+    with col5:
+        if results['ate_raw'] > 0:
+            st.success(f"ATE conclusion: On Average, on the entire population, the treatment increases the outcome by {results['ate_raw']:.4f}")
+        elif results['ate_raw'] < 0:
+            st.error(f" ATE conclusion: On Average, on the entire population, the treatment decreases the outcome by {results['ate_raw']:.4f}")
+        else:
+            st.warning("ATE conclusion: On Average, on the entire population, the treatment has no effect on the outcome")
+    with col6:
+        if results['att'] > 0:
+            st.success(f"ATT conclusion: On Average, on the treated, the treatment increases the outcome by {results['att']:.4f}")
+        elif results['att'] < 0:
+            st.error(f"ATT conclusion: On Average, on the treated, the treatment decreases the outcome by {results['att']:.4f}")
+        else:
+            st.warning("ATT conclusion: On Average, on the treated, the treatment has no effect on the outcome")
+
+    # Display DataFrame with PSM info
+    if results.get("result_id"):
+        with st.expander("Show full data with propensity scores and matching info"):
+            df_psm_info, total_rows = fetch_table(results["result_id"], "full_data", limit=PREVIEW_ROWS)
+            st.caption(f"Showing {len(df_psm_info)} of {total_rows} rows")
+            st.dataframe(df_psm_info)
+
+    # Display matched pairs table
+    if results.get("result_id"):
+        with st.expander("Show all matched pairs (treated to control original indices)"):
+            df_matched_pairs, total_rows = fetch_table(results["result_id"], "matched_pairs", limit=PREVIEW_ROWS)
+            st.caption(f"Showing {len(df_matched_pairs)} of {total_rows} pairs")
+            st.dataframe(df_matched_pairs)
+
+    # Display plots
+    if results.get("propensity_score_plot_data") and show_prop_hist:
+        plot_data = results["propensity_score_plot_data"]
+        fig, ax = plt.subplots(figsize=(7, 4))
+        plot_histogram(ax, plot_data, "treated", 20, plot_data["legend_labels"][0] if plot_data.get("legend_labels") else "Treated", "tab:blue")
+        plot_histogram(ax, plot_data, "control", 20, plot_data["legend_labels"][1] if plot_data.get("legend_labels") else "Control", "tab:orange")
+        ax.set_xlabel(plot_data.get("xlabel", "Propensity Score"))
+        ax.set_ylabel(plot_data.get("ylabel", "Count"))
+        ax.set_title(plot_data.get("title", "Propensity Score Distribution"))
+        ax.legend()
+        st.pyplot(fig)
+
+    if results.get("matched_outcome_plot_data") and show_matched_pair_hist:
+        plot_data = results["matched_outcome_plot_data"]
+        fig2, ax2 = plt.subplots(figsize=(7, 4))
+        plot_histogram(ax2, plot_data, "treated", 10, plot_data["legend_labels"][0] if plot_data.get("legend_labels") else "Matched Treated", "tab:purple")
+        plot_histogram(ax2, plot_data, "control", 10, plot_data["legend_labels"][1] if plot_data.get("legend_labels") else "Matched Control", "tab:green")
+        ax2.set_xlabel(plot_data.get("xlabel", "Outcome"))
+        ax2.set_ylabel(plot_data.get("ylabel", "Count"))
+        ax2.set_title(plot_data.get("title", "Outcome Distribution of Matched Units"))
+        ax2.legend()
+        st.pyplot(fig2)
+
+def show_dml_results(results, view_outcome_plot):
+    """Estimates, conclusions and plots of a DML response."""
+    if results.get("message") and "Error" in results["message"]:
+        st.error(results["message"])
+    if results.get("att") is None or results.get("ate") is None:
+        return
+
+    if results.get("att") is not None:
+        st.write(f"**ATT (Matched units):** {results['att']:.4f}")
+    if results.get("ate") is not None:
+        st.write(f"**ATE (Adjusted for confounders):** {results['ate']:.4f}")
+    show_inference(results)
+    if results.get("cate"):
+        summary = results["cate"]
+        quantiles = ", ".join(f"{name}: {value:.4f}" for name, value in summary["quantiles"].items())
+        st.write(f"**CATE:** mean {summary['mean']:.4f}, std {summary['std']:.4f} ({quantiles})")
+        st.caption(f"Score new rows with POST /api/dml/{summary['model_id']}/score")
+    col5, col6 = st.columns(2)
+
+    # Conclusions
+    with col5:
+        if results['ate'] > 0:
+            st.success(f"ATE conclusion: On Average, on the entire population, the treatment increases the outcome by {results['ate']:.4f}")
+        elif results['ate'] < 0:
+            st.error(f" ATE conclusion: On Average, on the entire population, the treatment decreases the outcome by {results['ate']:.4f}")
+        else:
+            st.warning("ATE conclusion: On Average, on the entire population, the treatment has no effect on the outcome")
+    with col6:
+        if results['att'] > 0:
+            st.success(f"ATT conclusion: On Average, on the treated, the treatment increases the outcome by {results['att']:.4f}")
+        elif results['att'] < 0:
+            st.error(f"ATT conclusion: On Average, on the treated, the treatment decreases the outcome by {results['att']:.4f}")
+        else:
+            st.warning("ATT conclusion: On Average, on the treated, the treatment has no effect on the outcome")
+
+    # Output plot
+    if results.get("outcome_plot") and view_outcome_plot:
+        plot_data = results["outcome_plot"]
+        fig, ax = plt.subplots(figsize=(7, 4))
+        plot_histogram(ax, plot_data, "treated", 20, plot_data["legend_labels"][0] if plot_data.get("legend_labels") else "Treated", "tab:blue")
+        plot_histogram(ax, plot_data, "control", 20, plot_data["legend_labels"][1] if plot_data.get("legend_labels") else "Control", "tab:orange")
+        ax.set_xlabel(plot_data.get("xlabel", "Outcome"))
+        ax.set_ylabel(plot_data.get("ylabel", "Count"))
+        ax.set_title(plot_data.get("title", "Outcome Distribution by Treatment Group"))
+        ax.legend()
+        st.pyplot(fig)
+
+    # DML final model liner regression plot
+    if results.get("linear_regression_plot"):                        
+        lasso_data = results["linear_regression_plot"]
+        intercept = lasso_data["intercept"]
+        coef = lasso_data["coef"]
+        fig, ax = plt.subplots(figsize=(7, 4))
+        ax.scatter(lasso_data["sample_treatment_residuals"], lasso_data["sample_outcome_residuals"], alpha=0.5, label="Residuals (sample)")
+        ax.scatter(lasso_data["binned_treatment_residuals"], lasso_data["binned_outcome_residuals"], color="black", marker="D", s=18, label="Quantile-bin means")
+        x_vals = np.linspace(lasso_data["x_min"], lasso_data["x_max"], 100)
+        y_vals = intercept + coef * x_vals
+        ax.plot(x_vals, y_vals, color="red", label="LassoCV Fit")
+        ax.set_xlabel("Treatment Residuals")
+        ax.set_ylabel("Outcome Residuals")
+        ax.set_title("LassoCV Fit on Residuals (DML)")
+        ax.legend()
+        st.pyplot(fig)
+
 
 # File upload ui
 st.header("Upload your CSV file")
@@ -19,9 +311,11 @@ columns = []
 
 if "df_data" not in st.session_state:
     st.session_state.df_data = None
+    st.session_state.dataset_id = None
+if "analysis_results" not in st.session_state:
+    st.session_state.analysis_results = {}
 if uploaded_file is not None:
-    df = pd.read_csv(uploaded_file)
-    st.session_state.df_data = df.to_dict(orient="records")
+    df, st.session_state.df_data, st.session_state.dataset_id = parse_upload(uploaded_file.getvalue())
     st.session_state.columns = df.columns.tolist()
     st.success("File uploaded successfully")
     with st.expander("Click to show uploaded data", expanded=False):
@@ -54,104 +348,56 @@ with psm_tab:
             random_state = st.number_input("random_state", value=42, step=1, key="random_state_psm")
 
         st.markdown("### Advanced Options (optional)")
+        matching_method = st.selectbox(
+            "Matching method", ["nearest", "greedy", "optimal"], key="matching_method_psm",
+            help="nearest matches with replacement; greedy and optimal use each unit in at most one pair"
+        )
+        estimator = st.selectbox(
+            "Estimator", ["matching", "ipw", "aipw"], key="estimator_psm",
+            help="ipw and aipw weight units by their propensity scores instead of matching them; aipw also fits outcome models"
+        )
         scale_features = st.checkbox("Scale features for matching", value=True, key="scale_features_psm")
         show_prop_hist = st.checkbox("Show propensity score distribution plot", value=True, key="show_prop_hist_psm")
         show_matched_pair_hist = st.checkbox("Show outcome distribution of matched pairs", value=False, key="show_matched_pair_hist_psm")
         use_caliper = st.checkbox("Use caliper for matching", value=False, key="use_caliper_psm")
         caliper = st.number_input("Caliper (max distance allowed)", min_value=0.0, value=0.1, step=0.01, disabled=not use_caliper, key="caliper_psm")
+        n_bootstrap = st.number_input("Bootstrap replicates for standard errors (0 = off)", min_value=0, value=0, step=50, key="n_bootstrap_psm")
 
+        # Plots are always requested and shown per the checkboxes, so toggling
+        # one reuses the cached result instead of rerunning the analysis
+        payload = {
+            "treatment_col": treatment_col,
+            "outcome_col": outcome_col,
+            "confounders": confounders,
+            "n_neighbors": n_neighbors,
+            "matching_method": matching_method,
+            "estimator": estimator,
+            "random_state": random_state,
+            "scale_features": scale_features,
+            "use_caliper": use_caliper,
+            "caliper": caliper if use_caliper else 0.0,
+            "n_bootstrap": n_bootstrap,
+            "show_prop_hist": True,
+            "show_matched_pair_hist": True
+        }
+        results = None
         if st.button("Analyze Data", key="analyze_psm"):
             if not treatment_col or not outcome_col or not confounders:
                 st.error("Please input treatement, outcome and confounder columns")
             else:
-                payload = {
-                    "data": st.session_state.df_data,
-                    "treatment_col": treatment_col,
-                    "outcome_col": outcome_col,
-                    "confounders": confounders,
-                    "n_neighbors": n_neighbors,
-                    "random_state": random_state,
-                    "scale_features": scale_features,
-                    "use_caliper": use_caliper,
-                    "caliper": caliper if use_caliper else 0.0,
-                    "show_prop_hist": show_prop_hist,
-                    "show_matched_pair_hist": show_matched_pair_hist
-                }
-
                 try:
                     with st.spinner("Loading..."):
-                        response = requests.post(f"{FASTAPI_URL}/psm", json=payload, timeout=120)
-                    results = response.json()
-                    if results.get("message"):
-                        if "Error" in results["message"] or "No " in results["message"]:
-                            st.error(results["message"])
-                        elif not "complete" in results["message"]:
-                            st.info(results["message"])
-
-                    if results.get("att") is not None:
-                        st.write(f"**ATT (Matched units):** {results['att']:.4f}")
-                    if results.get("ate_raw") is not None:
-                        st.write(f"**ATE (Raw difference):** {results['ate_raw']:.4f}")
-                    if results.get("num_matched_pairs") is not None:
-                        st.write(f"**Number of matched units/pairs:** {results['num_matched_pairs']}")
-                    
-                    # Conclusions
-                    col5, col6 = st.columns(2)
-                    with col5:
-                        if results['ate_raw'] > 0:
-                            st.success(f"ATE conclusion: On Average, on the entire population, the treatment increases the outcome by {results['ate_raw']:.4f}")
-                        elif results['ate_raw'] < 0:
-                            st.error(f" ATE conclusion: On Average, on the entire population, the treatment decreases the outcome by {results['ate_raw']:.4f}")
-                        else:
-                            st.warning("ATE conclusion: On Average, on the entire population, the treatment has no effect on the outcome")
-                    with col6:
-                        if results['att'] > 0:
-                            st.success(f"ATT conclusion: On Average, on the treated, the treatment increases the outcome by {results['att']:.4f}")
-                        elif results['att'] < 0:
-                            st.error(f"ATT conclusion: On Average, on the treated, the treatment decreases the outcome by {results['att']:.4f}")
-                        else:
-                            st.warning("ATT conclusion: On Average, on the treated, the treatment has no effect on the outcome")
-
-                    # Display DataFrame with PSM info
-                    if results.get("full_data_with_psm_info"):
-                        with st.expander("Show full data with propensity scores and matching info"):
-                            df_psm_info = pd.DataFrame(results["full_data_with_psm_info"])
-                            st.dataframe(df_psm_info)
-
-                    # Display matched pairs table
-                    if results.get("matched_pairs_table"):
-                        with st.expander("Show all matched pairs (treated to control original indices)"):
-                            df_matched_pairs = pd.DataFrame(results["matched_pairs_table"])
-                            st.dataframe(df_matched_pairs)
-
-                    # Display plots
-                    if results.get("propensity_score_plot_data") and show_prop_hist:
-                        plot_data = results["propensity_score_plot_data"]
-                        fig, ax = plt.subplots(figsize=(7, 4))
-                        if plot_data.get("treated_values"):
-                            ax.hist(plot_data["treated_values"], bins=20, alpha=0.6, label=plot_data["legend_labels"][0] if plot_data.get("legend_labels") else "Treated", color="tab:blue")
-                        if plot_data.get("control_values"):
-                            ax.hist(plot_data["control_values"], bins=20, alpha=0.6, label=plot_data["legend_labels"][1] if plot_data.get("legend_labels") else "Control", color="tab:orange")
-                        ax.set_xlabel(plot_data.get("xlabel", "Propensity Score"))
-                        ax.set_ylabel(plot_data.get("ylabel", "Count"))
-                        ax.set_title(plot_data.get("title", "Propensity Score Distribution"))
-                        ax.legend()
-                        st.pyplot(fig)
-
-                    if results.get("matched_outcome_plot_data") and show_matched_pair_hist:
-                        plot_data = results["matched_outcome_plot_data"]
-                        fig2, ax2 = plt.subplots(figsize=(7, 4))
-                        if plot_data.get("treated_values"):
-                            ax2.hist(plot_data["treated_values"], bins=10, alpha=0.6, label=plot_data["legend_labels"][0] if plot_data.get("legend_labels") else "Matched Treated", color="tab:purple")
-                        if plot_data.get("control_values"):
-                            ax2.hist(plot_data["control_values"], bins=10, alpha=0.6, label=plot_data["legend_labels"][1] if plot_data.get("legend_labels") else "Matched Control", color="tab:green")
-                        ax2.set_xlabel(plot_data.get("xlabel", "Outcome"))
-                        ax2.set_ylabel(plot_data.get("ylabel", "Count"))
-                        ax2.set_title(plot_data.get("title", "Outcome Distribution of Matched Units"))
-                        ax2.legend()
-                        st.pyplot(fig2)
+                        results = cached_analysis("psm", payload)
                 except Exception as e:
                     st.error(f"An error occurred while communicating with the backend: {e}")
+        else:
+            # Keep showing the last result for these settings across reruns
+            results = cached_result("psm", payload)
+        if results is not None:
+            try:
+                show_psm_results(results, show_prop_hist, show_matched_pair_hist)
+            except Exception as e:
+                st.error(f"An error occurred while communicating with the backend: {e}")
     else:
         st.info("Please upload your data")
 
@@ -175,84 +421,54 @@ with dml_tab:
         with col4:
             random_state = st.number_input("random_state", value=42, step=1, key="random_state_dml")
 
+        use_all_cores = st.checkbox("Use every core for cross-fitting", value=False, key="use_all_cores_dml")
+        n_jobs = st.number_input("n_jobs", min_value=1, value=1, step=1, disabled=use_all_cores, key="n_jobs_dml")
+        n_repeats = st.number_input("Repeated cross-fitting splits (median-aggregated)", min_value=1, value=1, step=1, key="n_repeats_dml")
+        col7, col8 = st.columns(2)
+        with col7:
+            treatment_learner = st.selectbox(
+                "Treatment model", ["fast", "logistic", "logistic_warm", "hist_gradient_boosting"], key="treatment_learner_dml",
+                help="fast uses gradient boosting on large data and logistic regression otherwise"
+            )
+        with col8:
+            outcome_learner = st.selectbox(
+                "Outcome model", ["fast", "random_forest", "ridge", "hist_gradient_boosting"], key="outcome_learner_dml",
+                help="fast uses gradient boosting on large data and a random forest otherwise"
+            )
         scale_features = st.checkbox("Scale features for matching", value=True, key="scale_features_dml")
         view_outcome_plot = st.checkbox("Show outcome distribution plot", value=False, key="view_outcome_plot_dml")
+        cate = st.checkbox("Estimate heterogeneous effects (CATE)", value=False, key="cate_dml")
 
+        payload = {
+            "treatment_col": treatment_col,
+            "outcome_col": outcome_col,
+            "confounders": confounders,
+            "n_splits": n_splits,
+            "random_state": random_state,
+            "n_jobs": -1 if use_all_cores else n_jobs,
+            "n_repeats": n_repeats,
+            "treatment_learner": treatment_learner,
+            "outcome_learner": outcome_learner,
+            "cate": cate,
+            "scale_features": scale_features
+        }
+        results = None
         if st.button("Analyze Data", key="analyze_dml"):
             if not treatment_col or not outcome_col or not confounders:
                 st.error("Please input treatement, outcome and confounder columns")
             else:
-                payload = {
-                    "data": st.session_state.df_data,
-                    "treatment_col": treatment_col,
-                    "outcome_col": outcome_col,
-                    "confounders": confounders,
-                    "n_splits": n_splits,
-                    "random_state": random_state,
-                    "scale_features": scale_features,
-                    "view_outcome_plot": view_outcome_plot
-                }
-
                 try:
                     with st.spinner("Loading..."):
-                        response = requests.post(f"{FASTAPI_URL}/dml", json=payload, timeout=120)
-                    results = response.json()
-
-                    if results.get("att") is not None:
-                        st.write(f"**ATT (Matched units):** {results['att']:.4f}")
-                    if results.get("ate") is not None:
-                        st.write(f"**ATE (Adjusted for confounders):** {results['ate']:.4f}")
-                    col5, col6 = st.columns(2)
-
-                    # Conclusions
-                    with col5:
-                        if results['ate'] > 0:
-                            st.success(f"ATE conclusion: On Average, on the entire population, the treatment increases the outcome by {results['ate']:.4f}")
-                        elif results['ate'] < 0:
-                            st.error(f" ATE conclusion: On Average, on the entire population, the treatment decreases the outcome by {results['ate']:.4f}")
-                        else:
-                            st.warning("ATE conclusion: On Average, on the entire population, the treatment has no effect on the outcome")
-                    with col6:
-                        if results['att'] > 0:
-                            st.success(f"ATT conclusion: On Average, on the treated, the treatment increases the outcome by {results['att']:.4f}")
-                        elif results['att'] < 0:
-                            st.error(f"ATT conclusion: On Average, on the treated, the treatment decreases the outcome by {results['att']:.4f}")
-                        else:
-                            st.warning("ATT conclusion: On Average, on the treated, the treatment has no effect on the outcome")
-                    
-                    # Output plot
-                    if results.get("outcome_plot"):
-                        plot_data = results["outcome_plot"]
-                        fig, ax = plt.subplots(figsize=(7, 4))
-                        if plot_data.get("treated_values"):
-                            ax.hist(plot_data["treated_values"], bins=20, alpha=0.6, label=plot_data["legend_labels"][0] if plot_data.get("legend_labels") else "Treated", color="tab:blue")
-                        if plot_data.get("control_values"):
-                            ax.hist(plot_data["control_values"], bins=20, alpha=0.6, label=plot_data["legend_labels"][1] if plot_data.get("legend_labels") else "Control", color="tab:orange")
-                        ax.set_xlabel(plot_data.get("xlabel", "Outcome"))
-                        ax.set_ylabel(plot_data.get("ylabel", "Count"))
-                        ax.set_title(plot_data.get("title", "Outcome Distribution by Treatment Group"))
-                        ax.legend()
-                        st.pyplot(fig)
-
-                    # DML final model liner regression plot
-                    if results.get("linear_regression_plot"):                        
-                        lasso_data = results["linear_regression_plot"]
-                        x = np.array(lasso_data["treatment_residuals"])
-                        y = np.array(lasso_data["outcome_residuals"])
-                        intercept = lasso_data["intercept"]
-                        coef = lasso_data["coef"]
-                        fig, ax = plt.subplots(figsize=(7, 4))
-                        ax.scatter(x, y, alpha=0.5, label="Residuals")
-                        x_vals = np.linspace(x.min(), x.max(), 100)
-                        y_vals = intercept + coef * x_vals
-                        ax.plot(x_vals, y_vals, color="red", label="LassoCV Fit")
-                        ax.set_xlabel("Treatment Residuals")
-                        ax.set_ylabel("Outcome Residuals")
-                        ax.set_title("LassoCV Fit on Residuals (DML)")
-                        ax.legend()
-                        st.pyplot(fig)
-
+                        results = cached_analysis("dml", payload)
                 except Exception as e:
                     st.error(f"An error occurred while communicating with the backend: {e}")
+        else:
+            # Keep showing the last result for these settings across reruns
+            results = cached_result("dml", payload)
+        if results is not None:
+            try:
+                show_dml_results(results, view_outcome_plot)
+            except Exception as e:
+                st.error(f"An error occurred while communicating with the backend: {e}")
     else:
         st.info("Please upload your data")
\ No newline at end of file